@@ -9,6 +9,7 @@ from streamlit_option_menu import option_menu
 import graphviz
 import os # <--- NOVO
 from dotenv import load_dotenv # <--- NOVO
+from evolution import ClienteEvolution, EvolutionErro, estado_da_conexao
 
 # =====================================================
 # CARREGAR VARIÁVEIS DE AMBIENTE (.ENV)
@@ -66,10 +67,20 @@ API_URL = os.getenv("LOCAL_URL", "http://127.0.0.1:8000") # Backend Python
 EVO_URL = os.getenv("EVO_API_URL", "http://127.0.0.1:8080") # Evolution API
 EVO_API_KEY = os.getenv("EVO_API_KEY", "SUA_KEY_AQUI")
 
-HEADERS_EVO = {
-    "apikey": EVO_API_KEY,
-    "Content-Type": "application/json"
-}
+# Cliente único da Evolution (pool + retry + circuit breaker, ver evolution.py).
+# cache_resource: o Streamlit re-executa o script a cada clique; o pool sobrevive.
+@st.cache_resource
+def evolution():
+    return ClienteEvolution(EVO_URL, EVO_API_KEY)
+
+def enviar_no_chat(envio, *args):
+    """Envia pelo painel; se a Evolution recusar, avisa e devolve False (nada é salvo)."""
+    try:
+        envio(*args)
+        return True
+    except EvolutionErro as e:
+        st.error(f"Mensagem não enviada: {e}")
+        return False
 
 # =====================================================
 # 🚨 NOVO: VERIFICAÇÃO DE RETORNO DO PAGAMENTO (CARTÃO)
@@ -80,12 +91,15 @@ params = st.query_params
 if params.get("status_mp") == "aprovado":
     uid_pag = params.get("uid")
     plano_pag = params.get("plano")
+    # O MP acrescenta payment_id/collection_id na URL de retorno
+    id_pag = params.get("payment_id") or params.get("collection_id") or ""
     
     try:
-        # Confirma no backend
-        requests.get(f"{API_URL}/pagamento/confirmar_sucesso?uid={uid_pag}&plano={plano_pag}")
+        # Confirma no backend (ele confere no MP e renova uma vez só)
+        requests.get(f"{API_URL}/pagamento/confirmar_sucesso",
+                     params={"uid": uid_pag, "plano": plano_pag, "payment_id": id_pag}, timeout=10)
         
-        st.toast("✅ Pagamento via Cartão Aprovado!", icon="💳")
+        st.toast("✅ Pagamento via Cartão Aprovado! A renovação aparece em instantes.", icon="💳")
         st.balloons()
         
         # Limpa URL e recarrega
@@ -110,16 +124,7 @@ def verificar_status_whatsapp(instancia):
     Retorna True se estiver "open" (conectado).
     """
     try:
-        url_evo = EVO_URL 
-        headers_evo = {"apikey": EVO_API_KEY} 
-        
-        res = requests.get(f"{url_evo}/instance/connectionState/{instancia}", headers=headers_evo, timeout=2)
-        
-        if res.status_code == 200:
-            dados = res.json()
-            estado = dados.get("instance", {}).get("state") or dados.get("state")
-            return estado == "open"
-        return False
+        return estado_da_conexao(evolution().connection_state(instancia)) == "open"
     except:
         return False
     
@@ -630,14 +635,48 @@ def tela_gestao_equipe():
 # =====================================================
 # COMPONENTE: CHAT COM AUTO-REFRESH 🔄
 # =====================================================
-@st.fragment(run_every=3) 
+CHAT_BUFFER_MAX = 200  # mensagens guardadas por conversa na sessão
+
+def atualizar_buffer_chat(instancia, remote_jid):
+    """
+    Mantém as mensagens da conversa em st.session_state e só busca o que é
+    novo (apos_id + ETag). Sem mudança o servidor responde 304 sem corpo.
+    A resposta relê uns segundos antes do cursor (linhas que fizeram commit
+    fora da ordem do id): o que já está no buffer é descartado pelo id.
+    """
+    chave = f"chat_buf_{instancia}_{remote_jid}"
+    buf = st.session_state.get(chave)
+    url = f"{API_URL}/chat/local/{instancia}/{remote_jid}"
+
+    if buf is None:
+        r = requests.get(url, timeout=10)
+        if r.status_code != 200: return []
+        msgs = r.json()
+        buf = {"msgs": msgs, "etag": r.headers.get("ETag"), "ultimo_id": msgs[-1]['id'] if msgs else 0}
+        st.session_state[chave] = buf
+        return buf["msgs"]
+
+    headers = {"If-None-Match": buf["etag"]} if buf.get("etag") else {}
+    r = requests.get(url, params={"apos_id": buf["ultimo_id"]}, headers=headers, timeout=10)
+    if r.status_code == 200:
+        vistos = {m['id'] for m in buf["msgs"]}
+        novas = [m for m in r.json() if m['id'] not in vistos]
+        if novas:
+            msgs = sorted(buf["msgs"] + novas, key=lambda m: (m.get('timestamp') or "", m['id']))
+            buf["msgs"] = msgs[-CHAT_BUFFER_MAX:]
+            buf["ultimo_id"] = buf["msgs"][-1]['id']
+        buf["etag"] = r.headers.get("ETag")
+    return buf["msgs"]
+
+# O feed (vigia_feed) já força a atualização quando chega mensagem; o
+# intervalo aqui é só a rede de segurança (e custa um 304 quando nada mudou).
+@st.fragment(run_every=10) 
 def painel_mensagens_auto(instancia, cliente, nome_usuario):
     chat_container = st.container(height=500)
     
     with chat_container:
         try:
-            r = requests.get(f"{API_URL}/chat/local/{instancia}/{cliente['remote_jid']}")
-            msgs = r.json() if r.status_code == 200 else []
+            msgs = atualizar_buffer_chat(instancia, cliente['remote_jid'])
             
             if not msgs: 
                 st.info("👋 Histórico vazio. Mande a primeira mensagem!")
@@ -671,6 +710,41 @@ def painel_mensagens_auto(instancia, cliente, nome_usuario):
             st.error(f"Erro chat: {e}")
 
 
+# =====================================================
+# COMPONENTE: VIGIA DO FEED (substitui os cliques em 🔄) 📡
+# =====================================================
+# Consulta curta no /feed (sem espera=): o fragmento roda na thread do
+# script, então segurar a requisição (long-poll) faria cada clique esperar.
+# Sem evento novo a resposta é só a versão, barata; o evento aparece em
+# até FEED_INTERVALO_PAINEL_S.
+# Ticket novo/encerrado ou mensagem do chat aberto -> rerun; o resto não.
+FEED_INTERVALO_PAINEL_S = 1
+EVENTOS_TICKET = ("ticket_novo", "ticket_encerrado")
+
+@st.fragment(run_every=FEED_INTERVALO_PAINEL_S)
+def vigia_feed(instancia):
+    chave = f"feed_versao_{instancia}"
+    primeira = chave not in st.session_state
+    try:
+        params = {} if primeira else {"apos": st.session_state[chave]}
+        r = requests.get(f"{API_URL}/feed/{instancia}", params=params, timeout=2)
+        if r.status_code != 200: return
+        res = r.json()
+    except: return
+
+    st.session_state[chave] = res['versao']
+    if primeira or not res['eventos']: return
+
+    chat_aberto = st.session_state.get('chat_atual', {}).get('remote_jid')
+    atualizar = False
+    for ev in res['eventos']:
+        if ev['tipo'] in EVENTOS_TICKET or (ev['tipo'] == "mensagem" and ev['remote_jid'] == chat_aberto):
+            atualizar = True
+        elif ev['tipo'] == "mensagem" and not ev.get('dados', {}).get('from_me'):
+            st.toast(f"💬 Nova mensagem de {str(ev['remote_jid']).split('@')[0]}")
+    if atualizar: st.rerun()
+
+
 # =====================================================
 # TELA ATENDENTE 6.0 (CRM COMPLETO + HISTÓRICO) 🌟
 # =====================================================
@@ -686,6 +760,7 @@ def tela_atendente():
     if c_head2.button("Sair", key="logout_atend"):
         st.session_state.autenticado = False
         st.rerun()
+    vigia_feed(instancia)
     st.divider()
 
     col_lista, col_chat = st.columns([1.3, 2.5])
@@ -812,11 +887,11 @@ def tela_atendente():
                 with st.popover("🏁 Finalizar", use_container_width=True):
                     if st.button("👋 Tchau e Arquivar", use_container_width=True):
                         msg = f"*{nome_usuario}:* Atendimento encerrado. Obrigado!"
-                        requests.post(f"{EVO_URL}/message/sendText/{instancia}", json={"number": cliente['remote_jid'], "text": msg}, headers=HEADERS_EVO)
-                        requests.post(f"{API_URL}/chat/salvar_manual", json={"instancia": instancia, "remote_jid": cliente['remote_jid'], "texto": msg, "nome_atendente": nome_usuario})
-                        requests.post(f"{API_URL}/atendimentos/finalizar/{cliente['id']}", json={"nome_atendente": nome_usuario})
-                        del st.session_state.chat_atual
-                        st.rerun()
+                        if enviar_no_chat(evolution().send_text, instancia, cliente['remote_jid'], msg):
+                            requests.post(f"{API_URL}/chat/salvar_manual", json={"instancia": instancia, "remote_jid": cliente['remote_jid'], "texto": msg, "nome_atendente": nome_usuario})
+                            requests.post(f"{API_URL}/atendimentos/finalizar/{cliente['id']}", json={"nome_atendente": nome_usuario})
+                            del st.session_state.chat_atual
+                            st.rerun()
 
                     if st.button("🤫 Só Arquivar", use_container_width=True):
                         requests.post(f"{API_URL}/atendimentos/finalizar/{cliente['id']}", json={"nome_atendente": nome_usuario})
@@ -837,38 +912,36 @@ def tela_atendente():
                             arq = st.file_uploader("Arquivo", key="up_pop_final")
                             if arq and st.button("Enviar 📤", key="btn_up_final"):
                                 files = {"file": (arq.name, arq, arq.type)}
-                                r_up = requests.post(f"{API_URL}/upload", files=files)
+                                r_up = requests.post(f"{API_URL}/upload", files=files, data={"instancia": instancia})
                                 if r_up.status_code == 200:
                                     url_m = r_up.json()["url"]
                                     arq.seek(0)
                                     b64 = base64.b64encode(arq.read()).decode('utf-8')
                                     tipo = "image" if "image" in arq.type else "document"
-                                    requests.post(f"{EVO_URL}/message/sendMedia/{instancia}", 
-                                                  json={"number": cliente['remote_jid'], "media": b64, "mediatype": tipo, "mimetype": arq.type, "fileName": arq.name, "caption": f"*{nome_usuario}:* Arquivo"}, headers=HEADERS_EVO)
-                                    requests.post(f"{API_URL}/chat/salvar_manual", 
-                                                  json={"instancia": instancia, "remote_jid": cliente['remote_jid'], "texto": url_m, "tipo": "imagem" if "image" in arq.type else "documento", "nome_atendente": nome_usuario})
-                                    st.rerun()
+                                    if enviar_no_chat(evolution().send_media, instancia, cliente['remote_jid'], b64, tipo, arq.type, arq.name, f"*{nome_usuario}:* Arquivo"):
+                                        requests.post(f"{API_URL}/chat/salvar_manual", 
+                                                      json={"instancia": instancia, "remote_jid": cliente['remote_jid'], "texto": url_m, "tipo": "imagem" if "image" in arq.type else "documento", "nome_atendente": nome_usuario})
+                                        st.rerun()
                         with tab_mic:
                             audio = st.audio_input("Gravar")
                             if audio and st.button("Enviar 🎤", key="btn_mic_final"):
                                 files = {"file": ("voz.wav", audio, "audio/wav")}
-                                r_up = requests.post(f"{API_URL}/upload", files=files)
+                                r_up = requests.post(f"{API_URL}/upload", files=files, data={"instancia": instancia})
                                 if r_up.status_code == 200:
                                     url_a = r_up.json()["url"]
                                     audio.seek(0)
                                     b64 = base64.b64encode(audio.read()).decode('utf-8')
-                                    requests.post(f"{EVO_URL}/message/sendWhatsAppAudio/{instancia}", 
-                                                  json={"number": cliente['remote_jid'], "audio": b64, "encoding": True}, headers=HEADERS_EVO)
-                                    requests.post(f"{API_URL}/chat/salvar_manual", 
-                                                  json={"instancia": instancia, "remote_jid": cliente['remote_jid'], "texto": url_a, "tipo": "audio", "nome_atendente": nome_usuario})
-                                    st.rerun()
+                                    if enviar_no_chat(evolution().send_audio, instancia, cliente['remote_jid'], b64):
+                                        requests.post(f"{API_URL}/chat/salvar_manual", 
+                                                      json={"instancia": instancia, "remote_jid": cliente['remote_jid'], "texto": url_a, "tipo": "audio", "nome_atendente": nome_usuario})
+                                        st.rerun()
 
                 if prompt := st.chat_input("Mensagem...", key="chat_in_final"):
                     msg_fmt = f"*{nome_usuario}:* {prompt}"
-                    requests.post(f"{EVO_URL}/message/sendText/{instancia}", json={"number": cliente['remote_jid'], "text": msg_fmt}, headers=HEADERS_EVO)
-                    requests.post(f"{API_URL}/chat/salvar_manual", json={"instancia": instancia, "remote_jid": cliente['remote_jid'], "texto": prompt, "nome_atendente": nome_usuario})
-                    time.sleep(0.5)
-                    st.rerun()
+                    if enviar_no_chat(evolution().send_text, instancia, cliente['remote_jid'], msg_fmt):
+                        requests.post(f"{API_URL}/chat/salvar_manual", json={"instancia": instancia, "remote_jid": cliente['remote_jid'], "texto": prompt, "nome_atendente": nome_usuario})
+                        time.sleep(0.5)
+                        st.rerun()
         else:
             with st.container(border=True):
                 st.markdown("### 👋 Bem-vindo")
@@ -1389,7 +1462,7 @@ elif selected == "Meus Gatilhos":
                         with st.spinner("Enviando arquivo..."):
                             files = {"file": (arquivo_enviado.name, arquivo_enviado, arquivo_enviado.type)}
                             try:
-                                res_up = requests.post(f"{API_URL}/upload", files=files)
+                                res_up = requests.post(f"{API_URL}/upload", files=files, data={"instancia": instancia_selecionada})
                                 if res_up.status_code == 200:
                                     url_final = res_up.json()["url"]
                                     if "image" in arquivo_enviado.type: tipo_msg = "image"
@@ -1601,21 +1674,18 @@ elif selected == "Conexão":
             
             with st.spinner("Buscando QR Code..."):
                 try:
-                    res = requests.get(f"{EVO_URL}/instance/connect/{instancia_selecionada}", headers=HEADERS_EVO, timeout=20)
+                    evo = evolution()
+                    res = evo.connect(instancia_selecionada)
                     
                     # AUTO-REPARO SE NÃO EXISTIR
                     if res.status_code == 404:
                         st.warning("Recriando instância...")
-                        try: requests.delete(f"{EVO_URL}/instance/delete/{instancia_selecionada}", headers=HEADERS_EVO); time.sleep(1)
+                        try: evo.delete_instance(instancia_selecionada); time.sleep(1)
                         except: pass
                         
-                        payload_create = {
-                            "instanceName": instancia_selecionada, "token": u.get("senha", "123456"), 
-                            "qrcode": True, "integration": "WHATSAPP-BAILEYS"
-                        }
-                        requests.post(f"{EVO_URL}/instance/create", json=payload_create, headers=HEADERS_EVO)
-                        time.sleep(3)
-                        res = requests.get(f"{EVO_URL}/instance/connect/{instancia_selecionada}", headers=HEADERS_EVO, timeout=20)
+                        evo.create_instance(instancia_selecionada, u.get("senha", "123456"))
+                        evo.aguardar_instancia(instancia_selecionada)
+                        res = evo.connect(instancia_selecionada)
 
                     if res.status_code == 200:
                         data = res.json()
@@ -1631,8 +1701,10 @@ elif selected == "Conexão":
     with col_con2:
         if st.button("🚪 Desconectar (Reset Total)", type="secondary", use_container_width=True):
             with st.spinner("Resetando..."):
-                requests.delete(f"{EVO_URL}/instance/logout/{instancia_selecionada}", headers=HEADERS_EVO)
-                requests.delete(f"{EVO_URL}/instance/delete/{instancia_selecionada}", headers=HEADERS_EVO)
+                try:
+                    evolution().logout(instancia_selecionada)
+                    evolution().delete_instance(instancia_selecionada)
+                except Exception as e: st.error(f"Erro: {e}")
                 st.success("Limpeza concluída. Gere um novo QR Code."); time.sleep(2); st.rerun()
 
     st.divider()
@@ -1644,7 +1716,7 @@ elif selected == "Conexão":
         # 1. Busca onde a Evolution está mandando as mensagens hoje
         webhook_atual = "Desconhecido"
         try:
-            r_find = requests.get(f"{EVO_URL}/webhook/find/{instancia_selecionada}", headers=HEADERS_EVO)
+            r_find = evolution().find_webhook(instancia_selecionada)
             if r_find.status_code == 200:
                 webhook_atual = r_find.json().get("webhook", {}).get("url") or "Não configurado"
             else: webhook_atual = f"Erro API: {r_find.status_code}"
@@ -1663,15 +1735,9 @@ elif selected == "Conexão":
         novo_webhook = st.text_input("Qual o endereço do seu Backend (API)?", value=f"{url_sugerida}/webhook/whatsapp")
         
         if st.button("💾 Salvar Webhook Manualmente"):
-            payload_hook = {
-                "webhook": {
-                    "enabled": True,
-                    "url": novo_webhook,
-                    "events": ["MESSAGES_UPSERT", "MESSAGES_UPDATE", "SEND_MESSAGE", "CONNECTION_UPDATE"]
-                }
-            }
+            eventos = ["MESSAGES_UPSERT", "MESSAGES_UPDATE", "SEND_MESSAGE", "CONNECTION_UPDATE"]
             try:
-                r_set = requests.post(f"{EVO_URL}/webhook/set/{instancia_selecionada}", json=payload_hook, headers=HEADERS_EVO)
+                r_set = evolution().set_webhook(instancia_selecionada, novo_webhook, eventos)
                 # Aceita 200 (OK) ou 201 (Created) como sucesso
                 if r_set.status_code in [200, 201]:
                     st.success(f"✅ Webhook atualizado para: {novo_webhook}")
@@ -1878,6 +1944,7 @@ elif selected == "Gestão de Clientes":
                         r_gatilhos = st.number_input("Máx. Gatilhos (0 = Ilimitado)", value=int(p_regras.get('max_gatilhos', 5)))
                         r_disparos = st.checkbox("Permitir Disparos em Massa?", value=bool(p_regras.get('permite_disparos', False)))
                         r_crm = st.checkbox("Acesso ao CRM?", value=bool(p_regras.get('acesso_crm', True)))
+                        r_midia = st.checkbox("Permitir Mídia nos Gatilhos?", value=bool(p_regras.get('permite_midia', False)))
 
                     with col_l2:
                         st.caption("👥 Equipe e Atendimento")
@@ -1894,6 +1961,7 @@ elif selected == "Gestão de Clientes":
                                 "max_gatilhos": r_gatilhos,
                                 "permite_disparos": r_disparos,
                                 "acesso_crm": r_crm,
+                                "permite_midia": r_midia,
                                 "atendimento_humano": r_humano,
                                 "max_atendentes": r_atendentes,
                                 "max_conexoes": r_conexoes
@@ -1976,6 +2044,7 @@ elif selected == "Gestão de Clientes":
                         c_chk1, c_chk2 = st.columns(2)
                         n_disparos = c_chk1.checkbox("Disparos?", value=False)
                         n_humano = c_chk2.checkbox("Atend. Humano?", value=True)
+                        n_midia = c_chk1.checkbox("Mídia nos Gatilhos?", value=True)
                         
                         if st.form_submit_button("Criar Plano", type="primary"):
                             if n_nome:
@@ -1983,7 +2052,7 @@ elif selected == "Gestão de Clientes":
                                     "nome": n_nome, "valor": n_valor, "descricao": n_desc, "ativo": True,
                                     "limites": {
                                         "max_gatilhos": n_gatilhos, "permite_disparos": n_disparos,
-                                        "acesso_crm": True, "atendimento_humano": n_humano,
+                                        "acesso_crm": True, "atendimento_humano": n_humano, "permite_midia": n_midia,
                                         "max_atendentes": n_atendentes, "max_conexoes": 1
                                     }
                                 }
@@ -2233,10 +2302,14 @@ elif selected == "CRM & Disparos":
                             "instancia": instancia_selecionada, "nome": crm_nome,
                             "telefone": crm_tel, "dia_vencimento": crm_dia, "etiquetas": crm_tags
                         }
-                        requests.post(f"{API_URL}/crm/clientes", json=payload)
-                        st.success("Salvo!")
-                        time.sleep(0.5)
-                        st.rerun()
+                        res = requests.post(f"{API_URL}/crm/clientes", json=payload).json()
+                        if res.get("status") == "duplicado":
+                            st.warning("⚠️ Esse telefone já está cadastrado nesta instância.")
+                        elif res.get("status") == "ok":
+                            st.success("Salvo!")
+                            time.sleep(0.5)
+                            st.rerun()
+                        else: st.error(f"Erro ao salvar: {res.get('detail')}")
                     else: st.warning("Nome e Telefone são obrigatórios.")
 
         st.divider()
@@ -2254,53 +2327,38 @@ elif selected == "CRM & Disparos":
                 arquivo_import = st.file_uploader("Selecione o arquivo", type=["csv", "xlsx"])
                 if arquivo_import:
                     if st.button("Processar Importação"):
+                        # Um envio só: a API normaliza, deduplica e grava em lote (COPY)
                         try:
-                            if arquivo_import.name.endswith('.csv'): df_import = pd.read_csv(arquivo_import)
-                            else: df_import = pd.read_excel(arquivo_import)
-                            df_import.columns = [c.lower() for c in df_import.columns]
-                            col_nome = next((c for c in df_import.columns if 'nom' in c), None)
-                            col_tel = next((c for c in df_import.columns if 'tel' in c or 'cel' in c or 'what' in c), None)
-                            
-                            if col_nome and col_tel:
-                                barra_imp = st.progress(0, text="Importando...")
-                                total = len(df_import)
-                                sucesso = 0
-                                for i, row in df_import.iterrows():
-                                    nome = str(row[col_nome])
-                                    tel_raw = str(row[col_tel])
-                                    tel_clean = "".join([c for c in tel_raw if c.isdigit()])
-                                    if len(tel_clean) < 10: continue 
-                                    if not tel_clean.startswith("55") and len(tel_clean) > 9: tel_clean = "55" + tel_clean
-                                    if "@" not in tel_clean: tel_clean += "@s.whatsapp.net"
-                                    
-                                    payload = {
-                                        "instancia": instancia_selecionada, "nome": nome,
-                                        "telefone": tel_clean, "dia_vencimento": 1, "etiquetas": "importado_excel"
-                                    }
-                                    requests.post(f"{API_URL}/crm/clientes", json=payload)
-                                    sucesso += 1
-                                    barra_imp.progress((i + 1) / total)
-                                st.success(f"✅ Importação finalizada! {sucesso} contatos adicionados.")
+                            with st.spinner("Importando..."):
+                                files = {"arquivo": (arquivo_import.name, arquivo_import, arquivo_import.type)}
+                                r_imp = requests.post(f"{API_URL}/crm/clientes/{instancia_selecionada}/importar", files=files,
+                                                      data={"etiqueta": "importado_excel", "dia_vencimento": 1}, timeout=300)
+                            if r_imp.status_code == 200:
+                                res_imp = r_imp.json()
+                                st.success(f"✅ Importação finalizada! {res_imp['inseridos']} novos, "
+                                           f"{res_imp['atualizados']} atualizados, {res_imp['ignorados']} ignorados.")
                                 time.sleep(2)
                                 st.rerun()
-                            else: st.error("❌ Não encontrei as colunas 'Nome' e 'Telefone'.")
-                        except Exception as e: st.error(f"Erro ao ler arquivo: {e}")
+                            else: st.error(f"❌ {r_imp.json().get('detail', r_imp.text)}")
+                        except Exception as e: st.error(f"Erro ao importar: {e}")
 
         st.divider()
         st.markdown("### 📋 Gerenciamento de Contatos")
-        if "crm_pagina" not in st.session_state: st.session_state.crm_pagina = 1
+        # Paginação por cursor: guardamos o cursor de cada página visitada (p/ voltar)
+        if "crm_cursores" not in st.session_state: st.session_state.crm_cursores = [None]
         if "crm_busca" not in st.session_state: st.session_state.crm_busca = ""
 
         c_filt1, c_filt2, c_filt3 = st.columns([2, 1, 1])
         texto_busca = c_filt1.text_input("🔍 Buscar (Nome ou Tel)", value=st.session_state.crm_busca, placeholder="Enter para buscar...")
         if texto_busca != st.session_state.crm_busca:
             st.session_state.crm_busca = texto_busca
-            st.session_state.crm_pagina = 1
+            st.session_state.crm_cursores = [None]
             st.rerun()
 
         try:
+            pagina_crm = len(st.session_state.crm_cursores)
             params = {
-                "pagina": st.session_state.crm_pagina, "itens_por_pagina": 20,
+                "cursor": st.session_state.crm_cursores[-1], "itens_por_pagina": 20,
                 "busca": st.session_state.crm_busca if st.session_state.crm_busca else None
             }
             res = requests.get(f"{API_URL}/crm/clientes/{instancia_selecionada}", params=params)
@@ -2310,12 +2368,14 @@ elif selected == "CRM & Disparos":
                 lista_clientes = payload['data']
                 total_paginas = payload['total_paginas']
                 total_itens = payload['total']
+                proximo_cursor = payload.get('proximo_cursor')
+                prefixo_total = "~" if payload.get('total_estimado') else ""
                 
                 if lista_clientes:
                     df = pd.DataFrame(lista_clientes)
                     df['telefone_visual'] = df['telefone'].astype(str).str.replace('@s.whatsapp.net', '')
                     df_editor = df[['id', 'nome', 'telefone_visual', 'dia_vencimento', 'etiquetas', 'telefone']]
-                    st.caption(f"Total: {total_itens} clientes | Página {st.session_state.crm_pagina} de {total_paginas}")
+                    st.caption(f"Total: {prefixo_total}{total_itens} clientes | Página {pagina_crm} de {prefixo_total}{max(total_paginas, pagina_crm)}")
                     st.info("💡 Clique duas vezes na célula para editar Nome, Dia ou Etiquetas.")
 
                     editado = st.data_editor(
@@ -2328,7 +2388,7 @@ elif selected == "CRM & Disparos":
                             "dia_vencimento": st.column_config.NumberColumn("Dia Venc.", min_value=1, max_value=31, format="%d"),
                             "etiquetas": st.column_config.TextColumn("Etiquetas")
                         },
-                        hide_index=True, use_container_width=True, key=f"editor_crm_{st.session_state.crm_pagina}"
+                        hide_index=True, use_container_width=True, key=f"editor_crm_{pagina_crm}"
                     )
 
                     if st.button("💾 Salvar Alterações da Tabela"):
@@ -2347,11 +2407,11 @@ elif selected == "CRM & Disparos":
                         st.rerun()
 
                     c_ant, c_pag, c_prox = st.columns([1, 2, 1])
-                    if c_ant.button("⬅️ Anterior", disabled=(st.session_state.crm_pagina <= 1)):
-                        st.session_state.crm_pagina -= 1
+                    if c_ant.button("⬅️ Anterior", disabled=(pagina_crm <= 1)):
+                        st.session_state.crm_cursores.pop()
                         st.rerun()
-                    if c_prox.button("Próxima ➡️", disabled=(st.session_state.crm_pagina >= total_paginas)):
-                        st.session_state.crm_pagina += 1
+                    if c_prox.button("Próxima ➡️", disabled=(not proximo_cursor)):
+                        st.session_state.crm_cursores.append(proximo_cursor)
                         st.rerun()
                         
                     st.divider()
@@ -2368,6 +2428,38 @@ elif selected == "CRM & Disparos":
     # ==========================================================
     # ABA 3: DISPAROS (COM TRAVA DE SEGURANÇA 🔒)
     # ==========================================================
+    # --- PAINEL DE CAMPANHAS (atualiza sozinho enquanto houver envio rodando) ---
+    @st.fragment(run_every=5)
+    def painel_campanhas(instancia):
+        st.markdown("### 📈 Campanhas")
+        try:
+            r = requests.get(f"{API_URL}/disparo/campanhas", params={"instancia": instancia, "limite": 5}, timeout=5)
+            campanhas = r.json() if r.status_code == 200 else []
+        except: campanhas = []
+
+        if not campanhas:
+            st.caption("Nenhuma campanha enviada ainda.")
+            return
+
+        icones = {"ativa": "🟢", "pausada": "⏸️", "cancelada": "⛔", "concluida": "✅"}
+        for camp in campanhas:
+            with st.container(border=True):
+                c_info, c_btn = st.columns([3, 1])
+                with c_info:
+                    st.markdown(f"{icones.get(camp['status'], '•')} **Campanha #{camp['id']}** — {camp['status']}")
+                    st.progress(min(1.0, camp['percentual'] / 100))
+                    eta = f" | ⏳ ~{camp['eta_segundos'] // 60}min {camp['eta_segundos'] % 60}s" if camp.get('eta_segundos') is not None else ""
+                    st.caption(f"Enviados: {camp['enviados']} | Falhas: {camp['falhas']} | Restantes: {camp['restantes']} de {camp['total']}{eta}")
+                with c_btn:
+                    acoes = []
+                    if camp['status'] == "ativa": acoes = [("⏸️ Pausar", "pausar"), ("⛔ Cancelar", "cancelar")]
+                    elif camp['status'] == "pausada": acoes = [("▶️ Retomar", "retomar"), ("⛔ Cancelar", "cancelar")]
+                    for rotulo, acao in acoes:
+                        if st.button(rotulo, key=f"camp_{acao}_{camp['id']}", use_container_width=True):
+                            try: requests.post(f"{API_URL}/disparo/campanhas/{camp['id']}/{acao}", timeout=5)
+                            except: st.error("Erro ao atualizar campanha.")
+                            st.rerun(scope="fragment")
+
     with tab_disparo:
         plano_atual = st.session_state.user_info.get('plano', 'Básico')
         
@@ -2484,7 +2576,7 @@ elif selected == "CRM & Disparos":
                             with st.spinner("Subindo arquivo..."):
                                 files = {"file": (arquivo_disparo.name, arquivo_disparo, arquivo_disparo.type)}
                                 try:
-                                    res_up = requests.post(f"{API_URL}/upload", files=files)
+                                    res_up = requests.post(f"{API_URL}/upload", files=files, data={"instancia": instancia_selecionada})
                                     if res_up.status_code == 200:
                                         url_final = res_up.json()["url"]
                                         if arquivo_disparo.type.startswith("image"): tipo_msg = "image"
@@ -2501,20 +2593,22 @@ elif selected == "CRM & Disparos":
                             "url_midia": url_final, "tipo_midia": tipo_msg
                         }
                         
-                        with st.spinner(f"Enviando para {len(ids)} contatos..."):
-                            try:
-                                r_disp = requests.post(f"{API_URL}/disparo/em-massa", json=payload_mass)
-                                if r_disp.status_code == 200:
-                                    d = r_disp.json()
-                                    st.balloons()
-                                    st.success(f"✅ Concluído! Enviados: {d['enviados']} | Erros: {d['erros']}")
-                                    st.session_state.confirmacao_disparo = False # Reseta a trava
-                                    time.sleep(3)
-                                    st.rerun()
-                                else: 
-                                    st.error("Erro no envio.")
-                            except Exception as e: 
-                                st.error(f"Erro: {e}")
+                        # O servidor só agenda a campanha; o progresso aparece no painel abaixo
+                        try:
+                            r_disp = requests.post(f"{API_URL}/disparo/em-massa", json=payload_mass)
+                            if r_disp.status_code == 200:
+                                d = r_disp.json()
+                                st.success(f"✅ Campanha #{d.get('campanha_id')} agendada para {d.get('total', 0)} contatos!")
+                                st.session_state.confirmacao_disparo = False # Reseta a trava
+                                time.sleep(1)
+                                st.rerun()
+                            else: 
+                                st.error("Erro ao agendar o disparo.")
+                        except Exception as e: 
+                            st.error(f"Erro: {e}")
+
+            st.divider()
+            painel_campanhas(instancia_selecionada)
         
 elif selected == "Minha Assinatura":
     st.subheader("💳 Detalhes da Assinatura")
@@ -0,0 +1,246 @@
+# ==========================================================
+# 🗄️ ARMAZÉM DE MÍDIA POR CONTEÚDO (SHA-256)
+# ==========================================================
+# O /upload gravava uploads/{nome_do_arquivo}: dois "foto.jpg" diferentes
+# se sobrescreviam e o mesmo arquivo enviado 10 vezes ocupava 10 vezes.
+# Cada campanha ainda relia o arquivo do disco e refazia o base64.
+#
+# Agora:
+#   - o upload é lido em pedaços, com o SHA-256 calculado no caminho, para
+#     um temporário; o arquivo final é uploads/cas/ab/<sha256>.<ext>
+#     (os.replace = atômico). Se o conteúdo já existe, só apaga o temporário;
+#   - a URL depende só do conteúdo -> estável e cacheável;
+#   - cota por instância (soma dos arquivos que ela referencia): cobra só
+#     o conteúdo que a instância ainda não tem, conferido depois do hash e
+#     antes de publicar (o que passa da cota nem chega a uploads/cas);
+#   - base64 + mimetype ficam num cache LRU (limite em bytes) usado por
+#     campanhas e envios de mídia: o mesmo arquivo não é relido/recodificado.
+# ==========================================================
+import os
+import re
+import base64
+import hashlib
+import tempfile
+import threading
+import mimetypes
+from collections import OrderedDict
+
+PASTA_UPLOADS = "uploads"
+PASTA_CAS = os.path.join(PASTA_UPLOADS, "cas")
+PREFIXO_URL = "/arquivos"                      # app.mount("/arquivos", StaticFiles(directory="uploads"))
+ARMAZEM_CHUNK = 1024 * 1024
+ARMAZEM_COTA_MB = int(os.getenv("ARMAZEM_COTA_MB", 1024))          # por instância (0 = sem limite)
+ARMAZEM_CACHE_MB = int(os.getenv("ARMAZEM_CACHE_MB", 128))         # base64 em memória (por worker)
+CHAVE_COTA = 728410            # advisory lock (por instância) da conferência da cota
+
+DDL_ARMAZEM = """
+    CREATE TABLE IF NOT EXISTS midias (
+        sha256 CHAR(64) PRIMARY KEY,
+        extensao VARCHAR(10) NOT NULL,
+        mimetype VARCHAR(100) NOT NULL,
+        tamanho BIGINT NOT NULL,
+        criado_em TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+
+    -- Quem usa cada arquivo (a cota de uma instância é a soma dos seus)
+    CREATE TABLE IF NOT EXISTS midias_instancia (
+        instancia VARCHAR(100) NOT NULL,
+        sha256 CHAR(64) NOT NULL REFERENCES midias(sha256),
+        nome_original TEXT,
+        criado_em TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (instancia, sha256)
+    );
+"""
+
+_RE_CAS = re.compile(r"/cas/[0-9a-f]{2}/([0-9a-f]{64})(\.[A-Za-z0-9]{1,10})?$")
+
+
+class CotaExcedida(Exception):
+    pass
+
+
+def extensao_de(nome, mimetype=None):
+    ext = os.path.splitext(nome or "")[1].lower()
+    if not re.fullmatch(r"\.[a-z0-9]{1,10}", ext):
+        ext = mimetypes.guess_extension(mimetype or "") or ".bin"
+    return ext
+
+
+def caminho_cas(sha256, extensao):
+    return os.path.join(PASTA_CAS, sha256[:2], f"{sha256}{extensao}")
+
+
+def url_cas(sha256, extensao, dominio=""):
+    return f"{dominio}{PREFIXO_URL}/cas/{sha256[:2]}/{sha256}{extensao}"
+
+
+# ==========================================================
+# GRAVAÇÃO (síncrona: chamar via asyncio.to_thread nas rotas async)
+# ==========================================================
+def gravar_fluxo(origem, nome, limite_bytes=None, publicar=True):
+    """
+    Lê `origem` (arquivo binário) em pedaços calculando o SHA-256.
+    Devolve (sha256, extensao, tamanho, caminho). Passou de limite_bytes -> CotaExcedida.
+    publicar=False: caminho é o temporário (quem chamou publica ou apaga).
+    """
+    os.makedirs(PASTA_CAS, exist_ok=True)
+    fd, temporario = tempfile.mkstemp(prefix=".up_", suffix=".part", dir=PASTA_CAS)
+    h = hashlib.sha256()
+    tamanho = 0
+    try:
+        with os.fdopen(fd, "wb") as saida:
+            while True:
+                pedaco = origem.read(ARMAZEM_CHUNK)
+                if not pedaco: break
+                tamanho += len(pedaco)
+                if limite_bytes is not None and tamanho > limite_bytes:
+                    raise CotaExcedida("Arquivo maior que o espaço livre da instância.")
+                h.update(pedaco)
+                saida.write(pedaco)
+        sha256 = h.hexdigest()
+        extensao = extensao_de(nome)
+        if not publicar:
+            return sha256, extensao, tamanho, temporario
+        return sha256, extensao, tamanho, publicar_temporario(temporario, sha256, extensao)
+    except BaseException:
+        try: os.remove(temporario)
+        except OSError: pass
+        raise
+
+
+def publicar_temporario(temporario, sha256, extensao):
+    """Move um temporário (já com hash conhecido) para o lugar definitivo. Duplicado: descarta."""
+    destino = caminho_cas(sha256, extensao)
+    if os.path.exists(destino):
+        os.remove(temporario)
+    else:
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        os.replace(temporario, destino)
+    return destino
+
+
+# ==========================================================
+# BANCO (asyncpg)
+# ==========================================================
+def cota_bytes():
+    """Cota de cada instância em bytes (None = sem limite)."""
+    return ARMAZEM_COTA_MB * 1024 * 1024 if ARMAZEM_COTA_MB else None
+
+
+async def registrar_midia(pool, instancia, sha256, extensao, tamanho, nome_original, cobrar_cota=False):
+    """
+    Grava os metadados; devolve False se a instância já tinha esse conteúdo
+    (não conta na cota de novo). cobrar_cota: conteúdo novo para a instância
+    que não cabe no espaço livre -> CotaExcedida (nada é gravado). A conferência
+    é serializada por instância: dois uploads simultâneos não passam os dois.
+    """
+    mimetype = mimetypes.types_map.get(extensao, "application/octet-stream")
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            if cobrar_cota and instancia is not None and ARMAZEM_COTA_MB:
+                await conn.execute("SELECT pg_advisory_xact_lock($1, hashtext($2))", CHAVE_COTA, instancia)
+                if await conn.fetchval("SELECT 1 FROM midias_instancia WHERE instancia = $1 AND sha256 = $2", instancia, sha256):
+                    return False
+                usado = await conn.fetchval("""
+                    SELECT COALESCE(SUM(m.tamanho), 0) FROM midias_instancia i
+                    JOIN midias m ON m.sha256 = i.sha256 WHERE i.instancia = $1
+                """, instancia)
+                if usado + tamanho > cota_bytes():
+                    raise CotaExcedida("Arquivo maior que o espaço livre da instância.")
+            await conn.execute("""
+                INSERT INTO midias (sha256, extensao, mimetype, tamanho) VALUES ($1, $2, $3, $4)
+                ON CONFLICT (sha256) DO NOTHING
+            """, sha256, extensao, mimetype, tamanho)
+            if instancia is None: return True
+            novo = await conn.fetchval("""
+                INSERT INTO midias_instancia (instancia, sha256, nome_original) VALUES ($1, $2, $3)
+                ON CONFLICT (instancia, sha256) DO NOTHING RETURNING TRUE
+            """, instancia, sha256, nome_original)
+            return bool(novo)
+
+
+async def uso_instancia(pool, instancia):
+    linha = await pool.fetchrow("""
+        SELECT COUNT(*) AS arquivos, COALESCE(SUM(m.tamanho), 0) AS bytes FROM midias_instancia i
+        JOIN midias m ON m.sha256 = i.sha256 WHERE i.instancia = $1
+    """, instancia)
+    return {
+        "arquivos": linha['arquivos'],
+        "bytes": linha['bytes'],
+        "cota_bytes": cota_bytes(),
+    }
+
+
+# ==========================================================
+# CACHE DE DERIVADOS (base64 + mimetype), LRU por bytes
+# ==========================================================
+class CacheDerivados:
+    def __init__(self, limite_bytes):
+        self.limite = limite_bytes
+        self._itens = OrderedDict()    # chave -> (b64, mimetype, nome)
+        self._bytes = 0
+        self._trava = threading.Lock()
+        self.acertos = 0
+        self.faltas = 0
+        self.despejos = 0
+
+    def obter(self, chave):
+        with self._trava:
+            item = self._itens.get(chave)
+            if item is None:
+                self.faltas += 1
+                return None
+            self._itens.move_to_end(chave)
+            self.acertos += 1
+            return item
+
+    def guardar(self, chave, item):
+        tamanho = len(item[0])
+        if tamanho > self.limite: return
+        with self._trava:
+            antigo = self._itens.pop(chave, None)
+            if antigo: self._bytes -= len(antigo[0])
+            self._itens[chave] = item
+            self._bytes += tamanho
+            while self._bytes > self.limite:
+                _, (b64, _, _) = self._itens.popitem(last=False)
+                self._bytes -= len(b64)
+                self.despejos += 1
+
+    def estatisticas(self):
+        with self._trava:
+            return {"itens": len(self._itens), "bytes": self._bytes, "limite_bytes": self.limite,
+                    "acertos": self.acertos, "faltas": self.faltas, "despejos": self.despejos}
+
+
+cache_derivados = CacheDerivados(ARMAZEM_CACHE_MB * 1024 * 1024)
+
+
+def caminho_local_da_url(url):
+    """URL do armazém (ou legado /arquivos/nome, /uploads/nome) -> (chave do cache, caminho)."""
+    if not url: return None, None
+    m = _RE_CAS.search(url)
+    if m:
+        sha256, extensao = m.group(1), m.group(2) or ""
+        return sha256, caminho_cas(sha256, extensao)
+    # Arquivos antigos (antes do armazém): chave inclui mtime para não servir versão sobrescrita
+    caminho = os.path.join(PASTA_UPLOADS, os.path.basename(url.split("?")[0]))
+    try: return f"{caminho}@{os.path.getmtime(caminho)}", caminho
+    except OSError: return None, caminho
+
+
+def midia_base64(url):
+    """(base64, mimetype, nome_arquivo) para enviar pela Evolution, ou None se o arquivo não existe."""
+    chave, caminho = caminho_local_da_url(url)
+    if chave is None: return None
+    item = cache_derivados.obter(chave)
+    if item is not None: return item
+    try:
+        with open(caminho, "rb") as f:
+            b64 = base64.b64encode(f.read()).decode('utf-8')
+    except OSError:
+        return None
+    nome = os.path.basename(caminho)
+    item = (b64, mimetypes.guess_type(nome)[0] or "application/octet-stream", nome)
+    cache_derivados.guardar(chave, item)
+    return item
@@ -0,0 +1,481 @@
+# ==========================================================
+# 🏊 POOL DE CONEXÕES POSTGRESQL (psycopg2)
+# ==========================================================
+# Cada worker do uvicorn tem o SEU pool (limitado por DB_POOL_MAX),
+# então o total no Postgres fica em: workers x DB_POOL_MAX.
+#
+# Uso nas rotas:
+#     conn = get_connection()      # pega do pool
+#     ...
+#     conn.close()                 # DEVOLVE para o pool (não fecha o socket)
+#
+# Ou com context manager (commit/rollback automático + devolução):
+#     with conexao() as conn:
+#         cur = conn.cursor()
+#         ...
+# ==========================================================
+import os
+import time
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+
+import asyncpg
+import psycopg2
+import psycopg2.extras
+import psycopg2.extensions
+from dotenv import load_dotenv
+
+from telemetria import contar_consulta
+from logs import obter_logger
+
+load_dotenv(dotenv_path=Path(__file__).resolve().parent / '.env')
+
+log = obter_logger("banco")
+
+# --- CONFIGURAÇÕES DO BANCO DE DADOS (Via .env) ---
+DB_USER = os.getenv("DB_USER")
+DB_PASS = os.getenv("DB_PASS")
+DB_HOST = os.getenv("DB_HOST")
+DB_NAME = os.getenv("DB_NAME")
+DB_PORT = os.getenv("DB_PORT")
+
+# --- CONFIGURAÇÕES DO POOL ---
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 2))                        # Conexões abertas já no boot
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))                       # Teto por worker
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))             # Espera máx. por uma conexão livre (s)
+DB_POOL_CHECAGEM = float(os.getenv("DB_POOL_CHECAGEM", 30))           # Ociosa há mais que isso -> SELECT 1 antes de usar (s)
+DB_POOL_VIDA_MAX = float(os.getenv("DB_POOL_VIDA_MAX", 1800))         # Recicla conexões velhas (s)
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", 10))
+
+DSN = f"host={DB_HOST} port={DB_PORT} dbname={DB_NAME} user={DB_USER} password={DB_PASS} connect_timeout={DB_CONNECT_TIMEOUT}"
+
+
+class PoolEsgotado(Exception):
+    """Nenhuma conexão livre dentro de DB_POOL_TIMEOUT."""
+
+
+# Conexões pegas durante a requisição atual (o middleware devolve as esquecidas)
+_conexoes_requisicao = contextvars.ContextVar("conexoes_requisicao", default=None)
+
+
+# Cursores que contam consultas/tempo da requisição (telemetria.py)
+class _MedirConsultas:
+    def execute(self, *args, **kwargs):
+        inicio = time.perf_counter()
+        try: return super().execute(*args, **kwargs)
+        finally: contar_consulta(time.perf_counter() - inicio)
+
+    def executemany(self, *args, **kwargs):
+        inicio = time.perf_counter()
+        try: return super().executemany(*args, **kwargs)
+        finally: contar_consulta(time.perf_counter() - inicio)
+
+    def copy_expert(self, *args, **kwargs):
+        inicio = time.perf_counter()
+        try: return super().copy_expert(*args, **kwargs)
+        finally: contar_consulta(time.perf_counter() - inicio)
+
+
+class CursorMedido(_MedirConsultas, psycopg2.extensions.cursor): pass
+class RealDictCursorMedido(_MedirConsultas, psycopg2.extras.RealDictCursor): pass
+class DictCursorMedido(_MedirConsultas, psycopg2.extras.DictCursor): pass
+
+_CURSORES_MEDIDOS = {
+    None: CursorMedido,
+    psycopg2.extensions.cursor: CursorMedido,
+    psycopg2.extras.RealDictCursor: RealDictCursorMedido,
+    psycopg2.extras.DictCursor: DictCursorMedido,
+}
+
+
+class ConexaoPool:
+    """
+    Embrulha a conexão psycopg2 real. Tudo (cursor, commit, rollback...)
+    é repassado para ela; só o close() muda: devolve para o pool.
+    """
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+        self._devolvida = False
+
+    def __getattr__(self, nome):
+        return getattr(self._raw, nome)
+
+    def cursor(self, *args, cursor_factory=None, **kwargs):
+        return self._raw.cursor(*args, cursor_factory=_CURSORES_MEDIDOS.get(cursor_factory, cursor_factory), **kwargs)
+
+    @property
+    def closed(self):
+        return self._devolvida or self._raw.closed
+
+    # Atributo gravável: precisa chegar na conexão real
+    @property
+    def autocommit(self):
+        return self._raw.autocommit
+
+    @autocommit.setter
+    def autocommit(self, valor):
+        self._raw.autocommit = valor
+
+    def close(self):
+        if self._devolvida: return
+        self._devolvida = True
+        self._pool.liberar(self._raw)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo_erro, erro, tb):
+        try:
+            if not self._raw.closed:
+                if tipo_erro is None: self._raw.commit()
+                else: self._raw.rollback()
+        finally:
+            self.close()
+        return False
+
+
+class PoolConexoes:
+    def __init__(self, dsn, minimo=DB_POOL_MIN, maximo=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT,
+                 checagem=DB_POOL_CHECAGEM, vida_max=DB_POOL_VIDA_MAX):
+        self.dsn = dsn
+        self.minimo = max(0, min(minimo, maximo))
+        self.maximo = max(1, maximo)
+        self.timeout = timeout
+        self.checagem = checagem
+        self.vida_max = vida_max
+
+        self._cond = threading.Condition()
+        self._ociosas = deque()      # (conn, ociosa_desde)
+        self._criada_em = {}         # id(conn) -> timestamp de criação
+        self._em_uso = 0
+        self._aguardando = 0
+        self._fechado = False
+
+        # Estatísticas
+        self._aquisicoes = 0
+        self._espera_total = 0.0
+        self._espera_max = 0.0
+        self._timeouts = 0
+        self._criadas = 0
+        self._descartadas = 0
+        self._falhas_checagem = 0
+
+        for _ in range(self.minimo):
+            try:
+                conn = self._nova_conexao()
+                self._ociosas.append((conn, time.monotonic()))
+            except Exception as e:
+                log.warning("Pool: não consegui pré-abrir conexão: %s", e)
+                break
+
+    # --- INTERNOS ---
+    def _nova_conexao(self):
+        conn = psycopg2.connect(self.dsn)
+        conn.set_client_encoding('UTF8')
+        self._criada_em[id(conn)] = time.monotonic()
+        self._criadas += 1
+        return conn
+
+    def _descartar(self, conn):
+        self._criada_em.pop(id(conn), None)
+        self._descartadas += 1
+        try: conn.close()
+        except Exception: pass
+
+    def _total(self):
+        return self._em_uso + len(self._ociosas)
+
+    def _saudavel(self, conn, ociosa_desde):
+        if conn.closed: return False
+        if time.monotonic() - self._criada_em.get(id(conn), 0) > self.vida_max: return False
+        if time.monotonic() - ociosa_desde < self.checagem: return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            self._falhas_checagem += 1
+            return False
+
+    # --- API ---
+    def adquirir(self):
+        inicio = time.monotonic()
+        limite = inicio + self.timeout
+
+        with self._cond:
+            if self._fechado: raise PoolEsgotado("Pool encerrado.")
+            self._aguardando += 1
+            try:
+                while True:
+                    if self._ociosas:
+                        conn, ociosa_desde = self._ociosas.pop()
+                        self._em_uso += 1
+                        break
+                    if self._total() < self.maximo:
+                        self._em_uso += 1
+                        conn = None
+                        break
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        self._timeouts += 1
+                        raise PoolEsgotado(f"Sem conexão livre em {self.timeout}s (máx {self.maximo}).")
+                    self._cond.wait(restante)
+            finally:
+                self._aguardando -= 1
+
+        # Checagem / abertura fora do lock (é I/O)
+        try:
+            if conn is not None and not self._saudavel(conn, ociosa_desde):
+                self._descartar(conn)
+                conn = None
+            if conn is None:
+                conn = self._nova_conexao()
+        except Exception:
+            with self._cond:
+                self._em_uso -= 1
+                self._cond.notify()
+            raise
+
+        espera = time.monotonic() - inicio
+        with self._cond:
+            self._aquisicoes += 1
+            self._espera_total += espera
+            self._espera_max = max(self._espera_max, espera)
+
+        wrapper = ConexaoPool(self, conn)
+        pendentes = _conexoes_requisicao.get()
+        if pendentes is not None: pendentes.append(wrapper)
+        return wrapper
+
+    def liberar(self, conn):
+        reutilizar = not conn.closed and not self._fechado
+        if reutilizar:
+            try:
+                # Nunca devolve conexão com transação aberta/quebrada para o pool
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit: conn.autocommit = False
+            except Exception:
+                reutilizar = False
+
+        with self._cond:
+            self._em_uso -= 1
+            if reutilizar:
+                self._ociosas.append((conn, time.monotonic()))
+            self._cond.notify()
+
+        if not reutilizar:
+            self._descartar(conn)
+
+    @contextmanager
+    def conexao(self):
+        with self.adquirir() as conn:
+            yield conn
+
+    def estatisticas(self):
+        with self._cond:
+            return {
+                "pid": os.getpid(),
+                "minimo": self.minimo,
+                "maximo": self.maximo,
+                "em_uso": self._em_uso,
+                "ociosas": len(self._ociosas),
+                "aguardando": self._aguardando,
+                "aquisicoes": self._aquisicoes,
+                "espera_media_ms": round((self._espera_total / self._aquisicoes) * 1000, 2) if self._aquisicoes else 0.0,
+                "espera_max_ms": round(self._espera_max * 1000, 2),
+                "timeouts": self._timeouts,
+                "criadas": self._criadas,
+                "descartadas": self._descartadas,
+                "falhas_checagem": self._falhas_checagem,
+            }
+
+    def fechar(self):
+        with self._cond:
+            self._fechado = True
+            ociosas = list(self._ociosas)
+            self._ociosas.clear()
+            self._cond.notify_all()
+        for conn, _ in ociosas:
+            self._descartar(conn)
+
+
+# ==========================================================
+# POOL GLOBAL (UM POR PROCESSO)
+# ==========================================================
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def obter_pool():
+    # Recria se o processo foi "forkado" (conexões não podem ser compartilhadas entre processos)
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = PoolConexoes(DSN)
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def get_connection():
+    try:
+        return obter_pool().adquirir()
+    except Exception as e:
+        log.error("Erro na conexão: %s", e)
+        raise e
+
+
+@contextmanager
+def conexao():
+    with obter_pool().conexao() as conn:
+        yield conn
+
+
+def estatisticas_pool():
+    return obter_pool().estatisticas()
+
+
+def fechar_pool():
+    global _pool
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.fechar()
+    _pool = None
+
+
+# ==========================================================
+# ESCOPO DE REQUISIÇÃO (REDE DE SEGURANÇA CONTRA VAZAMENTO)
+# ==========================================================
+# Várias rotas antigas fazem "raise" antes do conn.close(). Sem pool isso
+# só vazava um socket; com pool, esgotaria o pool. O middleware abre um
+# escopo e, no fim da requisição, devolve o que ficou para trás.
+def abrir_escopo_requisicao():
+    return _conexoes_requisicao.set([])
+
+
+def fechar_escopo_requisicao(token):
+    pendentes = _conexoes_requisicao.get() or []
+    _conexoes_requisicao.reset(token)
+    for conn in pendentes:
+        if not conn._devolvida:
+            conn.close()
+
+
+# ==========================================================
+# ⚡ POOL ASSÍNCRONO (asyncpg) - CAMINHO DO WEBHOOK
+# ==========================================================
+# O psycopg2 bloqueia o event loop; dentro de "async def" usamos asyncpg.
+# Atenção: asyncpg usa $1, $2... no lugar de %s.
+
+DB_POOL_ASYNC_MIN = int(os.getenv("DB_POOL_ASYNC_MIN", 2))
+DB_POOL_ASYNC_MAX = int(os.getenv("DB_POOL_ASYNC_MAX", 20))
+DB_COMANDO_TIMEOUT = float(os.getenv("DB_COMANDO_TIMEOUT", 15))
+
+_pool_async = None
+
+
+def _registrar_consulta_async(consulta):
+    contar_consulta(consulta.elapsed)
+
+
+async def _preparar_conexao_async(conn):
+    # asyncpg >= 0.29: o logger roda no contexto da requisição que fez a consulta
+    if hasattr(conn, "add_query_logger"):
+        conn.add_query_logger(_registrar_consulta_async)
+
+
+async def iniciar_pool_async():
+    global _pool_async
+    if _pool_async is None:
+        _pool_async = await asyncpg.create_pool(
+            host=DB_HOST,
+            port=int(DB_PORT or 5432),
+            database=DB_NAME,
+            user=DB_USER,
+            password=DB_PASS,
+            min_size=min(DB_POOL_ASYNC_MIN, DB_POOL_ASYNC_MAX),
+            max_size=DB_POOL_ASYNC_MAX,
+            timeout=DB_CONNECT_TIMEOUT,
+            command_timeout=DB_COMANDO_TIMEOUT,
+            max_inactive_connection_lifetime=DB_POOL_VIDA_MAX,
+            init=_preparar_conexao_async,
+        )
+    return _pool_async
+
+
+def pool_async():
+    if _pool_async is None:
+        raise RuntimeError("Pool assíncrono não iniciado (iniciar_pool_async no startup).")
+    return _pool_async
+
+
+async def fechar_pool_async():
+    global _pool_async
+    if _pool_async is not None:
+        await _pool_async.close()
+        _pool_async = None
+
+
+def estatisticas_pool_async():
+    if _pool_async is None: return {"iniciado": False}
+    return {
+        "iniciado": True,
+        "tamanho": _pool_async.get_size(),
+        "ociosas": _pool_async.get_idle_size(),
+        "maximo": _pool_async.get_max_size(),
+    }
+
+
+# ==========================================================
+# 🔧 ÍNDICES CRIADOS PELA APLICAÇÃO (asyncpg)
+# ==========================================================
+# CREATE INDEX CONCURRENTLY não trava escritas, mas não roda dentro de
+# transação e, se for interrompido, deixa o índice INVALID: conferimos
+# pg_index.indisvalid e recriamos. Só um worker por chave faz o build.
+
+DB_INDICE_TIMEOUT = float(os.getenv("DB_INDICE_TIMEOUT", 3600))   # build em tabela grande
+
+
+async def garantir_indices(pool, indices, chave_lock, timeout=DB_INDICE_TIMEOUT):
+    """
+    indices: lista de (nome, "ON tabela (...)") — ou "UNIQUE ON tabela (...)".
+    Devolve {nome: "ok" | "erro: ..."} ou None se outro worker já está cuidando.
+    """
+    situacao = {}
+    async with pool.acquire() as conn:
+        if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", chave_lock):
+            return None
+        try:
+            for nome, definicao in indices:
+                try:
+                    valido = await conn.fetchval("""
+                        SELECT i.indisvalid FROM pg_index i
+                        JOIN pg_class c ON c.oid = i.indexrelid
+                        WHERE c.relname = $1
+                    """, nome)
+                    if valido is False:
+                        log.info("Índice inválido, recriando", extra={"indice": nome})
+                        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {nome}")
+                    if valido is not True:
+                        log.info("Criando índice", extra={"indice": nome})
+                        unico, alvo = ("UNIQUE ", definicao[7:]) if definicao.startswith("UNIQUE ") else ("", definicao)
+                        await conn.execute(f"CREATE {unico}INDEX CONCURRENTLY IF NOT EXISTS {nome} {alvo}", timeout=timeout)
+                    situacao[nome] = "ok"
+                except Exception as e:
+                    situacao[nome] = f"erro: {e}"
+                    log.warning("Falha no índice: %s", e, extra={"indice": nome})
+                    # UNIQUE que falhou (ex.: duplicados) fica inválido mas continua barrando INSERTs: remove
+                    if definicao.startswith("UNIQUE "):
+                        try: await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {nome}")
+                        except Exception: pass
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", chave_lock)
+    return situacao
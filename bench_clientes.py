@@ -0,0 +1,146 @@
+# ==========================================================
+# ⏱️ BENCHMARK: LISTAGEM / BUSCA DO CRM (clientes_finais)
+# ==========================================================
+# Semeia uma instância de teste com N contatos (padrão 1.000.000, gerados
+# no próprio Postgres com generate_series) e compara:
+#   ANTES  -> COUNT(*) + ORDER BY id DESC LIMIT/OFFSET, ILIKE sem trigramas
+#   DEPOIS -> cursor (id < x), total em cache/estimado, ILIKE com GIN pg_trgm
+#
+# Uso (usa as mesmas variáveis DB_* da API):
+#   python bench_clientes.py                      # semeia (se precisar) e mede
+#   python bench_clientes.py --linhas 200000 --resemear
+#   python bench_clientes.py --limpar             # apaga a instância de teste
+#
+# O "ANTES" da busca roda numa transação que apaga os índices de trigramas
+# e dá ROLLBACK no final (DDL no Postgres é transacional), então nada muda
+# de verdade — mas a tabela fica travada durante a medição. Use num banco
+# de teste.
+# ==========================================================
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import psycopg2.extras
+
+from banco import get_connection, iniciar_pool_async, pool_async, fechar_pool_async
+from crm import garantir_indices_crm, listar_clientes, INDICES_CRM
+
+INSTANCIA_BENCH = "bench_crm"
+ITENS_POR_PAGINA = 20
+
+
+def semear(cur, linhas):
+    print(f"🌱 Semeando {linhas} contatos em '{INSTANCIA_BENCH}'...")
+    t0 = time.perf_counter()
+    cur.execute("DELETE FROM clientes_finais WHERE instancia = %s", (INSTANCIA_BENCH,))
+    cur.execute("""
+        INSERT INTO clientes_finais (instancia, nome, telefone, dia_vencimento, etiquetas)
+        SELECT %s,
+               (ARRAY['Ana','Bruno','Carla','Diego','Elisa','Fábio','Gabriela','Hugo','Isabel','João'])[1 + g %% 10]
+                   || ' ' || (ARRAY['Silva','Souza','Costa','Oliveira','Pereira','Lima','Gomes','Ribeiro'])[1 + (g / 10) %% 8]
+                   || ' ' || g,
+               '55' || (11 + g %% 89)::text || lpad((900000000 + g)::text, 9, '0') || '@s.whatsapp.net',
+               1 + g %% 28,
+               CASE WHEN g %% 7 = 0 THEN 'devedor' WHEN g %% 5 = 0 THEN 'vip' ELSE NULL END
+        FROM generate_series(1, %s) AS g
+    """, (INSTANCIA_BENCH, linhas))
+    cur.execute("ANALYZE clientes_finais")
+    print(f"   ok em {time.perf_counter() - t0:.1f}s")
+
+
+def medir(func, repeticoes):
+    tempos = []
+    for _ in range(repeticoes):
+        t0 = time.perf_counter()
+        func()
+        tempos.append((time.perf_counter() - t0) * 1000)
+    return round(statistics.median(tempos), 2)
+
+
+def cursor_da_pagina(cur, pagina):
+    # Último id da página anterior (o que o app teria recebido em proximo_cursor)
+    if pagina <= 1: return None
+    cur.execute("""
+        SELECT id FROM clientes_finais WHERE instancia = %s
+        ORDER BY id DESC LIMIT 1 OFFSET %s
+    """, (INSTANCIA_BENCH, (pagina - 1) * ITENS_POR_PAGINA - 1))
+    linha = cur.fetchone()
+    return linha['id'] if linha else None
+
+
+def listagem_antiga(cur, pagina, busca=None):
+    sql_base = "FROM clientes_finais WHERE instancia = %s"
+    params = [INSTANCIA_BENCH]
+    if busca:
+        sql_base += " AND (nome ILIKE %s OR telefone ILIKE %s)"
+        params.extend([f"%{busca}%", f"%{busca}%"])
+    cur.execute(f"SELECT COUNT(*) {sql_base}", tuple(params))
+    cur.fetchone()
+    cur.execute(f"SELECT * {sql_base} ORDER BY id DESC LIMIT %s OFFSET %s",
+                tuple(params + [ITENS_POR_PAGINA, (pagina - 1) * ITENS_POR_PAGINA]))
+    cur.fetchall()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark da listagem do CRM")
+    ap.add_argument("--linhas", type=int, default=1_000_000)
+    ap.add_argument("--resemear", action="store_true", help="Apaga e semeia de novo a instância de teste")
+    ap.add_argument("--limpar", action="store_true", help="Só apaga a instância de teste e sai")
+    ap.add_argument("--repeticoes", type=int, default=5)
+    ap.add_argument("--paginas", default="1,100,10000,50000")
+    ap.add_argument("--buscas", default="Carla Souza,99912,zzz")
+    args = ap.parse_args()
+
+    conn = get_connection()
+    conn.autocommit = True
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    if args.limpar:
+        cur.execute("DELETE FROM clientes_finais WHERE instancia = %s", (INSTANCIA_BENCH,))
+        print(f"🧹 {cur.rowcount} linhas apagadas.")
+        return
+
+    cur.execute("SELECT COUNT(*) AS n FROM clientes_finais WHERE instancia = %s", (INSTANCIA_BENCH,))
+    if args.resemear or cur.fetchone()['n'] < args.linhas:
+        semear(cur, args.linhas)
+
+    # Mesmo caminho do startup da API
+    async def preparar_indices():
+        await iniciar_pool_async()
+        try: return await garantir_indices_crm(pool_async())
+        finally: await fechar_pool_async()
+    print("🔧 Índices:", json.dumps(asyncio.run(preparar_indices())["indices"], ensure_ascii=False))
+
+    paginas = [int(p) for p in args.paginas.split(",")]
+    buscas = [b for b in args.buscas.split(",") if b]
+    resultado = {"linhas": args.linhas, "itens_por_pagina": ITENS_POR_PAGINA, "paginacao_ms": {}, "busca_ms": {}}
+
+    for pagina in paginas:
+        cursor_id = cursor_da_pagina(cur, pagina)
+        resultado["paginacao_ms"][f"pagina_{pagina}"] = {
+            "antes_offset_count": medir(lambda: listagem_antiga(cur, pagina), args.repeticoes),
+            "depois_cursor": medir(lambda: listar_clientes(cur, INSTANCIA_BENCH, ITENS_POR_PAGINA, cursor=cursor_id), args.repeticoes),
+        }
+
+    # ANTES da busca: sem os índices de trigramas (apagados dentro da transação + ROLLBACK)
+    conn.autocommit = False
+    for nome, definicao in INDICES_CRM:
+        if "gin_trgm_ops" in definicao:
+            cur.execute(f"DROP INDEX IF EXISTS {nome}")
+    for busca in buscas:
+        resultado["busca_ms"][busca] = {"antes_sem_trgm": medir(lambda: listagem_antiga(cur, 1, busca), args.repeticoes)}
+    conn.rollback()
+    conn.autocommit = True
+
+    for busca in buscas:
+        resultado["busca_ms"][busca]["depois_trgm_estimado"] = medir(
+            lambda: listar_clientes(cur, INSTANCIA_BENCH, ITENS_POR_PAGINA, busca=busca), args.repeticoes)
+
+    conn.close()
+    print(json.dumps(resultado, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+# ==========================================================
+# ⏱️ BENCHMARK: THROUGHPUT DO /webhook/whatsapp
+# ==========================================================
+# Sobe uma "Evolution falsa" (responde o sendText com atraso configurável)
+# e dispara N webhooks "messages.upsert" em paralelo contra a API.
+#
+# Como medir ANTES x DEPOIS:
+#   1. Suba a API apontando para a Evolution falsa:
+#        EVO_API_URL=http://127.0.0.1:8089 uvicorn main:app --port 8000
+#   2. Rode:
+#        python bench_webhook.py --instancia minha_instancia --n 500 --concorrencia 100 --atraso 0.5
+#   3. Faça checkout da versão anterior (git checkout <commit> -- main.py),
+#      reinicie a API e rode o mesmo comando.
+#
+# A instância precisa ter o gatilho 'default' cadastrado (a mensagem "oi"
+# dispara a resposta de boas-vindas, que passa pela Evolution).
+# ==========================================================
+import argparse
+import asyncio
+import json
+import statistics
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+
+class EvolutionFalsa(BaseHTTPRequestHandler):
+    atraso = 0.0
+    recebidos = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        tamanho = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(tamanho)
+        time.sleep(self.atraso)
+        with EvolutionFalsa.lock:
+            EvolutionFalsa.recebidos += 1
+        corpo = b'{"status": "PENDING"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def log_message(self, *args):
+        pass
+
+
+def subir_evolution_falsa(porta, atraso):
+    EvolutionFalsa.atraso = atraso
+    servidor = ThreadingHTTPServer(("127.0.0.1", porta), EvolutionFalsa)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+
+def montar_evento(instancia, i):
+    return {
+        "event": "messages.upsert",
+        "instance": instancia,
+        "data": {
+            "key": {"remoteJid": f"55119{i:08d}@s.whatsapp.net", "fromMe": False, "id": uuid.uuid4().hex.upper()},
+            "message": {"conversation": "oi"},
+        },
+    }
+
+
+async def disparar(url, instancia, n, concorrencia):
+    latencias = []
+    erros = 0
+    sem = asyncio.Semaphore(concorrencia)
+
+    async with httpx.AsyncClient(timeout=60, limits=httpx.Limits(max_connections=concorrencia)) as cli:
+        async def um(i):
+            nonlocal erros
+            async with sem:
+                t0 = time.perf_counter()
+                try:
+                    r = await cli.post(f"{url}/webhook/whatsapp", json=montar_evento(instancia, i))
+                    if r.status_code != 200: erros += 1
+                except Exception:
+                    erros += 1
+                latencias.append(time.perf_counter() - t0)
+
+        inicio = time.perf_counter()
+        await asyncio.gather(*(um(i) for i in range(n)))
+        return time.perf_counter() - inicio, latencias, erros
+
+
+def percentil(valores, p):
+    if not valores: return 0.0
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p))]
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark do webhook de mensagens")
+    ap.add_argument("--url", default="http://127.0.0.1:8000")
+    ap.add_argument("--instancia", required=True)
+    ap.add_argument("--n", type=int, default=500)
+    ap.add_argument("--concorrencia", type=int, default=100)
+    ap.add_argument("--atraso", type=float, default=0.5, help="Atraso da Evolution falsa (s)")
+    ap.add_argument("--porta-evo", type=int, default=8089)
+    ap.add_argument("--espera-envios", type=float, default=120, help="Tempo máx. aguardando os envios chegarem na Evolution (s)")
+    args = ap.parse_args()
+
+    servidor = subir_evolution_falsa(args.porta_evo, args.atraso)
+    try:
+        t_inicio = time.perf_counter()
+        duracao, latencias, erros = asyncio.run(disparar(args.url, args.instancia, args.n, args.concorrencia))
+
+        # Fim-a-fim: espera as respostas do bot chegarem na Evolution falsa
+        limite = time.perf_counter() + args.espera_envios
+        while EvolutionFalsa.recebidos < args.n and time.perf_counter() < limite:
+            time.sleep(0.05)
+        duracao_total = time.perf_counter() - t_inicio
+
+        resultado = {
+            "requisicoes": args.n,
+            "concorrencia": args.concorrencia,
+            "atraso_evolution_s": args.atraso,
+            "erros": erros,
+            "webhooks_por_s": round(args.n / duracao, 1),
+            "latencia_p50_ms": round(statistics.median(latencias) * 1000, 1),
+            "latencia_p95_ms": round(percentil(latencias, 0.95) * 1000, 1),
+            "latencia_p99_ms": round(percentil(latencias, 0.99) * 1000, 1),
+            "envios_na_evolution": EvolutionFalsa.recebidos,
+            "respostas_por_s": round(EvolutionFalsa.recebidos / duracao_total, 1) if duracao_total else 0.0,
+        }
+        print(json.dumps(resultado, indent=2, ensure_ascii=False))
+    finally:
+        servidor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+# ==========================================================
+# ⏳ CACHE COM TTL (LIMITADO) + GUARDA ANTI-DUPLICIDADE
+# ==========================================================
+# O /chat/salvar_manual guardava "instancia_jid_texto" num dict global
+# (msg_cache) que nunca era limpo — cresce a cada mensagem manual, com o
+# texto inteiro como chave — e só valia no worker que atendeu.
+#
+# Agora:
+#   - CacheTTL: chave vira resumo (BLAKE2b, 16 bytes), não o texto; teto
+#     de itens (o mais antigo sai); TTL único por cache -> ordem de
+#     inserção = ordem de expiração, então expirar é olhar só o começo
+#     (no máximo CACHE_TTL_VARREDURA itens por operação: custo amortizado,
+#     sem thread de limpeza). Com trava: serve para rotas sync (threadpool).
+#   - GuardaDuplicatas: "é a primeira vez que vejo isso nos últimos N s?".
+#     Primeiro o CacheTTL local (microssegundos). Opcional
+#     (ANTIDUPLICIDADE_BACKEND=postgres): confirma numa tabela UNLOGGED
+#     compartilhada (INSERT ... ON CONFLICT), então a guarda vale entre todos
+#     os workers — ao custo de um commit síncrono por envio, por isso o
+#     padrão é só memória. Banco fora = deixa passar (a guarda nunca
+#     bloqueia um envio legítimo).
+# ==========================================================
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from logs import obter_logger
+
+ANTIDUPLICIDADE_BACKEND = os.getenv("ANTIDUPLICIDADE_BACKEND", "memoria")   # memoria | postgres (entre workers)
+CACHE_TTL_VARREDURA = 8          # expirados removidos por operação
+RESERVAS_LIMPEZA_A_CADA = 500    # a cada N reservas no banco, apaga as vencidas
+
+log = obter_logger("cache_ttl")
+
+# Migração 012. UNLOGGED: é só uma guarda de segundos, não precisa de WAL
+DDL_RESERVAS = """
+    CREATE UNLOGGED TABLE IF NOT EXISTS reservas_ttl (
+        escopo VARCHAR(50) NOT NULL,
+        chave CHAR(32) NOT NULL,
+        expira_em TIMESTAMP NOT NULL,
+        PRIMARY KEY (escopo, chave)
+    );
+    CREATE INDEX IF NOT EXISTS idx_reservas_ttl_expira ON reservas_ttl (expira_em);
+"""
+
+
+def resumo(chave):
+    """Chave (texto ou tupla) -> 16 bytes. Texto longo não fica na memória."""
+    if isinstance(chave, tuple):
+        chave = "\x1f".join(str(p) for p in chave)
+    return hashlib.blake2b(str(chave).encode("utf-8"), digest_size=16).digest()
+
+
+class CacheTTL:
+    def __init__(self, ttl_s, max_itens):
+        self.ttl_s = ttl_s
+        self.max_itens = max_itens
+        self._itens = OrderedDict()    # resumo -> (expira_em, valor)
+        self._trava = threading.Lock()
+
+        # Métricas
+        self.acertos = 0
+        self.faltas = 0
+        self.expirados = 0
+        self.despejos = 0
+
+    def _varrer(self, agora):
+        for _ in range(CACHE_TTL_VARREDURA):
+            if not self._itens: break
+            expira, _ = next(iter(self._itens.values()))
+            if expira > agora: break
+            self._itens.popitem(last=False)
+            self.expirados += 1
+        while len(self._itens) > self.max_itens:
+            self._itens.popitem(last=False)
+            self.despejos += 1
+
+    def _vivo(self, r, agora):
+        item = self._itens.get(r)
+        if item is None: return None
+        if item[0] <= agora:
+            del self._itens[r]
+            self.expirados += 1
+            return None
+        return item
+
+    def obter(self, chave, padrao=None):
+        r = resumo(chave)
+        with self._trava:
+            item = self._vivo(r, time.monotonic())
+            if item is None:
+                self.faltas += 1
+                return padrao
+            self.acertos += 1
+            return item[1]
+
+    def contem(self, chave):
+        return self.obter(chave, self) is not self
+
+    def guardar(self, chave, valor=True):
+        r = resumo(chave)
+        agora = time.monotonic()
+        with self._trava:
+            self._itens.pop(r, None)   # renovar = ir para o fim (mantém a ordem de expiração)
+            self._itens[r] = (agora + self.ttl_s, valor)
+            self._varrer(agora)
+
+    def reservar(self, chave, valor=True):
+        """Guarda só se não existir (ou tiver expirado). True = reservou agora."""
+        r = resumo(chave)
+        agora = time.monotonic()
+        with self._trava:
+            if self._vivo(r, agora) is not None:
+                self.acertos += 1
+                return False
+            self.faltas += 1
+            self._itens[r] = (agora + self.ttl_s, valor)
+            self._varrer(agora)
+            return True
+
+    def remover(self, chave):
+        with self._trava:
+            self._itens.pop(resumo(chave), None)
+
+    def __len__(self):
+        return len(self._itens)
+
+    def estatisticas(self):
+        with self._trava:
+            return {"itens": len(self._itens), "max_itens": self.max_itens, "ttl_s": self.ttl_s,
+                    "acertos": self.acertos, "faltas": self.faltas,
+                    "expirados": self.expirados, "despejos": self.despejos}
+
+
+class GuardaDuplicatas:
+    """
+    primeira_vez(chave) -> True só para a primeira ocorrência dentro de ttl_s
+    (neste worker e, com backend postgres, em todos). Síncrona (psycopg2).
+    """
+
+    def __init__(self, escopo, ttl_s, max_itens=10000, backend=ANTIDUPLICIDADE_BACKEND):
+        self.escopo = escopo
+        self.ttl_s = ttl_s
+        self.backend = backend
+        self.local = CacheTTL(ttl_s, max_itens)
+        self._reservas = 0
+
+        # Métricas
+        self.bloqueadas_local = 0
+        self.bloqueadas_compartilhado = 0
+        self.falhas_banco = 0
+
+    def primeira_vez(self, chave):
+        if not self.local.reservar(chave):
+            self.bloqueadas_local += 1
+            return False
+        if self.backend != "postgres":
+            return True
+        try:
+            nova = self._reservar_banco(resumo(chave).hex())
+        except Exception as e:
+            self.falhas_banco += 1
+            log.warning("Guarda %s: reserva no banco falhou, deixando passar: %s", self.escopo, e)
+            return True
+        if not nova: self.bloqueadas_compartilhado += 1
+        return nova
+
+    def _reservar_banco(self, chave_hex):
+        from banco import conexao
+        self._reservas += 1
+        limpar = self._reservas % RESERVAS_LIMPEZA_A_CADA == 0
+        with conexao() as conn:
+            cur = conn.cursor()
+            # Não existe ou venceu -> é nossa; existe e vale -> outro worker chegou antes
+            cur.execute("""
+                INSERT INTO reservas_ttl (escopo, chave, expira_em)
+                VALUES (%s, %s, NOW() + make_interval(secs => %s))
+                ON CONFLICT (escopo, chave) DO UPDATE SET expira_em = EXCLUDED.expira_em
+                WHERE reservas_ttl.expira_em <= NOW()
+                RETURNING 1
+            """, (self.escopo, chave_hex, float(self.ttl_s)))
+            nova = cur.fetchone() is not None
+            if limpar:
+                cur.execute("DELETE FROM reservas_ttl WHERE expira_em <= NOW()")
+            conn.commit()
+            cur.close()
+        return nova
+
+    def estatisticas(self):
+        return {
+            "escopo": self.escopo,
+            "backend": self.backend,
+            "bloqueadas_local": self.bloqueadas_local,
+            "bloqueadas_compartilhado": self.bloqueadas_compartilhado,
+            "falhas_banco": self.falhas_banco,
+            "cache": self.local.estatisticas(),
+        }
@@ -0,0 +1,334 @@
+# ==========================================================
+# 📧 CAIXA DE SAÍDA DE E-MAIL (OUTBOX + ENVIO EM SEGUNDO PLANO)
+# ==========================================================
+# O /publico/recuperar-senha/solicitar abria uma conexão SMTP, fazia
+# STARTTLS + login e mandava UM e-mail dentro da requisição: servidor de
+# e-mail lento = tela de recuperação pendurada, e N e-mails = N handshakes.
+#
+# Agora:
+#   - a rota só grava o e-mail em emails_saida, na MESMA transação do que
+#     o originou (o token de recuperação e o e-mail entram juntos ou não
+#     entram) + pg_notify para acordar o enviador;
+#   - EnviadorEmails (todo worker roda um; FOR UPDATE SKIP LOCKED divide o
+#     trabalho) pega lotes de EMAIL_LOTE e manda numa sessão SMTP já
+#     autenticada, reaproveitada entre lotes (NOOP antes de usar; fecha
+#     depois de EMAIL_SESSAO_OCIOSA_S parada);
+#   - cada e-mail do lote tem dono (o enviador que o pegou): antes de
+#     mandar, o enviador renova o prazo (travado_ate) SÓ se ainda for o
+#     dono. Servidor lento não faz o lote vencer e sair duas vezes: o que
+#     a manutenção devolveu para a fila não é mais dele e é pulado;
+#   - falha temporária (conexão, login, servidor fora): nova tentativa com
+#     backoff exponencial até EMAIL_MAX_TENTATIVAS. Só a recusa do
+#     DESTINATÁRIO (501/550/551/553 no RCPT) vai direto para 'falha': erro de
+#     configuração do relay não pode queimar a fila inteira.
+# Desenvolvimento: SMTP_TLS=0 e SMTP_USER vazio falam com qualquer SMTP
+# local sem TLS/login (ex.: python -m aiosmtpd -n -l localhost:1025).
+# ==========================================================
+import os
+import time
+import uuid
+import random
+import socket
+import asyncio
+import smtplib
+import threading
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+from telemetria import registrar_saida
+from logs import obter_logger
+
+SMTP_HOST = os.getenv("SMTP_HOST")
+SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
+SMTP_USER = os.getenv("SMTP_USER")
+SMTP_PASS = os.getenv("SMTP_PASS")
+SMTP_FROM_NAME = os.getenv("SMTP_FROM_NAME", "Suporte")
+SMTP_FROM = os.getenv("SMTP_FROM") or SMTP_USER or "nao-responda@localhost"   # remetente (padrão: o login)
+SMTP_TLS = os.getenv("SMTP_TLS", "1") not in ("0", "false", "nao")
+SMTP_TIMEOUT_S = float(os.getenv("SMTP_TIMEOUT_S", 20))
+
+EMAIL_LOTE = int(os.getenv("EMAIL_LOTE", 20))
+EMAIL_MAX_TENTATIVAS = int(os.getenv("EMAIL_MAX_TENTATIVAS", 6))
+EMAIL_LEASE_S = int(os.getenv("EMAIL_LEASE_S", 300))              # 'enviando' há mais que isso volta para a fila
+EMAIL_SESSAO_OCIOSA_S = float(os.getenv("EMAIL_SESSAO_OCIOSA_S", 60))
+EMAIL_RETENCAO_DIAS = int(os.getenv("EMAIL_RETENCAO_DIAS", 7))
+
+CANAL_EMAILS = "emails_saida"
+
+# Recusa do destinatário que não muda com o tempo (caixa inexistente, endereço inválido)
+CODIGOS_DESTINATARIO_INVALIDO = (501, 550, 551, 553)
+
+log = obter_logger("email")
+
+# Migração 013
+DDL_EMAILS = """
+    CREATE TABLE IF NOT EXISTS emails_saida (
+        id BIGSERIAL PRIMARY KEY,
+        destinatario VARCHAR(255) NOT NULL,
+        assunto VARCHAR(255) NOT NULL,
+        corpo_html TEXT NOT NULL,
+        status VARCHAR(15) NOT NULL DEFAULT 'pendente',
+        tentativas INTEGER NOT NULL DEFAULT 0,
+        proxima_tentativa TIMESTAMP NOT NULL DEFAULT NOW(),
+        travado_ate TIMESTAMP,
+        erro TEXT,
+        criado_em TIMESTAMP NOT NULL DEFAULT NOW(),
+        enviado_em TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_emails_saida_pendentes
+        ON emails_saida (proxima_tentativa) WHERE status = 'pendente';
+    CREATE INDEX IF NOT EXISTS idx_emails_saida_status ON emails_saida (status, criado_em);
+"""
+
+# Migração 015: quem pegou o e-mail (o prazo só é renovado/encerrado pelo dono)
+DDL_EMAILS_DONO = """
+    ALTER TABLE emails_saida ADD COLUMN IF NOT EXISTS dono VARCHAR(80);
+"""
+
+_SQL_ENFILEIRAR = """
+    WITH novo AS (
+        INSERT INTO emails_saida (destinatario, assunto, corpo_html) VALUES ({p1}, {p2}, {p3}) RETURNING id
+    )
+    SELECT id, pg_notify('{canal}', id::text) FROM novo
+"""
+SQL_ENFILEIRAR = _SQL_ENFILEIRAR.format(p1="%s", p2="%s", p3="%s", canal=CANAL_EMAILS)
+SQL_ENFILEIRAR_ASYNC = _SQL_ENFILEIRAR.format(p1="$1", p2="$2", p3="$3", canal=CANAL_EMAILS)
+
+
+def enfileirar_email(cur, destinatario, assunto, corpo_html):
+    """Cursor psycopg2, DENTRO da transação da rota: o e-mail só existe se ela der commit."""
+    cur.execute(SQL_ENFILEIRAR, (destinatario, assunto, corpo_html))
+    return cur.fetchone()[0]
+
+
+async def enfileirar_email_async(conn, destinatario, assunto, corpo_html):
+    """conn: conexão ou pool asyncpg."""
+    return await conn.fetchval(SQL_ENFILEIRAR_ASYNC, destinatario, assunto, corpo_html)
+
+
+def calcular_backoff(tentativas):
+    # 30s, 1min, 2min... (máx 1h) com jitter
+    return min(3600, 15 * 2 ** tentativas) * random.uniform(0.8, 1.2)
+
+
+def montar_mensagem(destinatario, assunto, corpo_html):
+    msg = MIMEMultipart()
+    msg['From'] = f"{SMTP_FROM_NAME} <{SMTP_FROM}>"
+    msg['To'] = destinatario
+    msg['Subject'] = assunto
+    msg.attach(MIMEText(corpo_html, 'html'))
+    return msg.as_string()
+
+
+def falha_definitiva(erro):
+    """
+    Só o destinatário recusado (501/550/551/553 no RCPT) é definitivo. 5xx de
+    login (535), de relay/política (530/554) ou de servidor com problema
+    costuma ser configuração ou instabilidade: repete com backoff.
+    """
+    if not isinstance(erro, smtplib.SMTPRecipientsRefused): return False
+    codigos = [codigo for codigo, _ in erro.recipients.values()]
+    return bool(codigos) and all(c in CODIGOS_DESTINATARIO_INVALIDO for c in codigos)
+
+
+# ==========================================================
+# SESSÃO SMTP REAPROVEITADA (bloqueante: usar via asyncio.to_thread)
+# ==========================================================
+class SessaoSMTP:
+    def __init__(self):
+        self._smtp = None
+        self._usada_em = 0.0
+        self._trava = threading.Lock()
+        self.conexoes = 0
+
+    def _abrir(self):
+        smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT_S)
+        if SMTP_TLS: smtp.starttls()
+        if SMTP_USER: smtp.login(SMTP_USER, SMTP_PASS)
+        self.conexoes += 1
+        return smtp
+
+    def _obter(self):
+        if self._smtp is not None:
+            ociosa = time.monotonic() - self._usada_em > EMAIL_SESSAO_OCIOSA_S
+            try:
+                if ociosa or self._smtp.noop()[0] != 250: raise smtplib.SMTPServerDisconnected()
+            except (smtplib.SMTPException, OSError):
+                self._descartar()
+        if self._smtp is None:
+            self._smtp = self._abrir()
+        return self._smtp
+
+    def _descartar(self):
+        if self._smtp is None: return
+        try: self._smtp.quit()
+        except Exception:
+            try: self._smtp.close()
+            except Exception: pass
+        self._smtp = None
+
+    def enviar(self, destinatario, assunto, corpo_html):
+        with self._trava:
+            inicio = time.perf_counter()
+            resultado = "erro"
+            try:
+                self._obter().sendmail(SMTP_FROM, destinatario, montar_mensagem(destinatario, assunto, corpo_html))
+                resultado = "ok"
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+                raise               # recusou ESTA mensagem: a sessão continua boa
+            except OSError:         # (SMTPException é OSError) conexão caiu / sessão em estado ruim
+                self._descartar()   # a próxima mensagem abre uma sessão nova
+                raise
+            finally:
+                self._usada_em = time.monotonic()
+                registrar_saida("smtp", "sendmail", time.perf_counter() - inicio, resultado)
+
+    def fechar(self):
+        with self._trava:
+            self._descartar()
+
+
+# ==========================================================
+# ENVIADOR (todo worker; o banco divide os lotes)
+# ==========================================================
+class EnviadorEmails:
+    def __init__(self, pool, lote=EMAIL_LOTE):
+        self.pool = pool
+        self.lote = lote
+        self.sessao = SessaoSMTP()
+        self.dono = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._acordar = asyncio.Event()
+        self._conn_listen = None
+        self._tarefas = []
+        self._ao_notificar = lambda *_: self._acordar.set()
+
+        # Métricas
+        self.enviados = 0
+        self.repeticoes = 0
+        self.falhas = 0
+        self.perdidos = 0      # prazo venceu e outro enviador pegou: pulado
+
+    async def iniciar(self):
+        # Tabela: migração 013 (migracoes.py)
+        if not SMTP_HOST:
+            log.warning("SMTP_HOST não configurado: e-mails ficam na fila sem enviar")
+        self._conn_listen = await self.pool.acquire()
+        await self._conn_listen.add_listener(CANAL_EMAILS, self._ao_notificar)
+        self._tarefas = [asyncio.create_task(self._loop()), asyncio.create_task(self._loop_manutencao())]
+
+    async def parar(self):
+        for t in self._tarefas: t.cancel()
+        await asyncio.gather(*self._tarefas, return_exceptions=True)
+        self._tarefas = []
+        if self._conn_listen is not None:
+            try: await self._conn_listen.remove_listener(CANAL_EMAILS, self._ao_notificar)
+            except Exception: pass
+            await self.pool.release(self._conn_listen)
+            self._conn_listen = None
+        await asyncio.to_thread(self.sessao.fechar)
+
+    async def _reivindicar(self):
+        return await self.pool.fetch(f"""
+            UPDATE emails_saida e
+            SET status = 'enviando', dono = $2, travado_ate = NOW() + INTERVAL '{EMAIL_LEASE_S} seconds'
+            FROM (
+                SELECT id FROM emails_saida
+                WHERE status = 'pendente' AND proxima_tentativa <= NOW()
+                ORDER BY proxima_tentativa LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            ) escolhidos
+            WHERE e.id = escolhidos.id
+            RETURNING e.id, e.destinatario, e.assunto, e.corpo_html, e.tentativas
+        """, self.lote, self.dono)
+
+    async def _renovar(self, email):
+        """Prazo cheio para ESTE envio, se o e-mail ainda for nosso."""
+        return await self.pool.fetchval(f"""
+            UPDATE emails_saida SET travado_ate = NOW() + INTERVAL '{EMAIL_LEASE_S} seconds'
+            WHERE id = $1 AND dono = $2 AND status = 'enviando'
+            RETURNING id
+        """, email['id'], self.dono) is not None
+
+    async def _enviar(self, email):
+        if not await self._renovar(email):
+            self.perdidos += 1
+            log.warning("E-mail voltou para a fila antes do envio, pulando", extra={"id_email": email['id']})
+            return
+        try:
+            await asyncio.to_thread(self.sessao.enviar, email['destinatario'], email['assunto'], email['corpo_html'])
+        except Exception as e:
+            tentativas = email['tentativas'] + 1
+            erro = f"{type(e).__name__}: {e}"[:500]
+            if falha_definitiva(e) or tentativas >= EMAIL_MAX_TENTATIVAS:
+                self.falhas += 1
+                await self.pool.execute("""
+                    UPDATE emails_saida SET status = 'falha', tentativas = $2, erro = $3, travado_ate = NULL, dono = NULL
+                    WHERE id = $1 AND dono = $4
+                """, email['id'], tentativas, erro, self.dono)
+                log.error("E-mail não enviado: %s", erro, extra={"id_email": email['id'], "tentativas": tentativas})
+            else:
+                self.repeticoes += 1
+                await self.pool.execute("""
+                    UPDATE emails_saida SET status = 'pendente', tentativas = $2, erro = $3, travado_ate = NULL, dono = NULL,
+                        proxima_tentativa = NOW() + make_interval(secs => $4)
+                    WHERE id = $1 AND dono = $5
+                """, email['id'], tentativas, erro, calcular_backoff(tentativas), self.dono)
+                log.warning("E-mail vai tentar de novo: %s", erro, extra={"id_email": email['id'], "tentativas": tentativas})
+            return
+        await self.pool.execute(
+            "UPDATE emails_saida SET status = 'enviado', enviado_em = NOW(), erro = NULL, travado_ate = NULL, dono = NULL WHERE id = $1",
+            email['id'])
+        self.enviados += 1
+
+    async def _loop(self):
+        while True:
+            lote = []
+            try:
+                if SMTP_HOST:
+                    lote = await self._reivindicar()
+                    # Um de cada vez na mesma sessão (SMTP não multiplexa)
+                    for email in lote:
+                        await self._enviar(email)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Enviador de e-mails: %s", e)
+                await asyncio.sleep(5)
+            if len(lote) < self.lote:
+                try:
+                    await asyncio.wait_for(self._acordar.wait(), timeout=30)
+                except asyncio.TimeoutError:
+                    pass
+                self._acordar.clear()
+
+    async def _loop_manutencao(self):
+        while True:
+            await asyncio.sleep(60)
+            try:
+                # Worker que morreu no meio do lote: devolve; limpa os antigos
+                await self.pool.execute(
+                    "UPDATE emails_saida SET status = 'pendente', travado_ate = NULL, dono = NULL WHERE status = 'enviando' AND travado_ate < NOW()")
+                await self.pool.execute(
+                    f"DELETE FROM emails_saida WHERE status = 'enviado' AND enviado_em < NOW() - INTERVAL '{EMAIL_RETENCAO_DIAS} days'")
+                if self.sessao._smtp is not None and time.monotonic() - self.sessao._usada_em > EMAIL_SESSAO_OCIOSA_S:
+                    await asyncio.to_thread(self.sessao.fechar)
+            except Exception as e:
+                log.warning("Manutenção da caixa de e-mail: %s", e)
+
+    async def estatisticas(self):
+        r = await self.pool.fetchrow("""
+            SELECT
+                COUNT(*) FILTER (WHERE status = 'pendente') AS pendentes,
+                COUNT(*) FILTER (WHERE status = 'enviando') AS enviando,
+                COUNT(*) FILTER (WHERE status = 'falha') AS falhas
+            FROM emails_saida WHERE status <> 'enviado'
+        """)
+        return {
+            **dict(r),
+            "smtp_configurado": bool(SMTP_HOST),
+            "enviados": self.enviados,
+            "repeticoes": self.repeticoes,
+            "falhas_definitivas": self.falhas,
+            "perdidos_por_prazo": self.perdidos,
+            "sessoes_smtp_abertas": self.sessao.conexoes,
+        }
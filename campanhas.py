@@ -0,0 +1,357 @@
+# ==========================================================
+# 📣 MOTOR DE CAMPANHAS (DISPARO EM MASSA EM SEGUNDO PLANO)
+# ==========================================================
+# O /disparo/em-massa agora só grava a campanha + a lista de destinatários
+# e devolve o ID na hora. Um agendador (um só entre todos os workers,
+# eleito por advisory lock) drena as campanhas ativas respeitando, POR
+# INSTÂNCIA:
+#   DISPARO_TAXA_POR_S     -> mensagens por segundo (o antigo sleep(1) = 1/s)
+#   DISPARO_CONCORRENCIA   -> envios simultâneos
+#
+# Cada destinatário tem seu status no banco (pendente -> enviando ->
+# enviado/falha). Depois de um restart, quem já foi 'enviado' nunca é
+# reenviado. Cada 'enviando' tem dono (o agendador que pegou) e prazo
+# (travado_ate, renovado antes do envio): só volta para a fila quando o
+# prazo vence, então um líder novo não reenvia o que o anterior, ainda
+# vivo, está mandando. Falha temporária espera proxima_tentativa, que
+# cresce com as tentativas.
+# ==========================================================
+import os
+import time
+import uuid
+import random
+import socket
+import asyncio
+from datetime import datetime
+
+from evolution import evolution_async
+from armazem import midia_base64
+from logs import obter_logger, definir_correlacao
+
+log = obter_logger("campanhas")
+
+DISPARO_TAXA_POR_S = float(os.getenv("DISPARO_TAXA_POR_S", 1))
+DISPARO_CONCORRENCIA = int(os.getenv("DISPARO_CONCORRENCIA", 2))
+DISPARO_MAX_TENTATIVAS = int(os.getenv("DISPARO_MAX_TENTATIVAS", 3))
+DISPARO_LEASE_S = int(os.getenv("DISPARO_LEASE_S", 300))        # 'enviando' há mais que isso volta para a fila
+
+CHAVE_LIDER = 728401  # advisory lock do agendador
+
+DDL_CAMPANHAS = """
+    CREATE TABLE IF NOT EXISTS campanhas (
+        id BIGSERIAL PRIMARY KEY,
+        instancia VARCHAR(100) NOT NULL,
+        mensagem TEXT,
+        url_midia TEXT,
+        tipo_midia VARCHAR(20),
+        incluir_menu BOOLEAN DEFAULT FALSE,
+        status VARCHAR(15) NOT NULL DEFAULT 'ativa',
+        total INTEGER NOT NULL DEFAULT 0,
+        enviados INTEGER NOT NULL DEFAULT 0,
+        falhas INTEGER NOT NULL DEFAULT 0,
+        criado_em TIMESTAMP NOT NULL DEFAULT NOW(),
+        iniciado_em TIMESTAMP,
+        concluido_em TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_campanhas_status ON campanhas (status);
+    CREATE INDEX IF NOT EXISTS idx_campanhas_instancia ON campanhas (instancia, id DESC);
+
+    CREATE TABLE IF NOT EXISTS campanha_envios (
+        id BIGSERIAL PRIMARY KEY,
+        campanha_id BIGINT NOT NULL REFERENCES campanhas(id) ON DELETE CASCADE,
+        nome VARCHAR(255),
+        telefone VARCHAR(100) NOT NULL,
+        status VARCHAR(15) NOT NULL DEFAULT 'pendente',
+        tentativas INTEGER NOT NULL DEFAULT 0,
+        erro TEXT,
+        enviado_em TIMESTAMP,
+        CONSTRAINT uk_campanha_telefone UNIQUE (campanha_id, telefone)
+    );
+    CREATE INDEX IF NOT EXISTS idx_campanha_envios_fila ON campanha_envios (campanha_id, status, id);
+"""
+
+# Migração 016: dono + prazo do 'enviando' e espera entre tentativas
+DDL_CAMPANHAS_DONO = """
+    ALTER TABLE campanha_envios ADD COLUMN IF NOT EXISTS dono VARCHAR(80);
+    ALTER TABLE campanha_envios ADD COLUMN IF NOT EXISTS travado_ate TIMESTAMP;
+    ALTER TABLE campanha_envios ADD COLUMN IF NOT EXISTS proxima_tentativa TIMESTAMP NOT NULL DEFAULT NOW();
+"""
+
+
+def calcular_backoff(tentativas):
+    # 1min, 2min, 4min... (máx 30min) com jitter
+    return min(1800, 30 * 2 ** tentativas) * random.uniform(0.8, 1.2)
+
+
+class LimitadorTaxa:
+    """Token bucket: libera no máximo `taxa` envios por segundo (rajada = 1)."""
+
+    def __init__(self, taxa):
+        self.intervalo = 1.0 / taxa if taxa > 0 else 0.0
+        self._proximo = 0.0
+        self._trava = asyncio.Lock()
+
+    async def aguardar(self):
+        async with self._trava:
+            agora = time.monotonic()
+            espera = self._proximo - agora
+            self._proximo = max(agora, self._proximo) + self.intervalo
+        if espera > 0:
+            await asyncio.sleep(espera)
+
+
+class AgendadorCampanhas:
+    def __init__(self, pool, taxa=DISPARO_TAXA_POR_S, concorrencia=DISPARO_CONCORRENCIA):
+        self.pool = pool
+        self.taxa = taxa
+        self.concorrencia = max(1, concorrencia)
+        self._conn_lider = None
+        self._tarefa = None
+        self._drenando = {}      # campanha_id -> task
+        self._status = {}        # campanha_id -> status visto no banco (atualizado a cada volta)
+        self._limitadores = {}   # instancia -> LimitadorTaxa
+        self._semaforos = {}     # instancia -> Semaphore
+        self._recuperado_em = 0.0
+        self.dono = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    async def iniciar(self):
+        # Tabelas: migrações 005 e 016 (migracoes.py)
+        self._tarefa = asyncio.create_task(self._loop())
+
+    async def parar(self):
+        tarefas = [t for t in [self._tarefa, *self._drenando.values()] if t]
+        for t in tarefas: t.cancel()
+        await asyncio.gather(*tarefas, return_exceptions=True)
+        self._drenando.clear()
+        if self._conn_lider is not None:
+            try: await self._conn_lider.execute("SELECT pg_advisory_unlock($1)", CHAVE_LIDER)
+            except Exception: pass
+            await self.pool.release(self._conn_lider)
+            self._conn_lider = None
+
+    @property
+    def lider(self):
+        return self._conn_lider is not None
+
+    # --- ELEIÇÃO: só um worker dispara (senão a taxa por instância multiplica) ---
+    async def _tentar_liderar(self):
+        conn = await self.pool.acquire()
+        if await conn.fetchval("SELECT pg_try_advisory_lock($1)", CHAVE_LIDER):
+            self._conn_lider = conn
+            await self._recuperar_vencidos()
+            log.info("Agendador de campanhas ativo neste worker")
+            return True
+        await self.pool.release(conn)
+        return False
+
+    async def _recuperar_vencidos(self):
+        # Só volta para a fila o 'enviando' cujo prazo venceu (dono morreu);
+        # sem prazo = pego antes da migração 016
+        self._recuperado_em = time.monotonic()
+        await self.pool.execute("""
+            UPDATE campanha_envios SET status = 'pendente', dono = NULL, travado_ate = NULL
+            WHERE status = 'enviando' AND (travado_ate IS NULL OR travado_ate < NOW())
+        """)
+
+    async def _loop(self):
+        while True:
+            try:
+                if not self.lider and not await self._tentar_liderar():
+                    await asyncio.sleep(5)
+                    continue
+
+                if time.monotonic() - self._recuperado_em > 60:
+                    await self._recuperar_vencidos()
+
+                linhas = await self.pool.fetch("SELECT id, status FROM campanhas WHERE status IN ('ativa', 'pausada')")
+                self._status = {r['id']: r['status'] for r in linhas}
+
+                for camp_id, status in self._status.items():
+                    tarefa = self._drenando.get(camp_id)
+                    if status == 'ativa' and (tarefa is None or tarefa.done()):
+                        self._drenando[camp_id] = asyncio.create_task(self._drenar(camp_id))
+
+                for camp_id in [c for c, t in self._drenando.items() if t.done()]:
+                    self._drenando.pop(camp_id, None)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Agendador de campanhas falhou: %s", e)
+                if self._conn_lider is not None and self._conn_lider.is_closed():
+                    velha, self._conn_lider = self._conn_lider, None
+                    try: await self.pool.release(velha)
+                    except Exception: pass
+            await asyncio.sleep(1)
+
+    def _limitador(self, instancia):
+        if instancia not in self._limitadores:
+            self._limitadores[instancia] = LimitadorTaxa(self.taxa)
+            self._semaforos[instancia] = asyncio.Semaphore(self.concorrencia)
+        return self._limitadores[instancia], self._semaforos[instancia]
+
+    def _carregar_midia(self, camp):
+        # base64 vem do cache do armazém: lido e convertido uma vez por arquivo, não por campanha
+        if not camp['url_midia']: return None
+        midia = midia_base64(camp['url_midia'])
+        if midia is None:
+            log.warning("Arquivo da campanha não encontrado no servidor: %s", camp['url_midia'], extra={"campanha": camp['id']})
+        return midia
+
+    async def _drenar(self, camp_id):
+        definir_correlacao(f"campanha-{camp_id}")   # roda na própria task: não vaza para as outras
+        camp = await self.pool.fetchrow("SELECT * FROM campanhas WHERE id = $1", camp_id)
+        if not camp or camp['status'] != 'ativa': return
+        if not camp['iniciado_em']:
+            await self.pool.execute("UPDATE campanhas SET iniciado_em = NOW() WHERE id = $1 AND iniciado_em IS NULL", camp_id)
+
+        midia = await asyncio.to_thread(self._carregar_midia, camp)
+
+        while self._status.get(camp_id) == 'ativa':
+            lote = await self.pool.fetch(f"""
+                UPDATE campanha_envios
+                SET status = 'enviando', dono = $3, travado_ate = NOW() + INTERVAL '{DISPARO_LEASE_S} seconds'
+                WHERE id IN (
+                    SELECT id FROM campanha_envios
+                    WHERE campanha_id = $1 AND status = 'pendente' AND proxima_tentativa <= NOW()
+                    ORDER BY id LIMIT $2
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, nome, telefone, tentativas
+            """, camp_id, self.concorrencia * 2, self.dono)
+
+            if not lote:
+                await self._finalizar_se_vazia(camp_id)
+                return
+
+            await asyncio.gather(*(self._enviar(camp, midia, envio) for envio in lote))
+
+    async def _enviar(self, camp, midia, envio):
+        limitador, semaforo = self._limitador(camp['instancia'])
+        async with semaforo:
+            # Pausou/cancelou no meio do lote: devolve para a fila sem enviar
+            if self._status.get(camp['id']) != 'ativa':
+                await self.pool.execute("""
+                    UPDATE campanha_envios SET status = 'pendente', dono = NULL, travado_ate = NULL
+                    WHERE id = $1 AND dono = $2 AND status = 'enviando'
+                """, envio['id'], self.dono)
+                return
+
+            await limitador.aguardar()
+            if not await self._renovar(envio):
+                log.warning("Destinatário voltou para a fila antes do envio, pulando",
+                            extra={"campanha": camp['id'], "remote_jid": envio['telefone']})
+                return
+            msg_final = (camp['mensagem'] or "").replace("{nome}", envio['nome'] or "")
+            if camp['incluir_menu']:
+                msg_final += "\n\n(Digite 'Menu' para ver as opções)"
+
+            try:
+                if midia:
+                    b64, mimetype, nome_arquivo = midia
+                    resp = await evolution_async().send_media(camp['instancia'], envio['telefone'], b64, camp['tipo_midia'], mimetype, nome_arquivo, msg_final)
+                else:
+                    resp = await evolution_async().send_text(camp['instancia'], envio['telefone'], msg_final, timeout=15)
+                if resp.status_code >= 400:
+                    raise RuntimeError(f"Evolution respondeu {resp.status_code}: {resp.text[:200]}")
+            except Exception as e:
+                await self._registrar_falha(camp['id'], envio, str(e))
+                return
+
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute("""
+                        UPDATE campanha_envios SET status = 'enviado', enviado_em = NOW(), erro = NULL, dono = NULL, travado_ate = NULL
+                        WHERE id = $1
+                    """, envio['id'])
+                    await conn.execute("UPDATE campanhas SET enviados = enviados + 1 WHERE id = $1", camp['id'])
+            log.info("Mensagem enviada", extra={"evento": "mensagem.enviada", "origem": "campanha", "campanha": camp['id'],
+                                                "instancia": camp['instancia'], "remote_jid": envio['telefone'], "tamanho": len(msg_final)})
+
+    async def _renovar(self, envio):
+        """Prazo cheio para ESTE envio, se o destinatário ainda for nosso."""
+        return await self.pool.fetchval(f"""
+            UPDATE campanha_envios SET travado_ate = NOW() + INTERVAL '{DISPARO_LEASE_S} seconds'
+            WHERE id = $1 AND dono = $2 AND status = 'enviando'
+            RETURNING id
+        """, envio['id'], self.dono) is not None
+
+    async def _registrar_falha(self, camp_id, envio, erro):
+        tentativas = envio['tentativas'] + 1
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if tentativas >= DISPARO_MAX_TENTATIVAS:
+                    await conn.execute("""
+                        UPDATE campanha_envios SET status = 'falha', tentativas = $2, erro = $3, dono = NULL, travado_ate = NULL
+                        WHERE id = $1
+                    """, envio['id'], tentativas, erro)
+                    await conn.execute("UPDATE campanhas SET falhas = falhas + 1 WHERE id = $1", camp_id)
+                else:
+                    await conn.execute("""
+                        UPDATE campanha_envios SET status = 'pendente', tentativas = $2, erro = $3, dono = NULL, travado_ate = NULL,
+                            proxima_tentativa = NOW() + make_interval(secs => $4)
+                        WHERE id = $1
+                    """, envio['id'], tentativas, erro, calcular_backoff(tentativas))
+        log.warning("Erro no envio: %s", erro, extra={"evento": "campanha.falha_envio", "campanha": camp_id, "remote_jid": envio['telefone'], "tentativas": tentativas})
+
+    async def _finalizar_se_vazia(self, camp_id):
+        await self.pool.execute("""
+            UPDATE campanhas SET status = 'concluida', concluido_em = NOW()
+            WHERE id = $1 AND status = 'ativa'
+              AND NOT EXISTS (SELECT 1 FROM campanha_envios WHERE campanha_id = $1 AND status IN ('pendente', 'enviando'))
+        """, camp_id)
+
+    def estatisticas(self):
+        return {
+            "lider": self.lider,
+            "campanhas_em_andamento": sorted(c for c, t in self._drenando.items() if not t.done()),
+            "taxa_por_instancia": self.taxa,
+            "concorrencia_por_instancia": self.concorrencia,
+        }
+
+
+# ==========================================================
+# FUNÇÕES SÍNCRONAS (usadas pelas rotas com psycopg2)
+# ==========================================================
+def criar_campanha(cur, instancia, mensagem, lista_ids, incluir_menu=False, url_midia=None, tipo_midia=None):
+    cur.execute("""
+        INSERT INTO campanhas (instancia, mensagem, url_midia, tipo_midia, incluir_menu)
+        VALUES (%s, %s, %s, %s, %s) RETURNING id
+    """, (instancia, mensagem, url_midia, tipo_midia, incluir_menu))
+    camp_id = cur.fetchone()[0]
+
+    cur.execute("""
+        INSERT INTO campanha_envios (campanha_id, nome, telefone)
+        SELECT %s, nome, telefone FROM clientes_finais
+        WHERE id = ANY(%s) AND instancia = %s
+        ON CONFLICT (campanha_id, telefone) DO NOTHING
+    """, (camp_id, list(lista_ids), instancia))
+    total = cur.rowcount
+
+    cur.execute("UPDATE campanhas SET total = %s WHERE id = %s", (total, camp_id))
+    return camp_id, total
+
+
+def progresso_campanha(camp):
+    restantes = max(0, camp['total'] - camp['enviados'] - camp['falhas'])
+    feitos = camp['enviados'] + camp['falhas']
+
+    # ETA pela taxa real observada; sem histórico ainda, pela taxa configurada
+    taxa = DISPARO_TAXA_POR_S
+    if camp.get('iniciado_em') and feitos:
+        fim = camp.get('concluido_em') or datetime.now()
+        decorrido = (fim - camp['iniciado_em']).total_seconds()
+        if decorrido > 0: taxa = feitos / decorrido
+
+    return {
+        "id": camp['id'],
+        "instancia": camp['instancia'],
+        "status": camp['status'],
+        "total": camp['total'],
+        "enviados": camp['enviados'],
+        "falhas": camp['falhas'],
+        "restantes": restantes,
+        "percentual": round(feitos * 100 / camp['total'], 1) if camp['total'] else 100.0,
+        "eta_segundos": int(restantes / taxa) if camp['status'] == 'ativa' and taxa > 0 else None,
+        "criado_em": str(camp['criado_em']) if camp.get('criado_em') else None,
+        "concluido_em": str(camp['concluido_em']) if camp.get('concluido_em') else None,
+    }
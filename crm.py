@@ -0,0 +1,356 @@
+# ==========================================================
+# 📇 CRM: LISTAGEM RÁPIDA DE CLIENTES FINAIS
+# ==========================================================
+# - Paginação por cursor (keyset): "WHERE id < cursor ORDER BY id DESC"
+#   custa o mesmo na página 1 e na página 10.000 (OFFSET lia e jogava fora
+#   todas as linhas anteriores).
+# - Total sem COUNT(*) a cada tela:
+#     sem busca -> COUNT exato guardado em cache por CRM_TOTAL_TTL_S
+#     com busca -> estimativa do planejador (EXPLAIN), marcada como estimada
+# - Busca "contém" (ILIKE '%x%') usando índices GIN de trigramas (pg_trgm),
+#   criados e conferidos pela própria API no startup.
+# - Importação em lote: normaliza/deduplica em memória, COPY para uma
+#   tabela temporária e um único INSERT ... ON CONFLICT (instancia, telefone).
+# ==========================================================
+import os
+import io
+import re
+import csv
+import json
+import time
+import asyncio
+
+from banco import garantir_indices
+
+try:
+    import pandas as pd
+    TEM_PANDAS = True
+except ImportError:
+    TEM_PANDAS = False
+
+CRM_TOTAL_TTL_S = int(os.getenv("CRM_TOTAL_TTL_S", 60))
+CRM_MAX_ITENS = int(os.getenv("CRM_MAX_ITENS", 10000))
+CHAVE_INDICES = 728402  # advisory lock do build de índices
+CHAVE_IMPORTACAO = 728406  # advisory lock (por instância) da importação sem índice único
+IMPORTACAO_MAX_LINHAS = int(os.getenv("IMPORTACAO_MAX_LINHAS", 200000))
+
+# (nome, definição) — criados com CONCURRENTLY por banco.garantir_indices
+INDICES_CRM = [
+    ("idx_clientes_finais_instancia_id", "ON clientes_finais (instancia, id DESC)"),
+    ("idx_clientes_finais_nome_trgm", "ON clientes_finais USING gin (nome gin_trgm_ops)"),
+    ("idx_clientes_finais_telefone_trgm", "ON clientes_finais USING gin (telefone gin_trgm_ops)"),
+    # Alvo do ON CONFLICT da importação. Se a base já tem telefones repetidos o
+    # build falha (fica em /sistema/indices-crm) e a importação usa o caminho com lock.
+    ("uk_clientes_finais_instancia_telefone", "UNIQUE ON clientes_finais (instancia, telefone)"),
+]
+
+# Resultado da última verificação (exposto em /sistema/indices-crm)
+situacao_indices = {"verificado_em": None, "extensao_pg_trgm": None, "indices": {}}
+
+
+async def garantir_indices_crm(pool):
+    """
+    Ativa o pg_trgm e cria/confere os índices do CRM (banco.garantir_indices).
+    Roda em segundo plano: em tabela grande o build leva minutos.
+    """
+    try:
+        await pool.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        situacao_indices["extensao_pg_trgm"] = True
+    except Exception as e:
+        situacao_indices["extensao_pg_trgm"] = False
+        print(f"⚠️ CRM: não foi possível ativar pg_trgm ({e}). A busca vai continuar sem índice.")
+
+    indices = INDICES_CRM
+    if not situacao_indices["extensao_pg_trgm"]:
+        indices = [(n, d) for n, d in INDICES_CRM if "gin_trgm_ops" not in d]
+        for n, d in INDICES_CRM:
+            if "gin_trgm_ops" in d: situacao_indices["indices"][n] = "sem_pg_trgm"
+
+    resultado = await garantir_indices(pool, indices, CHAVE_INDICES)
+    if resultado is not None:
+        situacao_indices["indices"].update(resultado)
+        situacao_indices["verificado_em"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    return situacao_indices
+
+
+def iniciar_indices_crm(pool):
+    return asyncio.create_task(garantir_indices_crm(pool))
+
+
+# ==========================================================
+# TOTAL EM CACHE / ESTIMADO
+# ==========================================================
+_totais = {}   # instancia -> (total, expira_em)
+
+
+def invalidar_total(instancia):
+    _totais.pop(instancia, None)
+
+
+def _total_exato_em_cache(cur, instancia):
+    item = _totais.get(instancia)
+    if item and item[1] > time.monotonic(): return item[0]
+    cur.execute("SELECT COUNT(*) AS total FROM clientes_finais WHERE instancia = %s", (instancia,))
+    total = cur.fetchone()['total']
+    _totais[instancia] = (total, time.monotonic() + CRM_TOTAL_TTL_S)
+    return total
+
+
+def _total_estimado(cur, sql_where, params):
+    # Estimativa do planejador: não lê a tabela, só as estatísticas
+    cur.execute(f"EXPLAIN (FORMAT JSON) SELECT 1 FROM clientes_finais WHERE {sql_where}", params)
+    plano = cur.fetchone()
+    plano = plano['QUERY PLAN'] if isinstance(plano, dict) else plano[0]
+    if isinstance(plano, str): plano = json.loads(plano)
+    return int(plano[0]['Plan']['Plan Rows'])
+
+
+# ==========================================================
+# LISTAGEM
+# ==========================================================
+def montar_filtro(instancia, busca=None):
+    sql_where = "instancia = %s"
+    params = [instancia]
+    if busca:
+        sql_where += " AND (nome ILIKE %s OR telefone ILIKE %s)"
+        padrao = f"%{busca}%"
+        params.extend([padrao, padrao])
+    return sql_where, params
+
+
+def listar_clientes(cur, instancia, itens_por_pagina=50, cursor=None, busca=None, pagina=None):
+    """
+    cur: RealDictCursor psycopg2.
+    cursor: último id da página anterior (vem em "proximo_cursor").
+    pagina: só para clientes antigos que ainda mandam ?pagina=N sem cursor.
+    """
+    itens_por_pagina = max(1, min(int(itens_por_pagina), CRM_MAX_ITENS))
+    sql_where, params = montar_filtro(instancia, busca)
+
+    if busca:
+        total, estimado = _total_estimado(cur, sql_where, params), True
+    else:
+        total, estimado = _total_exato_em_cache(cur, instancia), False
+
+    consulta_where, consulta_params = sql_where, list(params)
+    offset = 0
+    if cursor:
+        consulta_where += " AND id < %s"
+        consulta_params.append(int(cursor))
+    elif pagina and pagina > 1:
+        offset = (pagina - 1) * itens_por_pagina
+
+    # Busca 1 a mais para saber se existe próxima página
+    cur.execute(
+        f"SELECT * FROM clientes_finais WHERE {consulta_where} ORDER BY id DESC LIMIT %s OFFSET %s",
+        tuple(consulta_params + [itens_por_pagina + 1, offset]))
+    itens = cur.fetchall()
+
+    tem_mais = len(itens) > itens_por_pagina
+    itens = itens[:itens_por_pagina]
+
+    return {
+        "data": itens,
+        "total": total,
+        "total_estimado": estimado,
+        "proximo_cursor": str(itens[-1]['id']) if tem_mais and itens else None,
+        "pagina_atual": pagina or 1,
+        "total_paginas": -(-total // itens_por_pagina),  # Arredonda pra cima
+    }
+
+
+# ==========================================================
+# IMPORTAÇÃO EM LOTE
+# ==========================================================
+COLUNAS_IMPORTACAO = ("nome", "telefone", "dia_vencimento", "etiquetas")
+_RE_NAO_DIGITO = re.compile(r"\D")
+MODOS_IMPORTACAO = ("atualizar", "ignorar")
+
+
+def normalizar_telefone(valor):
+    """Mesma regra do painel: só dígitos, >= 10, DDI 55 se faltar, sufixo do WhatsApp. JID pronto passa direto."""
+    valor = str(valor or "").strip()
+    if "@" in valor: return valor
+    digitos = _RE_NAO_DIGITO.sub("", valor)
+    if len(digitos) < 10: return None
+    if not digitos.startswith("55"): digitos = "55" + digitos
+    return digitos + "@s.whatsapp.net"
+
+
+def _coluna(colunas, *pedacos):
+    return next((c for c in colunas if any(p in c for p in pedacos)), None)
+
+
+def ler_planilha(arquivo, nome_arquivo):
+    """CSV/XLSX -> DataFrame com colunas nome/telefone (aceita 'Nome', 'Telefone', 'Celular', 'WhatsApp'...)."""
+    if not TEM_PANDAS:
+        raise RuntimeError("Importação de planilha exige pandas (pip install pandas openpyxl).")
+    if nome_arquivo.lower().endswith(".csv"):
+        df = pd.read_csv(arquivo, dtype=str, sep=None, engine="python")
+    else:
+        df = pd.read_excel(arquivo, dtype=str)
+    df.columns = [str(c).strip().lower() for c in df.columns]
+    col_nome = _coluna(df.columns, "nom")
+    col_tel = _coluna(df.columns, "tel", "cel", "what", "fone")
+    if not col_tel:
+        raise ValueError("Não encontrei a coluna de telefone.")
+    saida = pd.DataFrame({"telefone": df[col_tel], "nome": df[col_nome] if col_nome else None})
+    for extra in ("dia_vencimento", "etiquetas"):
+        if extra in df.columns: saida[extra] = df[extra]
+    return saida
+
+
+def normalizar_contatos(contatos, etiqueta_padrao, dia_padrao=None):
+    """
+    contatos: DataFrame ou lista de dicts {nome, telefone[, dia_vencimento, etiquetas]}.
+    Devolve (linhas prontas para o COPY, descartados). Duplicados: fica o último.
+    """
+    if TEM_PANDAS:
+        df = contatos if isinstance(contatos, pd.DataFrame) else pd.DataFrame(list(contatos))
+        total = len(df)
+        if total == 0: return [], 0
+        for col in COLUNAS_IMPORTACAO:
+            if col not in df.columns: df[col] = None
+        tel = df["telefone"].fillna("").astype(str).str.strip()
+        jid = tel.str.contains("@", regex=False)
+        digitos = tel.str.replace(r"\D", "", regex=True)
+        digitos = digitos.where(digitos.str.startswith("55"), "55" + digitos)
+        df["telefone"] = tel.where(jid, digitos + "@s.whatsapp.net")
+        validos = jid | (tel.str.replace(r"\D", "", regex=True).str.len() >= 10)
+        df = df[validos].copy()
+        df["nome"] = df["nome"].fillna("").astype(str).str.strip().replace("", "Cliente").str.slice(0, 200)
+        df["etiquetas"] = df["etiquetas"].fillna(etiqueta_padrao)
+        dia = pd.to_numeric(df["dia_vencimento"], errors="coerce")
+        df["dia_vencimento"] = dia.where(dia.between(1, 31), dia_padrao)
+        df = df.drop_duplicates(subset="telefone", keep="last")
+        linhas = [
+            (n, t, None if pd.isna(d) else int(d), e)
+            for n, t, d, e in df[list(COLUNAS_IMPORTACAO)].itertuples(index=False, name=None)
+        ]
+        return linhas, total - len(linhas)
+
+    # Sem pandas: mesma regra, linha a linha
+    unicos, total = {}, 0
+    for c in contatos:
+        total += 1
+        telefone = normalizar_telefone(c.get("telefone"))
+        if not telefone: continue
+        try: dia = int(c.get("dia_vencimento"))
+        except (TypeError, ValueError): dia = dia_padrao
+        if dia is not None and not 1 <= dia <= 31: dia = dia_padrao
+        nome = (str(c.get("nome") or "").strip() or "Cliente")[:200]
+        unicos[telefone] = (nome, telefone, dia, c.get("etiquetas") or etiqueta_padrao)
+    return list(unicos.values()), total - len(unicos)
+
+
+def _indice_unico_valido(cur):
+    cur.execute("""
+        SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = 'uk_clientes_finais_instancia_telefone'
+    """)
+    linha = cur.fetchone()
+    return bool(linha and (linha['indisvalid'] if isinstance(linha, dict) else linha[0]))
+
+
+def cadastrar_cliente(conn, instancia, nome, telefone, dia_vencimento, etiquetas):
+    """
+    Cadastro manual (POST /crm/clientes). Com o índice único, telefone já
+    cadastrado na instância não vira erro genérico: devolve "duplicado" com
+    o id existente. Sem o índice (base com repetidos) insere como sempre.
+    """
+    cur = conn.cursor()
+    try:
+        if _indice_unico_valido(cur):
+            cur.execute("""
+                INSERT INTO clientes_finais (instancia, nome, telefone, dia_vencimento, etiquetas)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (instancia, telefone) DO NOTHING
+                RETURNING id
+            """, (instancia, nome, telefone, dia_vencimento, etiquetas))
+            linha = cur.fetchone()
+            if linha is None:
+                cur.execute("SELECT id FROM clientes_finais WHERE instancia = %s AND telefone = %s", (instancia, telefone))
+                existente = cur.fetchone()
+                conn.rollback()
+                return {"status": "duplicado", "id": existente[0] if existente else None,
+                        "detail": "Telefone já cadastrado para esta instância."}
+        else:
+            cur.execute("""
+                INSERT INTO clientes_finais (instancia, nome, telefone, dia_vencimento, etiquetas)
+                VALUES (%s, %s, %s, %s, %s)
+                RETURNING id
+            """, (instancia, nome, telefone, dia_vencimento, etiquetas))
+            linha = cur.fetchone()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+    invalidar_total(instancia)
+    return {"status": "ok", "id": linha[0]}
+
+
+def importar_contatos(conn, instancia, linhas, modo="atualizar"):
+    """
+    conn: conexão psycopg2 (faz o commit). linhas: saída de normalizar_contatos.
+    modo 'atualizar': telefone já cadastrado recebe o nome novo; 'ignorar': fica como está.
+    Devolve {"inseridos", "atualizados", "ignorados"} (ignorados = já existiam sem mudança).
+    """
+    if modo not in MODOS_IMPORTACAO: raise ValueError(f"modo deve ser um de {MODOS_IMPORTACAO}")
+    if not linhas: return {"inseridos": 0, "atualizados": 0, "ignorados": 0}
+    if len(linhas) > IMPORTACAO_MAX_LINHAS:
+        raise ValueError(f"Máximo de {IMPORTACAO_MAX_LINHAS} contatos por importação.")
+
+    buf = io.StringIO()
+    csv.writer(buf).writerows(linhas)
+    buf.seek(0)
+
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            CREATE TEMP TABLE importacao_clientes (
+                nome TEXT, telefone VARCHAR(100), dia_vencimento INTEGER, etiquetas TEXT
+            ) ON COMMIT DROP
+        """)
+        cur.copy_expert("COPY importacao_clientes (nome, telefone, dia_vencimento, etiquetas) FROM STDIN WITH (FORMAT csv)", buf)
+
+        if _indice_unico_valido(cur):
+            acao = "DO UPDATE SET nome = EXCLUDED.nome WHERE clientes_finais.nome IS DISTINCT FROM EXCLUDED.nome" \
+                if modo == "atualizar" else "DO NOTHING"
+            cur.execute(f"""
+                WITH gravados AS (
+                    INSERT INTO clientes_finais (instancia, nome, telefone, dia_vencimento, etiquetas)
+                    SELECT %s, nome, telefone, dia_vencimento, etiquetas FROM importacao_clientes
+                    ON CONFLICT (instancia, telefone) {acao}
+                    RETURNING (xmax = 0) AS novo
+                )
+                SELECT COUNT(*) FILTER (WHERE novo), COUNT(*) FILTER (WHERE NOT novo) FROM gravados
+            """, (instancia,))
+            inseridos, atualizados = cur.fetchone()
+        else:
+            # Sem o índice único (base com telefones repetidos): serializa por instância e faz em 2 passos
+            cur.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s))", (CHAVE_IMPORTACAO, instancia))
+            atualizados = 0
+            if modo == "atualizar":
+                cur.execute("""
+                    UPDATE clientes_finais c SET nome = t.nome FROM importacao_clientes t
+                    WHERE c.instancia = %s AND c.telefone = t.telefone AND c.nome IS DISTINCT FROM t.nome
+                """, (instancia,))
+                atualizados = cur.rowcount
+            cur.execute("""
+                INSERT INTO clientes_finais (instancia, nome, telefone, dia_vencimento, etiquetas)
+                SELECT %s, t.nome, t.telefone, t.dia_vencimento, t.etiquetas FROM importacao_clientes t
+                WHERE NOT EXISTS (SELECT 1 FROM clientes_finais c WHERE c.instancia = %s AND c.telefone = t.telefone)
+            """, (instancia, instancia))
+            inseridos = cur.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+    invalidar_total(instancia)
+    return {"inseridos": inseridos, "atualizados": atualizados, "ignorados": len(linhas) - inseridos - atualizados}
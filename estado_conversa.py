@@ -0,0 +1,259 @@
+# ==========================================================
+# 🧭 ESTADO DA CONVERSA (EM QUE MENU O CLIENTE ESTÁ)
+# ==========================================================
+# Substitui o antigo dict "user_state" (que só existia no worker que
+# recebeu a mensagem e sumia a cada restart).
+#
+# Backends (ESTADO_BACKEND):
+#   memoria  -> dict no processo (1 worker / dev)
+#   postgres -> tabela estado_conversa (padrão; compartilhado entre workers)
+#   redis    -> qualquer servidor que fale o protocolo Redis (REDIS_URL)
+#
+# Toda chave tem TTL (ESTADO_TTL_S): menu abandonado expira sozinho.
+#
+# Escritas em lote ("group commit"): definir()/remover() entram num lote
+# que é gravado a cada ESTADO_LOTE_MS ou quando chega em ESTADO_LOTE_MAX
+# itens. Quem escreveu ESPERA o lote ser gravado, então o próximo evento
+# da mesma conversa (em qualquer worker) já enxerga o estado novo.
+# ==========================================================
+import os
+import json
+import time
+import asyncio
+
+try:
+    import redis.asyncio as aioredis
+    TEM_REDIS = True
+except ImportError:
+    TEM_REDIS = False
+
+from logs import obter_logger
+
+ESTADO_BACKEND = os.getenv("ESTADO_BACKEND", "postgres")
+ESTADO_TTL_S = int(os.getenv("ESTADO_TTL_S", 1800))
+ESTADO_LOTE_MS = int(os.getenv("ESTADO_LOTE_MS", 20))
+ESTADO_LOTE_MAX = int(os.getenv("ESTADO_LOTE_MAX", 200))
+REDIS_URL = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
+
+log = obter_logger("estado_conversa")
+
+DDL_ESTADO = """
+    CREATE TABLE IF NOT EXISTS estado_conversa (
+        chave VARCHAR(220) PRIMARY KEY,
+        valor TEXT NOT NULL,
+        expira_em TIMESTAMP NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_estado_conversa_expira ON estado_conversa (expira_em);
+"""
+
+
+def montar_chave(instancia, remote_jid):
+    return f"{instancia}:{remote_jid}"
+
+
+class EstadoConversa:
+    """Base: cuida do lote de escritas. Os backends implementam _ler/_gravar_lote/_limpar."""
+
+    def __init__(self, ttl=ESTADO_TTL_S, lote_ms=ESTADO_LOTE_MS, lote_max=ESTADO_LOTE_MAX):
+        self.ttl = ttl
+        self.lote_ms = lote_ms
+        self.lote_max = lote_max
+        self._pendentes = {}        # chave -> (valor | None para remover, ttl)
+        self._futuro = None         # concluído quando o lote atual for gravado
+        self._tem_lote = None
+        self._tarefas = []
+
+        # Métricas
+        self.lotes = 0
+        self.escritas = 0
+        self.leituras = 0
+
+    # --- a implementar pelos backends ---
+    async def _ler(self, chave): raise NotImplementedError
+    async def _gravar_lote(self, gravar, remover): raise NotImplementedError
+    async def _limpar(self): pass
+    async def _abrir(self): pass
+    async def _fechar(self): pass
+
+    # --- ciclo de vida ---
+    async def iniciar(self):
+        await self._abrir()
+        self._tem_lote = asyncio.Event()
+        self._tarefas = [asyncio.create_task(self._loop_lote()), asyncio.create_task(self._loop_limpeza())]
+
+    async def parar(self):
+        for t in self._tarefas: t.cancel()
+        await asyncio.gather(*self._tarefas, return_exceptions=True)
+        self._tarefas = []
+        await self._descarregar()
+        await self._fechar()
+
+    # --- API ---
+    async def obter(self, instancia, remote_jid):
+        chave = montar_chave(instancia, remote_jid)
+        self.leituras += 1
+        if chave in self._pendentes:
+            valor, _ = self._pendentes[chave]
+        else:
+            valor = await self._ler(chave)
+        return json.loads(valor) if valor is not None else None
+
+    async def definir(self, instancia, remote_jid, valor, ttl=None):
+        await self._enfileirar(montar_chave(instancia, remote_jid), json.dumps(valor), ttl or self.ttl)
+
+    async def remover(self, instancia, remote_jid):
+        await self._enfileirar(montar_chave(instancia, remote_jid), None, 0)
+
+    # --- lote ---
+    async def _enfileirar(self, chave, valor, ttl):
+        self.escritas += 1
+        self._pendentes[chave] = (valor, ttl)
+        if self._futuro is None or self._futuro.done():
+            self._futuro = asyncio.get_running_loop().create_future()
+        futuro = self._futuro
+        self._tem_lote.set()
+        await asyncio.shield(futuro)
+
+    async def _descarregar(self):
+        if not self._pendentes: return
+        lote, self._pendentes = self._pendentes, {}
+        futuro, self._futuro = self._futuro, None
+        gravar = {c: (v, t) for c, (v, t) in lote.items() if v is not None}
+        remover = [c for c, (v, _) in lote.items() if v is None]
+        try:
+            await self._gravar_lote(gravar, remover)
+            self.lotes += 1
+            if futuro and not futuro.done(): futuro.set_result(True)
+        except Exception as e:
+            if futuro and not futuro.done(): futuro.set_exception(e)
+
+    async def _loop_lote(self):
+        while True:
+            await self._tem_lote.wait()
+            self._tem_lote.clear()
+            # Junta o que chegar nos próximos milissegundos (ou até encher o lote)
+            limite = time.monotonic() + self.lote_ms / 1000
+            while len(self._pendentes) < self.lote_max and time.monotonic() < limite:
+                await asyncio.sleep(0.002)
+            await self._descarregar()
+
+    async def _loop_limpeza(self):
+        while True:
+            await asyncio.sleep(60)
+            try:
+                await self._limpar()
+            except Exception as e:
+                log.warning("Limpeza do estado de conversa: %s", e)
+
+    def estatisticas(self):
+        return {
+            "backend": type(self).__name__,
+            "ttl_s": self.ttl,
+            "pendentes": len(self._pendentes),
+            "lotes": self.lotes,
+            "escritas": self.escritas,
+            "leituras": self.leituras,
+            "escritas_por_lote": round(self.escritas / self.lotes, 2) if self.lotes else 0.0,
+        }
+
+
+# ==========================================================
+# BACKEND: MEMÓRIA
+# ==========================================================
+class EstadoMemoria(EstadoConversa):
+    def __init__(self, **kw):
+        super().__init__(**kw)
+        self._dados = {}   # chave -> (valor, expira_em)
+
+    async def _ler(self, chave):
+        item = self._dados.get(chave)
+        if not item: return None
+        if item[1] <= time.time():
+            self._dados.pop(chave, None)
+            return None
+        return item[0]
+
+    async def _gravar_lote(self, gravar, remover):
+        agora = time.time()
+        for chave, (valor, ttl) in gravar.items():
+            self._dados[chave] = (valor, agora + ttl)
+        for chave in remover:
+            self._dados.pop(chave, None)
+
+    async def _limpar(self):
+        agora = time.time()
+        for chave in [c for c, (_, exp) in self._dados.items() if exp <= agora]:
+            self._dados.pop(chave, None)
+
+
+# ==========================================================
+# BACKEND: POSTGRES
+# ==========================================================
+class EstadoPostgres(EstadoConversa):
+    def __init__(self, pool, **kw):
+        super().__init__(**kw)
+        self.pool = pool
+
+    # Tabela estado_conversa: migração 003 (migracoes.py)
+
+    async def _ler(self, chave):
+        return await self.pool.fetchval(
+            "SELECT valor FROM estado_conversa WHERE chave = $1 AND expira_em > NOW()", chave)
+
+    async def _gravar_lote(self, gravar, remover):
+        # Uma ida ao banco por lote, não importa quantas conversas
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if gravar:
+                    chaves = list(gravar.keys())
+                    await conn.execute("""
+                        INSERT INTO estado_conversa (chave, valor, expira_em)
+                        SELECT c, v, NOW() + make_interval(secs => t)
+                        FROM unnest($1::text[], $2::text[], $3::float8[]) AS x(c, v, t)
+                        ON CONFLICT (chave) DO UPDATE SET valor = EXCLUDED.valor, expira_em = EXCLUDED.expira_em
+                    """, chaves, [gravar[c][0] for c in chaves], [float(gravar[c][1]) for c in chaves])
+                if remover:
+                    await conn.execute("DELETE FROM estado_conversa WHERE chave = ANY($1::text[])", remover)
+
+    async def _limpar(self):
+        await self.pool.execute("DELETE FROM estado_conversa WHERE expira_em <= NOW()")
+
+
+# ==========================================================
+# BACKEND: REDIS (protocolo RESP)
+# ==========================================================
+class EstadoRedis(EstadoConversa):
+    def __init__(self, url=REDIS_URL, prefixo="agil:estado:", **kw):
+        super().__init__(**kw)
+        if not TEM_REDIS:
+            raise RuntimeError("Backend redis exige a biblioteca 'redis' (pip install redis).")
+        self.url = url
+        self.prefixo = prefixo
+        self.cliente = None
+
+    async def _abrir(self):
+        self.cliente = aioredis.from_url(self.url, decode_responses=True)
+        await self.cliente.ping()
+
+    async def _fechar(self):
+        if self.cliente is not None:
+            await self.cliente.aclose()
+            self.cliente = None
+
+    async def _ler(self, chave):
+        return await self.cliente.get(self.prefixo + chave)
+
+    async def _gravar_lote(self, gravar, remover):
+        # TTL nativo do Redis (EX); o lote vai num pipeline só
+        pipe = self.cliente.pipeline(transaction=False)
+        for chave, (valor, ttl) in gravar.items():
+            pipe.set(self.prefixo + chave, valor, ex=max(1, int(ttl)))
+        if remover:
+            pipe.delete(*[self.prefixo + c for c in remover])
+        await pipe.execute()
+
+
+def criar_estado(pool=None, backend=ESTADO_BACKEND):
+    if backend == "memoria": return EstadoMemoria()
+    if backend == "redis": return EstadoRedis()
+    return EstadoPostgres(pool)
@@ -0,0 +1,657 @@
+# ==========================================================
+# 📡 CLIENTE EVOLUTION API (ÚNICO PARA TODO O SISTEMA)
+# ==========================================================
+# Toda chamada à Evolution passa por aqui (API e painel):
+#   - pool de conexões com keep-alive (requests.Session / httpx.AsyncClient)
+#   - timeout por endpoint (TIMEOUTS)
+#   - retry com backoff exponencial + jitter em 5xx / 429 (respeita
+#     Retry-After). Envio de mensagem NÃO é idempotente: só repete quando
+#     a Evolution com certeza não processou (429, 502/503/504, falha ao
+#     conectar) — nunca em 500 ou timeout de leitura. Envio que termina
+#     em 5xx/429 levanta EnvioRecusado (subclasse de EvolutionErro); as
+#     chamadas idempotentes devolvem a resposta e quem chama confere o status.
+#   - circuit breaker POR INSTÂNCIA: depois de EVO_CIRCUITO_FALHAS falhas
+#     seguidas a instância fica "aberta" por EVO_CIRCUITO_ABERTO_S e as
+#     chamadas falham na hora (CircuitoAberto), sem segurar worker.
+#   - métricas por endpoint (chamadas, erros, retries, latência p50/p95).
+#   - descoberta de rotas: a versão do servidor (GET /) e a rota que
+#     funcionou para cada operação "instável" (mídia, contatos) ficam em
+#     cache por EVO_ROTAS_TTL_S; só se sonda de novo quando a rota guardada
+#     responde 404/405. O formato do corpo de envio (v1/v2) vem da versão.
+#
+# Uso:
+#   evolution_sync().send_text(instancia, numero, texto)            # rotas def
+#   await evolution_async().send_text(instancia, numero, texto)     # rotas async def
+# ==========================================================
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+from telemetria import registrar_saida, faixa_status
+from logs import obter_logger, id_correlacao, CABECALHO_CORRELACAO
+
+try:
+    import httpx
+    TEM_HTTPX = True
+except ImportError:
+    TEM_HTTPX = False
+
+load_dotenv(dotenv_path=Path(__file__).resolve().parent / '.env')
+
+log = obter_logger("evolution")
+
+EVO_API_URL = os.getenv("EVO_API_URL")
+EVO_API_KEY = os.getenv("EVO_API_KEY")
+EVO_MAX_CONEXOES = int(os.getenv("EVO_MAX_CONEXOES", 100))
+EVO_TENTATIVAS = int(os.getenv("EVO_TENTATIVAS", 3))
+EVO_BACKOFF_BASE = float(os.getenv("EVO_BACKOFF_BASE", 0.3))
+EVO_BACKOFF_MAX = float(os.getenv("EVO_BACKOFF_MAX", 5))
+EVO_CIRCUITO_FALHAS = int(os.getenv("EVO_CIRCUITO_FALHAS", 5))
+EVO_CIRCUITO_ABERTO_S = float(os.getenv("EVO_CIRCUITO_ABERTO_S", 30))
+EVO_TIMEOUT_PADRAO = float(os.getenv("EVO_TIMEOUT_PADRAO", 10))
+EVO_ROTAS_TTL_S = float(os.getenv("EVO_ROTAS_TTL_S", 3600))
+EVO_VERSAO_FALHA_TTL_S = 60          # servidor fora: não sonda a versão a cada envio
+EVO_ESPERA_MAX_S = float(os.getenv("EVO_ESPERA_MAX_S", 10))
+
+# Timeout (s) por operação
+TIMEOUTS = {
+    "send_text": 10,
+    "send_media": 60,
+    "send_audio": 60,
+    "connection_state": 3,
+    "connect": 20,
+    "create_instance": 20,
+    "delete_instance": 15,
+    "logout": 15,
+    "set_webhook": 10,
+    "find_webhook": 5,
+    "instance_settings": 10,
+    "versao_servidor": 3,
+}
+
+# Rotas que mudaram de nome entre versões/forks da Evolution (método, caminho)
+ROTAS_CANDIDATAS = {
+    "retrieve_media": [
+        ("POST", "/chat/retrieveMediaMessage/{instancia}"),     # V2 Padrão (Mais provável)
+        ("POST", "/chat/retrieverMediaMessage/{instancia}"),    # V1 / Forks antigos
+        ("POST", "/message/retrieveMediaMessage/{instancia}"),  # V2 Alternativa
+        ("POST", "/chat/getBase64FromMediaMessage/{instancia}"),
+    ],
+    "listar_contatos": [
+        ("GET",  "/chat/find/{instancia}"),          # v1.8+
+        ("GET",  "/chat/retriever/{instancia}"),
+        ("GET",  "/chat/findChats/{instancia}"),     # v2.0+
+        ("POST", "/chat/find/{instancia}"),
+        ("GET",  "/contact/find/{instancia}"),       # Contatos v1
+        ("POST", "/contact/find/{instancia}"),
+        ("GET",  "/contact/findAll/{instancia}"),    # Contatos v2
+    ],
+}
+ROTA_INEXISTENTE = {404, 405}
+
+STATUS_REPETIVEIS = {429, 500, 502, 503, 504}
+STATUS_REPETIVEIS_ENVIO = {429, 502, 503, 504}   # a Evolution não chegou a processar
+
+
+class EvolutionErro(Exception):
+    """Falha de rede / timeout falando com a Evolution (depois dos retries)."""
+
+
+class CircuitoAberto(EvolutionErro):
+    """A instância falhou demais seguidas; chamadas bloqueadas por um tempo."""
+
+
+class EnvioRecusado(EvolutionErro):
+    """
+    Envio (não idempotente) terminou em 5xx/429. Em 500 a Evolution pode ter
+    processado a mensagem: quem chamou decide se avisa ou repete.
+    """
+
+    def __init__(self, operacao, resp):
+        super().__init__(f"Evolution {operacao}: HTTP {resp.status_code}")
+        self.resp = resp
+        self.status_code = resp.status_code
+
+
+# ==========================================================
+# CIRCUIT BREAKER (por instância)
+# ==========================================================
+class Circuito:
+    def __init__(self, limite=EVO_CIRCUITO_FALHAS, aberto_s=EVO_CIRCUITO_ABERTO_S):
+        self.limite = limite
+        self.aberto_s = aberto_s
+        self.falhas = 0
+        self.aberto_ate = 0.0
+        self.testando = False
+        self._trava = threading.Lock()
+
+    @property
+    def estado(self):
+        if self.falhas < self.limite: return "fechado"
+        return "aberto" if time.monotonic() < self.aberto_ate else "meio_aberto"
+
+    def permitir(self):
+        return self.reservar() is not None
+
+    def reservar(self):
+        """None = bloqueado; True = esta é a chamada de teste (meio-aberto); False = normal."""
+        with self._trava:
+            estado = self.estado
+            if estado == "fechado": return False
+            if estado == "aberto": return None
+            # Meio-aberto: deixa UMA chamada de teste passar
+            if self.testando: return None
+            self.testando = True
+            return True
+
+    def soltar_teste(self):
+        # A chamada de teste terminou sem sucesso()/falha() (cancelada, erro
+        # inesperado): libera a vaga, senão a instância fica bloqueada para sempre
+        with self._trava:
+            self.testando = False
+
+    def sucesso(self):
+        with self._trava:
+            self.falhas = 0
+            self.testando = False
+
+    def falha(self):
+        with self._trava:
+            self.falhas += 1
+            self.testando = False
+            if self.falhas >= self.limite:
+                self.aberto_ate = time.monotonic() + self.aberto_s
+
+
+# ==========================================================
+# MÉTRICAS (por endpoint)
+# ==========================================================
+class MetricasEvolution:
+    def __init__(self, amostras=1000):
+        self.amostras = amostras
+        self._dados = {}
+        self._trava = threading.Lock()
+
+    def _item(self, operacao):
+        item = self._dados.get(operacao)
+        if item is None:
+            item = self._dados[operacao] = {
+                "chamadas": 0, "erros": 0, "repeticoes": 0, "circuito_aberto": 0,
+                "status": {}, "latencias": deque(maxlen=self.amostras), "latencia_max": 0.0,
+            }
+        return item
+
+    def registrar(self, operacao, duracao, status=None, erro=False):
+        with self._trava:
+            item = self._item(operacao)
+            item["chamadas"] += 1
+            if erro: item["erros"] += 1
+            faixa = faixa_status(status)
+            item["status"][faixa] = item["status"].get(faixa, 0) + 1
+            item["latencias"].append(duracao)
+            item["latencia_max"] = max(item["latencia_max"], duracao)
+        registrar_saida("evolution", operacao, duracao, faixa)
+
+    def contar(self, operacao, campo):
+        with self._trava:
+            self._item(operacao)[campo] += 1
+
+    def estatisticas(self):
+        with self._trava:
+            saida = {}
+            for operacao, item in self._dados.items():
+                lat = sorted(item["latencias"])
+                pct = lambda p: round(lat[min(len(lat) - 1, int(len(lat) * p))] * 1000, 1) if lat else 0.0
+                saida[operacao] = {
+                    "chamadas": item["chamadas"],
+                    "erros": item["erros"],
+                    "repeticoes": item["repeticoes"],
+                    "circuito_aberto": item["circuito_aberto"],
+                    "status": dict(item["status"]),
+                    "latencia_p50_ms": pct(0.50),
+                    "latencia_p95_ms": pct(0.95),
+                    "latencia_max_ms": round(item["latencia_max"] * 1000, 1),
+                }
+            return saida
+
+
+metricas_evolution = MetricasEvolution()
+_circuitos = {}
+_circuitos_trava = threading.Lock()
+
+
+def circuito(instancia):
+    chave = instancia or "_global"
+    with _circuitos_trava:
+        if chave not in _circuitos: _circuitos[chave] = Circuito()
+        return _circuitos[chave]
+
+
+def estado_circuitos():
+    with _circuitos_trava:
+        return {k: {"estado": c.estado, "falhas": c.falhas} for k, c in _circuitos.items() if c.falhas}
+
+
+def calcular_espera(tentativa, resp_headers=None):
+    # Retry-After (segundos) manda; senão backoff exponencial com jitter "cheio"
+    if resp_headers:
+        ra = resp_headers.get("Retry-After")
+        if ra and ra.strip().isdigit(): return min(float(ra), EVO_BACKOFF_MAX)
+    return random.uniform(0, min(EVO_BACKOFF_MAX, EVO_BACKOFF_BASE * (2 ** (tentativa - 1))))
+
+
+def estado_da_conexao(resp):
+    """Lê 'open' / 'close' / 'connecting' da resposta de connection_state."""
+    if resp is None or resp.status_code != 200: return None
+    try:
+        dados = resp.json()
+    except ValueError:
+        return None
+    return (dados.get("instance") or {}).get("state") or dados.get("state")
+
+
+def aguardar_pronto(verificar, limite_s=EVO_ESPERA_MAX_S, intervalo=0.3):
+    """
+    Chama verificar() até devolver algo verdadeiro ou estourar limite_s
+    (intervalo dobrando até 2s). Devolve o último resultado.
+    Substitui os time.sleep(N) fixos de "espera a Evolution terminar".
+    """
+    fim = time.monotonic() + limite_s
+    while True:
+        resultado = verificar()
+        restante = fim - time.monotonic()
+        if resultado or restante <= 0: return resultado
+        time.sleep(min(intervalo, restante))
+        intervalo = min(intervalo * 2, 2.0)
+
+
+# ==========================================================
+# DESCOBERTA DE ROTAS / VERSÃO (cache por servidor)
+# ==========================================================
+class DescobertaRotas:
+    def __init__(self, ttl=EVO_ROTAS_TTL_S):
+        self.ttl = ttl
+        self.versao = None
+        self._versao_ate = 0.0
+        self._rotas = {}          # operacao -> ((metodo, caminho), expira_em)
+        self.sondagens = 0
+        self._trava = threading.Lock()
+
+    # --- Versão do servidor ---
+    def precisa_versao(self):
+        return time.monotonic() >= self._versao_ate
+
+    def registrar_versao(self, resp):
+        versao = None
+        if resp is not None and resp.status_code == 200:
+            try:
+                dados = resp.json()
+                versao = str(dados.get("version") or dados.get("data", {}).get("version") or "")
+            except (ValueError, AttributeError):
+                versao = ""
+        with self._trava:
+            if versao is None:
+                self._versao_ate = time.monotonic() + EVO_VERSAO_FALHA_TTL_S
+            else:
+                self.versao = versao
+                self._versao_ate = time.monotonic() + self.ttl
+
+    def formato(self):
+        """'v1' (textMessage / mediaMessage) ou 'v2' (campos na raiz). Sem versão conhecida: v2."""
+        return "v1" if (self.versao or "").startswith("1.") else "v2"
+
+    # --- Rotas por operação ---
+    def candidatas(self, operacao):
+        todas = ROTAS_CANDIDATAS[operacao]
+        with self._trava:
+            guardada = self._rotas.get(operacao)
+        if guardada and guardada[1] > time.monotonic():
+            return [guardada[0]] + [r for r in todas if r != guardada[0]]
+        return list(todas)
+
+    def confirmar(self, operacao, rota):
+        with self._trava:
+            atual = self._rotas.get(operacao)
+            if not atual or atual[0] != rota:
+                log.info("Rota de '%s' = %s %s", operacao, rota[0], rota[1])
+            self._rotas[operacao] = (rota, time.monotonic() + self.ttl)
+
+    def esquecer(self, operacao, rota):
+        with self._trava:
+            self.sondagens += 1
+            atual = self._rotas.get(operacao)
+            if atual and atual[0] == rota: del self._rotas[operacao]
+
+    def estatisticas(self):
+        with self._trava:
+            return {
+                "versao": self.versao,
+                "formato": self.formato(),
+                "rotas": {op: f"{r[0][0]} {r[0][1]}" for op, r in self._rotas.items()},
+                "sondagens_404": self.sondagens,
+            }
+
+
+_descobertas = {}
+
+
+def descoberta_para(base_url):
+    with _circuitos_trava:
+        if base_url not in _descobertas: _descobertas[base_url] = DescobertaRotas()
+        return _descobertas[base_url]
+
+
+# ==========================================================
+# MÉTODOS TIPADOS (iguais no cliente síncrono e no assíncrono)
+# ==========================================================
+class _OperacoesEvolution:
+    """
+    Cada método devolve a resposta HTTP (no cliente async, um awaitable).
+    _chamar(operacao, metodo, caminho, instancia, json, idempotente) é do cliente.
+    Corpo "callable" = depende do formato do servidor: recebe 'v1'/'v2'.
+    """
+
+    def send_text(self, instancia, numero, texto, timeout=None):
+        def corpo(formato):
+            if formato == "v1": return {"number": numero, "textMessage": {"text": texto}}
+            return {"number": numero, "text": texto}
+        return self._chamar("send_text", "POST", f"/message/sendText/{instancia}", instancia,
+                            corpo, idempotente=False, timeout=timeout)
+
+    def send_media(self, instancia, numero, base64_midia, tipo_midia, mimetype, nome_arquivo, legenda="", timeout=None):
+        def corpo(formato):
+            midia = {
+                "media": base64_midia,
+                "mediatype": tipo_midia,
+                "mimetype": mimetype,
+                "caption": legenda,
+                "fileName": nome_arquivo,
+            }
+            if formato == "v1": return {"number": numero, "mediaMessage": midia}
+            return {"number": numero, **midia}
+        return self._chamar("send_media", "POST", f"/message/sendMedia/{instancia}", instancia, corpo,
+                            idempotente=False, timeout=timeout)
+
+    def send_audio(self, instancia, numero, base64_audio):
+        def corpo(formato):
+            if formato == "v1": return {"number": numero, "audioMessage": {"audio": base64_audio}, "options": {"encoding": True}}
+            return {"number": numero, "audio": base64_audio, "encoding": True}
+        return self._chamar("send_audio", "POST", f"/message/sendWhatsAppAudio/{instancia}", instancia,
+                            corpo, idempotente=False)
+
+    def connection_state(self, instancia):
+        return self._chamar("connection_state", "GET", f"/instance/connectionState/{instancia}", instancia)
+
+    def connect(self, instancia):
+        return self._chamar("connect", "GET", f"/instance/connect/{instancia}", instancia)
+
+    def create_instance(self, instancia, token, integration="WHATSAPP-BAILEYS", qrcode=True):
+        payload = {"instanceName": instancia, "token": token, "qrcode": qrcode, "integration": integration}
+        return self._chamar("create_instance", "POST", "/instance/create", instancia, payload, idempotente=False)
+
+    def delete_instance(self, instancia):
+        return self._chamar("delete_instance", "DELETE", f"/instance/delete/{instancia}", instancia)
+
+    def logout(self, instancia):
+        return self._chamar("logout", "DELETE", f"/instance/logout/{instancia}", instancia)
+
+    def set_webhook(self, instancia, url, eventos=("messages.upsert",), **extras):
+        webhook = {"enabled": True, "url": url, "events": list(eventos), **extras}
+        return self._chamar("set_webhook", "POST", f"/webhook/set/{instancia}", instancia, {"webhook": webhook})
+
+    def find_webhook(self, instancia):
+        return self._chamar("find_webhook", "GET", f"/webhook/find/{instancia}", instancia)
+
+    def instance_settings(self, instancia, payload):
+        return self._chamar("instance_settings", "POST", f"/instance/settings/{instancia}", instancia, payload)
+
+    def requisicao(self, operacao, metodo, caminho, instancia=None, json=None, idempotente=True, timeout=None):
+        """Escape para rotas sem método próprio (ainda passa por retry/circuito/métricas)."""
+        return self._chamar(operacao, metodo, caminho, instancia, json, idempotente=idempotente, timeout=timeout)
+
+
+class _NucleoEvolution(_OperacoesEvolution):
+    def __init__(self, base_url=None, api_key=None, metricas=None):
+        self.base_url = (base_url if base_url is not None else EVO_API_URL or "").rstrip("/")
+        self.api_key = api_key if api_key is not None else EVO_API_KEY or ""
+        self.metricas = metricas or metricas_evolution
+        self.descoberta = descoberta_para(self.base_url)
+
+    def _liberar(self, operacao, instancia):
+        """(circuito, é_teste). O teste do meio-aberto tem que ser solto no finally."""
+        c = circuito(instancia)
+        teste = c.reservar()
+        if teste is None:
+            self.metricas.contar(operacao, "circuito_aberto")
+            raise CircuitoAberto(f"Evolution: circuito aberto para '{instancia}' ({operacao}).")
+        return c, teste
+
+    @staticmethod
+    def _cabecalhos():
+        # Leva o id de correlação até a Evolution (cruza com os logs de lá)
+        correlacao = id_correlacao()
+        return {CABECALHO_CORRELACAO: correlacao} if correlacao else None
+
+    @staticmethod
+    def _repetir_status(status, idempotente):
+        return status in (STATUS_REPETIVEIS if idempotente else STATUS_REPETIVEIS_ENVIO)
+
+    def _finalizar(self, c, operacao, duracao, status):
+        erro = status >= 500 or status == 429
+        self.metricas.registrar(operacao, duracao, status, erro=erro)
+        # 4xx é erro do pedido, não da instância: não conta para o circuito
+        if status >= 500: c.falha()
+        else: c.sucesso()
+
+    @staticmethod
+    def _conferir_envio(operacao, resp, idempotente):
+        # Idempotente devolve a resposta (quem chamou confere status_code);
+        # envio que falhou no servidor levanta, como a falha de rede.
+        if not idempotente and (resp.status_code >= 500 or resp.status_code == 429):
+            raise EnvioRecusado(operacao, resp)
+        return resp
+
+
+# ==========================================================
+# CLIENTE SÍNCRONO (rotas "def" e painel Streamlit)
+# ==========================================================
+class ClienteEvolution(_NucleoEvolution):
+    def __init__(self, base_url=None, api_key=None, max_conexoes=EVO_MAX_CONEXOES, metricas=None):
+        super().__init__(base_url, api_key, metricas)
+        self.sessao = requests.Session()
+        self.sessao.headers.update({"apikey": self.api_key, "Content-Type": "application/json"})
+        adaptador = HTTPAdapter(pool_connections=4, pool_maxsize=max_conexoes)
+        self.sessao.mount("http://", adaptador)
+        self.sessao.mount("https://", adaptador)
+
+    def _chamar(self, operacao, metodo, caminho, instancia=None, json=None, idempotente=True, timeout=None):
+        if callable(json):
+            if self.descoberta.precisa_versao(): self._sondar_versao()
+            json = json(self.descoberta.formato())
+        c, teste = self._liberar(operacao, instancia)
+        try:
+            return self._tentar(c, operacao, metodo, caminho, instancia, json, idempotente, timeout)
+        finally:
+            if teste: c.soltar_teste()
+
+    def _tentar(self, c, operacao, metodo, caminho, instancia, json, idempotente, timeout):
+        timeout = timeout or TIMEOUTS.get(operacao, EVO_TIMEOUT_PADRAO)
+        for tentativa in range(1, EVO_TENTATIVAS + 1):
+            inicio = time.perf_counter()
+            try:
+                resp = self.sessao.request(metodo, self.base_url + caminho, json=json, timeout=timeout, headers=self._cabecalhos())
+            except requests.RequestException as e:
+                duracao = time.perf_counter() - inicio
+                self.metricas.registrar(operacao, duracao, erro=True)
+                seguro = idempotente or isinstance(e, requests.exceptions.ConnectTimeout)
+                if seguro and tentativa < EVO_TENTATIVAS:
+                    self.metricas.contar(operacao, "repeticoes")
+                    log.warning("%s falhou (tentativa %s): %s", operacao, tentativa, e, extra={"evento": "evolution.repeticao", "instancia": instancia})
+                    time.sleep(calcular_espera(tentativa))
+                    continue
+                c.falha()
+                raise EvolutionErro(f"Evolution {operacao}: {e}") from e
+
+            duracao = time.perf_counter() - inicio
+            if self._repetir_status(resp.status_code, idempotente) and tentativa < EVO_TENTATIVAS:
+                self.metricas.registrar(operacao, duracao, resp.status_code, erro=True)
+                self.metricas.contar(operacao, "repeticoes")
+                log.warning("%s respondeu %s (tentativa %s)", operacao, resp.status_code, tentativa, extra={"evento": "evolution.repeticao", "instancia": instancia})
+                time.sleep(calcular_espera(tentativa, resp.headers))
+                continue
+            self._finalizar(c, operacao, duracao, resp.status_code)
+            return self._conferir_envio(operacao, resp, idempotente)
+
+    def _sondar_versao(self):
+        try:
+            resp = self._chamar("versao_servidor", "GET", "/")
+        except EvolutionErro:
+            resp = None
+        self.descoberta.registrar_versao(resp)
+
+    def descobrir(self, operacao, instancia, json=None, timeout=None):
+        """
+        Chama `operacao` pela rota que este servidor tem (ROTAS_CANDIDATAS).
+        A vencedora fica em cache; 404/405 nela faz sondar as outras de novo.
+        Devolve a resposta (ou a do último 404 se nenhuma rota existir).
+        """
+        resp = None
+        for metodo, modelo in self.descoberta.candidatas(operacao):
+            corpo = json if metodo != "GET" else None
+            resp = self._chamar(operacao, metodo, modelo.format(instancia=instancia), instancia, corpo, timeout=timeout)
+            if resp.status_code in ROTA_INEXISTENTE:
+                self.descoberta.esquecer(operacao, (metodo, modelo))
+                continue
+            self.descoberta.confirmar(operacao, (metodo, modelo))
+            return resp
+        return resp
+
+    def aguardar_instancia(self, instancia, limite_s=EVO_ESPERA_MAX_S):
+        """Depois do create: espera a instância responder connectionState (em vez de sleep fixo)."""
+        def pronta():
+            try: return self.connection_state(instancia).status_code == 200
+            except EvolutionErro: return False
+        return aguardar_pronto(pronta, limite_s)
+
+    def fechar(self):
+        self.sessao.close()
+
+
+# ==========================================================
+# CLIENTE ASSÍNCRONO (webhook, campanhas)
+# ==========================================================
+class ClienteEvolutionAsync(_NucleoEvolution):
+    def __init__(self, base_url=None, api_key=None, max_conexoes=EVO_MAX_CONEXOES, metricas=None):
+        if not TEM_HTTPX:
+            raise RuntimeError("Cliente assíncrono da Evolution exige 'httpx' (pip install httpx).")
+        super().__init__(base_url, api_key, metricas)
+        self.cliente = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={"apikey": self.api_key},
+            timeout=httpx.Timeout(EVO_TIMEOUT_PADRAO, connect=5.0),
+            limits=httpx.Limits(max_connections=max_conexoes, max_keepalive_connections=max_conexoes),
+        )
+
+    async def _chamar(self, operacao, metodo, caminho, instancia=None, json=None, idempotente=True, timeout=None):
+        if callable(json):
+            if self.descoberta.precisa_versao(): await self._sondar_versao()
+            json = json(self.descoberta.formato())
+        c, teste = self._liberar(operacao, instancia)
+        try:
+            return await self._tentar(c, operacao, metodo, caminho, instancia, json, idempotente, timeout)
+        finally:
+            if teste: c.soltar_teste()
+
+    async def _tentar(self, c, operacao, metodo, caminho, instancia, json, idempotente, timeout):
+        timeout = timeout or TIMEOUTS.get(operacao, EVO_TIMEOUT_PADRAO)
+        for tentativa in range(1, EVO_TENTATIVAS + 1):
+            inicio = time.perf_counter()
+            try:
+                resp = await self.cliente.request(metodo, caminho, json=json, timeout=timeout, headers=self._cabecalhos())
+            except httpx.HTTPError as e:
+                duracao = time.perf_counter() - inicio
+                self.metricas.registrar(operacao, duracao, erro=True)
+                seguro = idempotente or isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+                if seguro and tentativa < EVO_TENTATIVAS:
+                    self.metricas.contar(operacao, "repeticoes")
+                    log.warning("%s falhou (tentativa %s): %s", operacao, tentativa, e, extra={"evento": "evolution.repeticao", "instancia": instancia})
+                    await asyncio.sleep(calcular_espera(tentativa))
+                    continue
+                c.falha()
+                raise EvolutionErro(f"Evolution {operacao}: {e}") from e
+
+            duracao = time.perf_counter() - inicio
+            if self._repetir_status(resp.status_code, idempotente) and tentativa < EVO_TENTATIVAS:
+                self.metricas.registrar(operacao, duracao, resp.status_code, erro=True)
+                self.metricas.contar(operacao, "repeticoes")
+                log.warning("%s respondeu %s (tentativa %s)", operacao, resp.status_code, tentativa, extra={"evento": "evolution.repeticao", "instancia": instancia})
+                await asyncio.sleep(calcular_espera(tentativa, resp.headers))
+                continue
+            self._finalizar(c, operacao, duracao, resp.status_code)
+            return self._conferir_envio(operacao, resp, idempotente)
+
+    async def _sondar_versao(self):
+        try:
+            resp = await self._chamar("versao_servidor", "GET", "/")
+        except EvolutionErro:
+            resp = None
+        self.descoberta.registrar_versao(resp)
+
+    async def descobrir(self, operacao, instancia, json=None, timeout=None):
+        """Igual ao ClienteEvolution.descobrir (mesmo cache de rotas)."""
+        resp = None
+        for metodo, modelo in self.descoberta.candidatas(operacao):
+            corpo = json if metodo != "GET" else None
+            resp = await self._chamar(operacao, metodo, modelo.format(instancia=instancia), instancia, corpo, timeout=timeout)
+            if resp.status_code in ROTA_INEXISTENTE:
+                self.descoberta.esquecer(operacao, (metodo, modelo))
+                continue
+            self.descoberta.confirmar(operacao, (metodo, modelo))
+            return resp
+        return resp
+
+    async def fechar(self):
+        await self.cliente.aclose()
+
+
+# ==========================================================
+# INSTÂNCIAS DO PROCESSO
+# ==========================================================
+_sync = None
+_async = None
+
+
+def evolution_sync():
+    global _sync
+    if _sync is None: _sync = ClienteEvolution()
+    return _sync
+
+
+def evolution_async():
+    global _async
+    if _async is None: _async = ClienteEvolutionAsync()
+    return _async
+
+
+async def fechar_clientes_evolution():
+    global _sync, _async
+    if _async is not None:
+        await _async.fechar()
+        _async = None
+    if _sync is not None:
+        _sync.fechar()
+        _sync = None
+
+
+def estatisticas_evolution():
+    with _circuitos_trava:
+        descobertas = {url or "(padrão)": d.estatisticas() for url, d in _descobertas.items()}
+    return {"endpoints": metricas_evolution.estatisticas(), "circuitos": estado_circuitos(), "servidores": descobertas}
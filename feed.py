@@ -0,0 +1,260 @@
+# ==========================================================
+# 📡 FEED DE MUDANÇAS POR INSTÂNCIA (SSE / LONG-POLL)
+# ==========================================================
+# Em vez do painel ficar perguntando "mudou alguma coisa?" a cada poucos
+# segundos, as rotas que escrevem publicam um evento:
+#   ticket_novo       -> atendimento aberto / reaberto
+#   mensagem          -> mensagem recebida (webhook) ou enviada (manual)
+#   ticket_encerrado  -> atendimento finalizado
+#
+# Cada instância tem um contador de versão (feed_versao). O incremento
+# trava a linha da instância até o COMMIT, então a ordem das versões é a
+# ordem em que os eventos ficam visíveis — "me dá o que veio depois da
+# versão N" nunca pula evento.
+#
+# O pg_notify no mesmo comando acorda todos os workers (LISTEN); cada um
+# guarda os últimos FEED_BUFFER eventos das instâncias que alguém está
+# acompanhando e responde o long-poll / SSE direto da memória.
+# ==========================================================
+import os
+import json
+import asyncio
+from collections import deque
+
+from logs import obter_logger
+
+log = obter_logger("feed")
+
+FEED_BUFFER = int(os.getenv("FEED_BUFFER", 500))                # eventos por instância em memória
+FEED_ESPERA_MAX_S = float(os.getenv("FEED_ESPERA_MAX_S", 25))   # long-poll
+FEED_VERIFICAR_S = float(os.getenv("FEED_VERIFICAR_S", 5))      # rede de segurança se um NOTIFY se perder
+FEED_RETENCAO_H = int(os.getenv("FEED_RETENCAO_H", 24))
+
+CANAL_FEED = "feed_eventos"
+
+DDL_FEED = """
+    CREATE TABLE IF NOT EXISTS feed_versao (
+        instancia VARCHAR(100) PRIMARY KEY,
+        versao BIGINT NOT NULL DEFAULT 0
+    );
+
+    CREATE TABLE IF NOT EXISTS feed_eventos (
+        instancia VARCHAR(100) NOT NULL,
+        versao BIGINT NOT NULL,
+        tipo VARCHAR(30) NOT NULL,
+        remote_jid VARCHAR(100),
+        dados JSONB,
+        criado_em TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (instancia, versao)
+    );
+    CREATE INDEX IF NOT EXISTS idx_feed_eventos_criado ON feed_eventos (criado_em);
+"""
+
+# Um comando só: versão + evento + NOTIFY
+_SQL_PUBLICAR = """
+    WITH v AS (
+        INSERT INTO feed_versao (instancia, versao) VALUES ({p1}, 1)
+        ON CONFLICT (instancia) DO UPDATE SET versao = feed_versao.versao + 1
+        RETURNING versao
+    ), e AS (
+        INSERT INTO feed_eventos (instancia, versao, tipo, remote_jid, dados)
+        SELECT {p1}, versao, {p2}, {p3}, {p4}::jsonb FROM v
+        RETURNING versao
+    )
+    SELECT versao, pg_notify('feed_eventos', {p1} || ':' || versao) FROM e
+"""
+SQL_PUBLICAR = _SQL_PUBLICAR.format(p1="%(instancia)s", p2="%(tipo)s", p3="%(remote_jid)s", p4="%(dados)s")
+SQL_PUBLICAR_ASYNC = _SQL_PUBLICAR.format(p1="$1::varchar", p2="$2", p3="$3", p4="$4")
+
+
+def publicar_evento(cur, instancia, tipo, remote_jid=None, dados=None):
+    """
+    Cursor psycopg2, DENTRO da transação da rota (chamar perto do commit:
+    a linha da instância em feed_versao fica travada até lá).
+    """
+    cur.execute(SQL_PUBLICAR, {"instancia": instancia, "tipo": tipo, "remote_jid": remote_jid,
+                               "dados": json.dumps(dados or {}, default=str)})
+
+
+async def publicar_evento_async(conn, instancia, tipo, remote_jid=None, dados=None):
+    """conn: conexão ou pool asyncpg."""
+    return await conn.fetchval(SQL_PUBLICAR_ASYNC, instancia, tipo, remote_jid, json.dumps(dados or {}, default=str))
+
+
+def _formatar(linha):
+    return {
+        "versao": linha['versao'],
+        "tipo": linha['tipo'],
+        "remote_jid": linha['remote_jid'],
+        "dados": json.loads(linha['dados']) if isinstance(linha['dados'], str) else linha['dados'],
+        "criado_em": str(linha['criado_em']),
+    }
+
+
+class AnelInstancia:
+    """Últimos eventos de uma instância + sinal para quem está esperando."""
+
+    def __init__(self, versao):
+        self.versao = versao
+        self.eventos = deque(maxlen=FEED_BUFFER)
+        self.sinal = asyncio.Event()
+        self.trava = asyncio.Lock()
+
+    def menor_versao(self):
+        return self.eventos[0]['versao'] if self.eventos else self.versao + 1
+
+    def acordar(self):
+        # Troca o Event: quem já acordou não acorda de novo no próximo ciclo
+        sinal, self.sinal = self.sinal, asyncio.Event()
+        sinal.set()
+
+
+class FeedMudancas:
+    def __init__(self, pool):
+        self.pool = pool
+        self._aneis = {}
+        self._conn_listen = None
+        self._tarefas = []
+
+        # Métricas
+        self.notificacoes = 0
+        self.esperas = 0
+        self.conexoes_sse = 0
+
+    async def iniciar(self):
+        # Tabelas: migração 007 (migracoes.py)
+        self._conn_listen = await self.pool.acquire()
+        await self._conn_listen.add_listener(CANAL_FEED, self._ao_notificar)
+        self._tarefas = [asyncio.create_task(self._loop_verificacao()), asyncio.create_task(self._loop_limpeza())]
+
+    async def parar(self):
+        for t in self._tarefas: t.cancel()
+        await asyncio.gather(*self._tarefas, return_exceptions=True)
+        self._tarefas = []
+        if self._conn_listen is not None:
+            try: await self._conn_listen.remove_listener(CANAL_FEED, self._ao_notificar)
+            except Exception: pass
+            await self.pool.release(self._conn_listen)
+            self._conn_listen = None
+        for anel in self._aneis.values(): anel.acordar()
+
+    # --- ENTRADA: NOTIFY ---
+    def _ao_notificar(self, conn, pid, canal, payload):
+        self.notificacoes += 1
+        instancia, _, versao = payload.rpartition(":")
+        anel = self._aneis.get(instancia)
+        if anel is not None and int(versao) > anel.versao:
+            asyncio.get_running_loop().create_task(self._atualizar(instancia))
+
+    async def _atualizar(self, instancia):
+        anel = self._aneis.get(instancia)
+        if anel is None: return
+        async with anel.trava:
+            linhas = await self.pool.fetch("""
+                SELECT versao, tipo, remote_jid, dados, criado_em FROM feed_eventos
+                WHERE instancia = $1 AND versao > $2 ORDER BY versao
+            """, instancia, anel.versao)
+            if not linhas: return
+            for linha in linhas:
+                anel.eventos.append(_formatar(linha))
+            anel.versao = linhas[-1]['versao']
+        anel.acordar()
+
+    async def _anel(self, instancia):
+        anel = self._aneis.get(instancia)
+        if anel is None:
+            versao = await self.pool.fetchval("SELECT versao FROM feed_versao WHERE instancia = $1", instancia) or 0
+            anel = self._aneis.setdefault(instancia, AnelInstancia(versao))
+        return anel
+
+    async def _loop_verificacao(self):
+        # Se a conexão do LISTEN cair, nenhum NOTIFY chega: confere as versões de tempos em tempos
+        while True:
+            await asyncio.sleep(FEED_VERIFICAR_S)
+            try:
+                if self._conn_listen is not None and self._conn_listen.is_closed():
+                    # A conexão morta volta para o pool (que a substitui); senão a vaga se perde
+                    velha, self._conn_listen = self._conn_listen, None
+                    try: await self.pool.release(velha)
+                    except Exception: pass
+                    self._conn_listen = await self.pool.acquire()
+                    await self._conn_listen.add_listener(CANAL_FEED, self._ao_notificar)
+                if not self._aneis: continue
+                linhas = await self.pool.fetch(
+                    "SELECT instancia, versao FROM feed_versao WHERE instancia = ANY($1::varchar[])", list(self._aneis))
+                for r in linhas:
+                    anel = self._aneis.get(r['instancia'])
+                    if anel and r['versao'] > anel.versao:
+                        await self._atualizar(r['instancia'])
+            except Exception as e:
+                log.warning("Verificação do feed falhou: %s", e)
+
+    async def _loop_limpeza(self):
+        while True:
+            await asyncio.sleep(600)
+            try:
+                await self.pool.execute(
+                    "DELETE FROM feed_eventos WHERE criado_em < NOW() - make_interval(hours => $1)", FEED_RETENCAO_H)
+            except Exception as e:
+                log.warning("Limpeza do feed falhou: %s", e)
+
+    # --- SAÍDA ---
+    async def obter(self, instancia, apos=None, espera_s=0.0):
+        """
+        Eventos com versão > apos. Sem apos: só a versão atual (para o
+        cliente começar a acompanhar). Se não houver nada novo, espera até
+        espera_s segundos por um evento.
+        """
+        anel = await self._anel(instancia)
+        if apos is None:
+            return {"versao": anel.versao, "eventos": []}
+
+        if apos >= anel.versao and espera_s > 0:
+            self.esperas += 1
+            sinal = anel.sinal
+            try:
+                await asyncio.wait_for(sinal.wait(), timeout=min(espera_s, FEED_ESPERA_MAX_S))
+            except asyncio.TimeoutError:
+                pass
+
+        if apos >= anel.versao:
+            return {"versao": anel.versao, "eventos": []}
+
+        if apos + 1 >= anel.menor_versao():
+            eventos = [e for e in anel.eventos if e['versao'] > apos]
+        else:
+            # Cliente muito atrasado: o que já saiu da memória vem do banco
+            linhas = await self.pool.fetch("""
+                SELECT versao, tipo, remote_jid, dados, criado_em FROM feed_eventos
+                WHERE instancia = $1 AND versao > $2 ORDER BY versao LIMIT $3
+            """, instancia, apos, FEED_BUFFER)
+            eventos = [_formatar(l) for l in linhas]
+
+        return {"versao": eventos[-1]['versao'] if eventos else anel.versao, "eventos": eventos}
+
+    async def transmitir(self, instancia, apos, desconectado):
+        """Gerador SSE: 'id' = versão (o navegador reenvia em Last-Event-ID ao reconectar)."""
+        self.conexoes_sse += 1
+        try:
+            if apos is None:
+                apos = (await self.obter(instancia))["versao"]
+            yield f"retry: 2000\nevent: versao\ndata: {json.dumps({'versao': apos})}\n\n"
+            while not await desconectado():
+                res = await self.obter(instancia, apos, espera_s=15)
+                if not res["eventos"]:
+                    yield ": ping\n\n"   # mantém a conexão viva em proxies
+                    continue
+                for ev in res["eventos"]:
+                    yield f"id: {ev['versao']}\nevent: {ev['tipo']}\ndata: {json.dumps(ev, ensure_ascii=False)}\n\n"
+                apos = res["versao"]
+        finally:
+            self.conexoes_sse -= 1
+
+    def estatisticas(self):
+        return {
+            "instancias_acompanhadas": len(self._aneis),
+            "eventos_em_memoria": sum(len(a.eventos) for a in self._aneis.values()),
+            "notificacoes": self.notificacoes,
+            "esperas_long_poll": self.esperas,
+            "conexoes_sse": self.conexoes_sse,
+        }
@@ -0,0 +1,503 @@
+# ==========================================================
+# 📥 FILA DE ENTRADA DO WEBHOOK (INBOX DURÁVEL)
+# ==========================================================
+# O /webhook/whatsapp só valida e grava o evento aqui (ACK em milissegundos).
+# Consumidores em segundo plano processam depois, respeitando a ORDEM por
+# conversa (instancia + remote_jid): só a "cabeça" da fila de cada conversa
+# pode ser processada; a próxima mensagem espera a anterior terminar.
+#
+# Backends:
+#   WEBHOOK_FILA=postgres  -> tabela webhook_inbox (durável, vários workers)  [padrão]
+#   WEBHOOK_FILA=memoria   -> filas em memória (dev/testes; perde tudo no restart)
+#
+# Falhas: nova tentativa com backoff exponencial; depois de
+# WEBHOOK_MAX_TENTATIVAS o evento vai para 'morta' (dead-letter).
+#
+# Prazo: o evento 'processando' tem dono (o worker que pegou) e o prazo
+# (travado_ate) é renovado a cada WEBHOOK_LEASE_S/3 enquanto o handler
+# roda; handler lento não faz o evento vencer e rodar de novo noutro
+# worker. Concluir/falhar só grava se o evento ainda for do dono. Handler
+# que passa de WEBHOOK_HANDLER_TIMEOUT_S é cancelado e conta como falha
+# (senão seguraria a conversa e o lote do consumidor para sempre).
+#
+# Reentrega: a Evolution reenvia o messages.upsert quando o ACK demora —
+# justo quando estamos lentos. Cada mensagem é identificada por
+# (instancia, data.key.id): um conjunto em memória com TTL (Deduplicador)
+# descarta a repetição antes de qualquer I/O, e o índice único em
+# webhook_inbox (instancia, id_mensagem) pega a que escapar dele (outro
+# worker, restart). Vale enquanto o evento estiver na inbox
+# (WEBHOOK_RETENCAO_H depois de processado).
+# ==========================================================
+import os
+import json
+import time
+import uuid
+import socket
+import random
+import asyncio
+import zlib
+from collections import deque
+
+from telemetria import registro
+from cache_ttl import CacheTTL
+from logs import obter_logger, definir_correlacao, restaurar_correlacao
+
+log = obter_logger("fila_webhook")
+
+WEBHOOK_FILA = os.getenv("WEBHOOK_FILA", "postgres")
+WEBHOOK_PARTICOES = int(os.getenv("WEBHOOK_PARTICOES", 8))
+WEBHOOK_CONSUMIDORES = int(os.getenv("WEBHOOK_CONSUMIDORES", 4))
+WEBHOOK_LOTE = int(os.getenv("WEBHOOK_LOTE", 20))
+WEBHOOK_MAX_TENTATIVAS = int(os.getenv("WEBHOOK_MAX_TENTATIVAS", 5))
+WEBHOOK_LEASE_S = int(os.getenv("WEBHOOK_LEASE_S", 120))           # Evento "processando" há mais que isso volta para a fila
+WEBHOOK_HANDLER_TIMEOUT_S = float(os.getenv("WEBHOOK_HANDLER_TIMEOUT_S", 90))   # Handler travado vira falha (com retry)
+WEBHOOK_RETENCAO_H = int(os.getenv("WEBHOOK_RETENCAO_H", 24))       # Processados ficam guardados por X horas
+WEBHOOK_DEDUP_TTL_S = int(os.getenv("WEBHOOK_DEDUP_TTL_S", 900))      # Quanto tempo um id fica na memória
+WEBHOOK_DEDUP_MAX = int(os.getenv("WEBHOOK_DEDUP_MAX", 100000))       # Teto de ids em memória (por worker)
+
+CANAL_NOTIFY = "webhook_inbox"
+
+DDL_INBOX = """
+    CREATE TABLE IF NOT EXISTS webhook_inbox (
+        id BIGSERIAL PRIMARY KEY,
+        instancia VARCHAR(100) NOT NULL,
+        remote_jid VARCHAR(100) NOT NULL,
+        particao SMALLINT NOT NULL,
+        payload JSONB NOT NULL,
+        status VARCHAR(15) NOT NULL DEFAULT 'pendente',
+        tentativas INTEGER NOT NULL DEFAULT 0,
+        proxima_tentativa TIMESTAMP NOT NULL DEFAULT NOW(),
+        travado_ate TIMESTAMP,
+        erro TEXT,
+        recebido_em TIMESTAMP NOT NULL DEFAULT NOW(),
+        processado_em TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_webhook_inbox_cabeca
+        ON webhook_inbox (particao, instancia, remote_jid, id)
+        WHERE status IN ('pendente', 'processando');
+    CREATE INDEX IF NOT EXISTS idx_webhook_inbox_status ON webhook_inbox (status, recebido_em);
+"""
+
+# Migração 011: id da mensagem do WhatsApp (NULL = evento sem id, nunca conflita)
+DDL_IDEMPOTENCIA = """
+    ALTER TABLE webhook_inbox ADD COLUMN IF NOT EXISTS id_mensagem VARCHAR(128);
+    CREATE UNIQUE INDEX IF NOT EXISTS uk_webhook_inbox_mensagem ON webhook_inbox (instancia, id_mensagem);
+"""
+
+# Migração 017: quem pegou o evento (o prazo só é renovado/encerrado pelo dono)
+DDL_INBOX_DONO = """
+    ALTER TABLE webhook_inbox ADD COLUMN IF NOT EXISTS dono VARCHAR(80);
+"""
+
+duplicatas_descartadas = registro.contador(
+    "webhook_duplicatas_total", "Reentregas do webhook descartadas (memoria = antes de I/O, banco = índice único).", ("camada",))
+
+
+def calcular_particao(instancia, remote_jid):
+    return zlib.crc32(f"{instancia}|{remote_jid}".encode()) % WEBHOOK_PARTICOES
+
+
+def calcular_backoff(tentativas):
+    # 2s, 4s, 8s... (máx 5 min) com jitter para não sincronizar retries
+    base = min(300, 2 ** tentativas)
+    return base * random.uniform(0.8, 1.2)
+
+
+# ==========================================================
+# BACKEND POSTGRES (DURÁVEL)
+# ==========================================================
+class FilaPostgres:
+    def __init__(self, pool):
+        self.pool = pool
+        self._acordar = asyncio.Event()
+        self._conn_listen = None
+        self._ao_notificar = lambda *_: self._acordar.set()
+        self.dono = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    async def iniciar(self):
+        # Tabela: migrações 002, 011 e 017 (migracoes.py)
+        # Conexão dedicada para LISTEN (acorda os consumidores na hora que chega evento)
+        self._conn_listen = await self.pool.acquire()
+        await self._conn_listen.add_listener(CANAL_NOTIFY, self._ao_notificar)
+
+    async def parar(self):
+        if self._conn_listen is not None:
+            try: await self._conn_listen.remove_listener(CANAL_NOTIFY, self._ao_notificar)
+            except Exception: pass
+            await self.pool.release(self._conn_listen)
+            self._conn_listen = None
+
+    async def enfileirar(self, instancia, remote_jid, payload, id_mensagem=None):
+        """INSERT + NOTIFY numa ida só ao banco. False = (instancia, id_mensagem) já estava na inbox."""
+        novo = await self.pool.fetchval(f"""
+            WITH novo AS (
+                INSERT INTO webhook_inbox (instancia, remote_jid, particao, payload, id_mensagem)
+                VALUES ($1, $2, $3, $4::jsonb, $5)
+                ON CONFLICT (instancia, id_mensagem) DO NOTHING
+                RETURNING id
+            )
+            SELECT id, pg_notify('{CANAL_NOTIFY}', id::text) FROM novo
+        """, instancia, remote_jid, calcular_particao(instancia, remote_jid), json.dumps(payload), id_mensagem)
+        return novo is not None
+
+    async def reivindicar(self, particao, lote):
+        # Pega a cabeça de cada conversa; só reivindica se ela estiver pendente e "vencida".
+        # O "AND w.status = 'pendente'" é reavaliado na trava da linha: dois
+        # consumidores nunca pegam o mesmo evento.
+        linhas = await self.pool.fetch(f"""
+            WITH cabecas AS (
+                SELECT DISTINCT ON (instancia, remote_jid) id, status, proxima_tentativa
+                FROM webhook_inbox
+                WHERE particao = $1 AND status IN ('pendente', 'processando')
+                ORDER BY instancia, remote_jid, id
+            ), escolhidos AS (
+                SELECT id FROM cabecas
+                WHERE status = 'pendente' AND proxima_tentativa <= NOW()
+                ORDER BY id LIMIT $2
+            )
+            UPDATE webhook_inbox w
+            SET status = 'processando', dono = $3, travado_ate = NOW() + INTERVAL '{WEBHOOK_LEASE_S} seconds'
+            FROM escolhidos e
+            WHERE w.id = e.id AND w.status = 'pendente'
+            RETURNING w.id, w.instancia, w.remote_jid, w.payload, w.tentativas, w.recebido_em
+        """, particao, lote, self.dono)
+        return [{
+            "id": r['id'], "instancia": r['instancia'], "remote_jid": r['remote_jid'],
+            "payload": json.loads(r['payload']), "tentativas": r['tentativas'],
+            "recebido_em": r['recebido_em'].timestamp(),
+        } for r in linhas]
+
+    async def renovar(self, evento):
+        """Prazo cheio de novo, se o evento ainda for nosso. False = perdemos o evento."""
+        return await self.pool.fetchval(f"""
+            UPDATE webhook_inbox SET travado_ate = NOW() + INTERVAL '{WEBHOOK_LEASE_S} seconds'
+            WHERE id = $1 AND dono = $2 AND status = 'processando'
+            RETURNING id
+        """, evento['id'], self.dono) is not None
+
+    async def concluir(self, evento):
+        await self.pool.execute("""
+            UPDATE webhook_inbox SET status = 'processado', processado_em = NOW(), travado_ate = NULL, dono = NULL
+            WHERE id = $1 AND dono = $2 AND status = 'processando'
+        """, evento['id'], self.dono)
+
+    async def falhar(self, evento, erro):
+        tentativas = evento['tentativas'] + 1
+        if tentativas >= WEBHOOK_MAX_TENTATIVAS:
+            await self.pool.execute("""
+                UPDATE webhook_inbox SET status = 'morta', tentativas = $2, erro = $3, travado_ate = NULL, dono = NULL
+                WHERE id = $1 AND dono = $4 AND status = 'processando'
+            """, evento['id'], tentativas, erro, self.dono)
+            return False
+        await self.pool.execute("""
+            UPDATE webhook_inbox
+            SET status = 'pendente', tentativas = $2, erro = $3, travado_ate = NULL, dono = NULL,
+                proxima_tentativa = NOW() + make_interval(secs => $4)
+            WHERE id = $1 AND dono = $5 AND status = 'processando'
+        """, evento['id'], tentativas, erro, calcular_backoff(tentativas), self.dono)
+        return True
+
+    async def aguardar(self, timeout):
+        try:
+            await asyncio.wait_for(self._acordar.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._acordar.clear()
+
+    async def manutencao(self):
+        # Devolve eventos de consumidores que morreram no meio (conta como
+        # tentativa: evento que derruba o worker acaba na dead-letter) e limpa os antigos
+        await self.pool.execute(f"""
+            UPDATE webhook_inbox
+            SET tentativas = tentativas + 1, travado_ate = NULL, dono = NULL,
+                status = CASE WHEN tentativas + 1 >= {WEBHOOK_MAX_TENTATIVAS} THEN 'morta' ELSE 'pendente' END,
+                erro = CASE WHEN tentativas + 1 >= {WEBHOOK_MAX_TENTATIVAS} THEN 'prazo vencido no processamento' ELSE erro END
+            WHERE status = 'processando' AND travado_ate < NOW()
+        """)
+        await self.pool.execute(
+            f"DELETE FROM webhook_inbox WHERE status = 'processado' AND processado_em < NOW() - INTERVAL '{WEBHOOK_RETENCAO_H} hours'")
+
+    async def estatisticas(self):
+        r = await self.pool.fetchrow("""
+            SELECT
+                COUNT(*) FILTER (WHERE status = 'pendente') AS pendentes,
+                COUNT(*) FILTER (WHERE status = 'processando') AS processando,
+                COUNT(*) FILTER (WHERE status = 'morta') AS mortas,
+                COALESCE(EXTRACT(EPOCH FROM NOW() - MIN(recebido_em) FILTER (WHERE status IN ('pendente', 'processando'))), 0) AS lag_s
+            FROM webhook_inbox
+            WHERE status <> 'processado'
+        """)
+        return {"pendentes": r['pendentes'], "processando": r['processando'], "mortas": r['mortas'], "lag_s": round(float(r['lag_s']), 3)}
+
+    async def listar_mortas(self, limite=50):
+        linhas = await self.pool.fetch(
+            "SELECT id, instancia, remote_jid, tentativas, erro, recebido_em FROM webhook_inbox WHERE status = 'morta' ORDER BY id DESC LIMIT $1",
+            limite)
+        return [{**dict(r), "recebido_em": str(r['recebido_em'])} for r in linhas]
+
+    async def reprocessar_mortas(self, ids=None):
+        if ids:
+            res = await self.pool.execute(
+                "UPDATE webhook_inbox SET status = 'pendente', tentativas = 0, proxima_tentativa = NOW() WHERE status = 'morta' AND id = ANY($1::bigint[])", ids)
+        else:
+            res = await self.pool.execute(
+                "UPDATE webhook_inbox SET status = 'pendente', tentativas = 0, proxima_tentativa = NOW() WHERE status = 'morta'")
+        self._acordar.set()
+        return int(res.split()[-1])
+
+
+# ==========================================================
+# BACKEND EM MEMÓRIA (DEV / TESTES)
+# ==========================================================
+class FilaMemoria:
+    def __init__(self, max_mortas=1000):
+        self._filas = {}          # (instancia, jid) -> deque de eventos
+        self._ocupadas = set()    # conversas com evento em processamento
+        self._mortas = deque(maxlen=max_mortas)
+        self._acordar = asyncio.Event()
+        self._seq = 0
+        self._ids = Deduplicador(ttl_s=WEBHOOK_RETENCAO_H * 3600)   # faz o papel do índice único
+
+    async def iniciar(self): pass
+    async def parar(self): pass
+    async def manutencao(self): pass
+    async def renovar(self, evento): return True     # sem prazo: o evento só sai pelo concluir/falhar
+
+    async def enfileirar(self, instancia, remote_jid, payload, id_mensagem=None):
+        if id_mensagem and not self._ids.marcar(instancia, id_mensagem):
+            return False
+        self._seq += 1
+        chave = (instancia, remote_jid)
+        self._filas.setdefault(chave, deque()).append({
+            "id": self._seq, "instancia": instancia, "remote_jid": remote_jid, "payload": payload,
+            "tentativas": 0, "recebido_em": time.time(), "proxima_tentativa": 0.0,
+            "particao": calcular_particao(instancia, remote_jid),
+        })
+        self._acordar.set()
+        return True
+
+    async def reivindicar(self, particao, lote):
+        agora = time.time()
+        escolhidos = []
+        for chave, fila in self._filas.items():
+            if len(escolhidos) >= lote: break
+            if not fila or chave in self._ocupadas: continue
+            cabeca = fila[0]
+            if cabeca['particao'] != particao or cabeca['proxima_tentativa'] > agora: continue
+            self._ocupadas.add(chave)
+            escolhidos.append(cabeca)
+        return escolhidos
+
+    def _soltar(self, evento, remover):
+        chave = (evento['instancia'], evento['remote_jid'])
+        self._ocupadas.discard(chave)
+        fila = self._filas.get(chave)
+        if remover and fila:
+            fila.popleft()
+        if fila is not None and not fila:
+            del self._filas[chave]
+
+    async def concluir(self, evento):
+        self._soltar(evento, remover=True)
+
+    async def falhar(self, evento, erro):
+        evento['tentativas'] += 1
+        evento['erro'] = erro
+        if evento['tentativas'] >= WEBHOOK_MAX_TENTATIVAS:
+            self._mortas.append(evento)
+            self._soltar(evento, remover=True)
+            return False
+        evento['proxima_tentativa'] = time.time() + calcular_backoff(evento['tentativas'])
+        self._soltar(evento, remover=False)
+        return True
+
+    async def aguardar(self, timeout):
+        try:
+            await asyncio.wait_for(self._acordar.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._acordar.clear()
+
+    async def estatisticas(self):
+        pendentes = sum(len(f) for f in self._filas.values())
+        mais_antigo = min((f[0]['recebido_em'] for f in self._filas.values() if f), default=None)
+        return {
+            "pendentes": pendentes,
+            "processando": len(self._ocupadas),
+            "mortas": len(self._mortas),
+            "lag_s": round(time.time() - mais_antigo, 3) if mais_antigo else 0.0,
+        }
+
+    async def listar_mortas(self, limite=50):
+        return [{k: e.get(k) for k in ("id", "instancia", "remote_jid", "tentativas", "erro")} for e in list(self._mortas)[-limite:]]
+
+    async def reprocessar_mortas(self, ids=None):
+        voltaram = [e for e in self._mortas if not ids or e['id'] in ids]
+        for e in voltaram:
+            self._mortas.remove(e)
+            e['tentativas'] = 0
+            e['proxima_tentativa'] = 0.0
+            self._filas.setdefault((e['instancia'], e['remote_jid']), deque()).append(e)
+        self._acordar.set()
+        return len(voltaram)
+
+
+# ==========================================================
+# IDEMPOTÊNCIA (REENTREGAS DA EVOLUTION)
+# ==========================================================
+class Deduplicador:
+    """Ids de mensagem vistos há menos de ttl_s (CacheTTL limitado a max_itens)."""
+
+    def __init__(self, ttl_s=WEBHOOK_DEDUP_TTL_S, max_itens=WEBHOOK_DEDUP_MAX):
+        self._vistos = CacheTTL(ttl_s, max_itens)
+        self.duplicatas_memoria = 0
+        self.duplicatas_banco = 0
+
+    def repetido(self, instancia, id_mensagem):
+        """True = já passou por aqui: descartar sem tocar no banco."""
+        if not self._vistos.contem((instancia, id_mensagem)): return False
+        self.duplicatas_memoria += 1
+        duplicatas_descartadas.inc(camada="memoria")
+        return True
+
+    def marcar(self, instancia, id_mensagem):
+        """Guarda o id (depois de enfileirar). False = já estava."""
+        return self._vistos.reservar((instancia, id_mensagem))
+
+    def contar_banco(self):
+        # Escapou da memória (outro worker / restart) e bateu no índice único
+        self.duplicatas_banco += 1
+        duplicatas_descartadas.inc(camada="banco")
+
+    def estatisticas(self):
+        return {
+            "duplicatas_memoria": self.duplicatas_memoria,
+            "duplicatas_banco": self.duplicatas_banco,
+            "cache": self._vistos.estatisticas(),
+        }
+
+
+# ==========================================================
+# CONSUMIDORES
+# ==========================================================
+class ConsumidorFila:
+    """
+    Sobe N tarefas asyncio que drenam a fila. Cada rodada pega as cabeças de
+    uma partição (conversas diferentes) e processa em paralelo; mensagens da
+    MESMA conversa nunca rodam ao mesmo tempo.
+    """
+
+    def __init__(self, fila, processador, consumidores=WEBHOOK_CONSUMIDORES, lote=WEBHOOK_LOTE):
+        self.fila = fila
+        self.processador = processador
+        self.consumidores = max(1, consumidores)
+        self.lote = lote
+        self._tarefas = []
+        self._rodando = False
+
+        # Métricas
+        self.processados = 0
+        self.falhas = 0
+        self.mortas = 0
+        self.perdidos = 0        # prazo venceu e o evento voltou para a fila no meio do handler
+        self.ultimo_lag_s = 0.0
+        self._lag_total = 0.0
+
+    async def iniciar(self):
+        await self.fila.iniciar()
+        self._rodando = True
+        for k in range(self.consumidores):
+            self._tarefas.append(asyncio.create_task(self._loop(k)))
+        self._tarefas.append(asyncio.create_task(self._loop_manutencao()))
+
+    async def parar(self):
+        self._rodando = False
+        for t in self._tarefas: t.cancel()
+        await asyncio.gather(*self._tarefas, return_exceptions=True)
+        self._tarefas = []
+        await self.fila.parar()
+
+    async def _processar(self, evento):
+        # Mesmo id de correlação do POST que enfileirou (cada evento roda na sua task)
+        payload = evento['payload']
+        token = definir_correlacao(payload.get('_correlacao') if isinstance(payload, dict) else None)
+        prazo = asyncio.create_task(self._manter_prazo(evento))
+        try:
+            await asyncio.wait_for(self.processador(payload), WEBHOOK_HANDLER_TIMEOUT_S)
+        except Exception as e:
+            self.falhas += 1
+            if not await self.fila.falhar(evento, f"{type(e).__name__}: {e}"):
+                self.mortas += 1
+                log.error("Evento foi para dead-letter: %s", e, extra={"evento": "webhook.dead_letter", "id_evento": evento['id'], "remote_jid": evento['remote_jid']})
+            else:
+                log.warning("Evento falhou, vai tentar de novo: %s", e, extra={"evento": "webhook.falha", "id_evento": evento['id']})
+            return
+        finally:
+            prazo.cancel()
+            restaurar_correlacao(token)
+        await self.fila.concluir(evento)
+        self.processados += 1
+        self.ultimo_lag_s = time.time() - evento['recebido_em']
+        self._lag_total += self.ultimo_lag_s
+
+    async def _manter_prazo(self, evento):
+        # Handler lento (Evolution devagar, banco travado) não deixa o prazo vencer
+        while True:
+            await asyncio.sleep(WEBHOOK_LEASE_S / 3)
+            try:
+                if not await self.fila.renovar(evento):
+                    self.perdidos += 1
+                    log.warning("Evento voltou para a fila durante o processamento", extra={"evento": "webhook.prazo_perdido", "id_evento": evento['id']})
+                    return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Falha ao renovar o prazo do evento: %s", e, extra={"id_evento": evento['id']})
+
+    async def _loop(self, k):
+        # Cada consumidor começa numa partição diferente e gira por todas
+        particoes = [(k + i) % WEBHOOK_PARTICOES for i in range(WEBHOOK_PARTICOES)]
+        while self._rodando:
+            trabalhou = False
+            try:
+                for particao in particoes:
+                    eventos = await self.fila.reivindicar(particao, self.lote)
+                    if eventos:
+                        trabalhou = True
+                        await asyncio.gather(*(self._processar(ev) for ev in eventos))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Consumidor %s: erro na fila: %s", k, e)
+                await asyncio.sleep(1)
+            if not trabalhou:
+                await self.fila.aguardar(1.0)
+
+    async def _loop_manutencao(self):
+        while self._rodando:
+            try:
+                await self.fila.manutencao()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Manutenção da fila: %s", e)
+            await asyncio.sleep(60)
+
+    async def estatisticas(self):
+        return {
+            **await self.fila.estatisticas(),
+            "backend": type(self.fila).__name__,
+            "consumidores": self.consumidores,
+            "processados": self.processados,
+            "falhas": self.falhas,
+            "enviados_dead_letter": self.mortas,
+            "prazos_perdidos": self.perdidos,
+            "ultimo_lag_s": round(self.ultimo_lag_s, 3),
+            "lag_medio_s": round(self._lag_total / self.processados, 3) if self.processados else 0.0,
+        }
+
+
+def criar_fila(pool=None):
+    if WEBHOOK_FILA == "memoria":
+        return FilaMemoria()
+    return FilaPostgres(pool)
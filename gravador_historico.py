@@ -0,0 +1,263 @@
+# ==========================================================
+# ✍️ GRAVAÇÃO DO HISTÓRICO EM LOTE (WRITE-BEHIND)
+# ==========================================================
+# Cada resposta do robô (enviar_mensagem_smart) e cada envio manual
+# (/chat/salvar_manual) fazia o seu INSERT em historico_mensagens com o
+# seu commit: no pico, milhares de transações de uma linha por minuto, e
+# a latência do envio incluía a ida ao banco.
+#
+# Agora gravar() só põe a linha num buffer (sem I/O, serve para rotas
+# sync e async) e volta. Uma tarefa grava o buffer a cada HISTORICO_LOTE_MS
+# ou quando chega em HISTORICO_LOTE_MAX linhas: um INSERT multi-linha
+# (unnest) por lote, numa transação, junto com os eventos do feed das
+# linhas que pedirem (o painel só é avisado depois que a linha existe).
+#
+# data_hora = hora do INSERT (NOW() do banco), não do gravar(): o cursor
+# do chat (historico.py) anda por (data_hora, id) e só relê alguns
+# segundos para trás; lote que sai atrasado (banco fora, linhas
+# recarregadas no start) com data antiga sumiria da conversa aberta.
+# A hora do gravar() fica só na linha guardada em arquivo ("em").
+# Falha no lote: as linhas voltam para o buffer e tentam de novo. Se o
+# banco recusar o DADO (byte NUL, texto maior que a coluna...) o lote é
+# dividido ao meio até isolar a linha ruim, que vai para
+# HISTORICO_REJEITADAS — uma linha ruim não para o histórico de todos.
+# No desligamento o buffer é gravado; se o banco não aceitar, vai para
+# HISTORICO_PENDENTES (JSON por linha), que é regravado no próximo start
+# (o arquivo só é apagado depois que as linhas chegam ao banco).
+# Um kill -9 perde no máximo o que estava no buffer (< HISTORICO_LOTE_MS).
+# ==========================================================
+import os
+import glob
+import json
+import time
+import asyncio
+import threading
+
+import asyncpg
+
+from feed import publicar_evento_async
+from logs import obter_logger
+
+HISTORICO_LOTE_MS = int(os.getenv("HISTORICO_LOTE_MS", 200))
+HISTORICO_LOTE_MAX = int(os.getenv("HISTORICO_LOTE_MAX", 500))
+HISTORICO_BUFFER_MAX = int(os.getenv("HISTORICO_BUFFER_MAX", 50000))   # banco fora: acima disso vai para o arquivo
+HISTORICO_PENDENTES = os.getenv("HISTORICO_PENDENTES", "historico_pendente.jsonl")
+HISTORICO_REJEITADAS = os.getenv("HISTORICO_REJEITADAS", "historico_rejeitado.jsonl")
+
+# Erros do dado de alguma linha (não do banco): repetir o lote igual não adianta
+ERROS_DE_LINHA = (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError)
+
+log = obter_logger("historico")
+
+SQL_INSERIR = """
+    INSERT INTO historico_mensagens (instancia, remote_jid, from_me, tipo, conteudo, nome_atendente, data_hora)
+    SELECT i, j, f, t, c, n, NOW()
+    FROM unnest($1::varchar[], $2::varchar[], $3::bool[], $4::varchar[], $5::text[], $6::varchar[])
+         WITH ORDINALITY AS x(i, j, f, t, c, n, ordem)
+    ORDER BY ordem
+"""
+
+
+class GravadorHistorico:
+    def __init__(self, lote_ms=HISTORICO_LOTE_MS, lote_max=HISTORICO_LOTE_MAX):
+        self.pool = None
+        self.lote_ms = lote_ms
+        self.lote_max = lote_max
+        self._buffer = []            # dicts (ver gravar)
+        self._trava = threading.Lock()
+        self._loop = None
+        self._sinal = None
+        self._tarefa = None
+        self._carregados = []        # arquivos de pendentes recarregados, apagados quando...
+        self._faltam_carregadas = 0  # ...as linhas deles (começo do buffer) chegarem ao banco
+
+        # Métricas
+        self.linhas = 0
+        self.lotes = 0
+        self.falhas = 0
+        self.rejeitadas = 0
+        self.enviadas_arquivo = 0
+
+    # --- ciclo de vida ---
+    async def iniciar(self, pool):
+        self.pool = pool
+        self._loop = asyncio.get_running_loop()
+        self._sinal = asyncio.Event()
+        self._carregar_pendentes()
+        self._tarefa = asyncio.create_task(self._loop_lote())
+        if self._buffer: self._sinal.set()
+
+    async def parar(self):
+        if self._tarefa:
+            self._tarefa.cancel()
+            await asyncio.gather(self._tarefa, return_exceptions=True)
+            self._tarefa = None
+        while self._buffer:
+            try:
+                await self._descarregar()
+            except Exception as e:
+                log.error("Buffer do histórico não gravado no desligamento: %s", e)
+                self._salvar_pendentes()
+                break
+
+    # --- API ---
+    def gravar(self, instancia, remote_jid, conteudo, from_me=True, tipo="texto", nome_atendente=None, evento=None):
+        """
+        Sem I/O: a linha entra no buffer. evento = dados do feed ("mensagem")
+        a publicar na mesma transação do lote. Pode ser chamada de thread.
+        """
+        linha = {"instancia": instancia, "remote_jid": remote_jid, "from_me": from_me, "tipo": tipo,
+                 "conteudo": conteudo, "nome_atendente": nome_atendente, "evento": evento, "em": time.time()}
+        with self._trava:
+            self._buffer.append(linha)
+            acordar = len(self._buffer) in (1, self.lote_max)   # buffer estava vazio / encheu
+        if acordar and self._loop is not None:   # antes do start: o lote sai no iniciar()
+            self._loop.call_soon_threadsafe(self._sinal.set)
+
+    # --- lote ---
+    async def _loop_lote(self):
+        while True:
+            await self._sinal.wait()
+            self._sinal.clear()
+            # Junta o que chegar nos próximos milissegundos (ou até encher o lote)
+            limite = time.monotonic() + self.lote_ms / 1000
+            while len(self._buffer) < self.lote_max and time.monotonic() < limite:
+                await asyncio.sleep(0.01)
+            try:
+                while self._buffer:
+                    await self._descarregar()
+            except Exception as e:
+                log.error("Lote do histórico falhou, tentando de novo: %s", e, extra={"buffer": len(self._buffer)})
+                self._limitar_buffer()
+                await asyncio.sleep(1)
+                self._sinal.set()
+
+    async def _descarregar(self):
+        with self._trava:
+            lote, self._buffer = self._buffer[:self.lote_max], self._buffer[self.lote_max:]
+        if not lote: return
+        # Pilha de pedaços: dado recusado -> divide ao meio (primeira metade sai antes)
+        pedacos = [lote]
+        try:
+            while pedacos:
+                pedaco = pedacos[-1]
+                try:
+                    await self._inserir(pedaco)
+                except ERROS_DE_LINHA as e:
+                    pedacos.pop()
+                    if len(pedaco) == 1:
+                        self._rejeitar(pedaco[0], e)
+                    else:
+                        meio = len(pedaco) // 2
+                        pedacos += [pedaco[meio:], pedaco[:meio]]
+                    continue
+                pedacos.pop()
+                self.lotes += 1
+                self.linhas += len(pedaco)
+                self._persistidas(len(pedaco))
+        except BaseException:
+            # O que não foi gravado volta para a frente do buffer (mantém a ordem das conversas)
+            self.falhas += 1
+            with self._trava:
+                self._buffer[:0] = [l for p in reversed(pedacos) for l in p]
+            raise
+
+    async def _inserir(self, lote):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(SQL_INSERIR,
+                    [l['instancia'] for l in lote], [l['remote_jid'] for l in lote],
+                    [l['from_me'] for l in lote], [l['tipo'] for l in lote],
+                    [l['conteudo'] for l in lote], [l['nome_atendente'] for l in lote])
+                for l in lote:
+                    if l['evento'] is not None:
+                        await publicar_evento_async(conn, l['instancia'], "mensagem", l['remote_jid'], l['evento'])
+
+    def _rejeitar(self, linha, erro):
+        with open(HISTORICO_REJEITADAS, "a", encoding="utf-8") as f:
+            f.write(json.dumps({**linha, "erro": f"{type(erro).__name__}: {erro}"}, ensure_ascii=False, default=str) + "\n")
+        self.rejeitadas += 1
+        self._persistidas(1)
+        log.error("Linha do histórico recusada pelo banco, guardada em %s: %s", HISTORICO_REJEITADAS, erro,
+                  extra={"instancia": linha['instancia'], "remote_jid": linha['remote_jid']})
+
+    def _persistidas(self, n):
+        # As linhas recarregadas estão no começo do buffer: saíram todas -> arquivo pode sumir
+        if not self._carregados: return
+        self._faltam_carregadas -= n
+        if self._faltam_carregadas <= 0:
+            self._apagar_carregados()
+
+    def _apagar_carregados(self):
+        for caminho in self._carregados:
+            try: os.remove(caminho)
+            except OSError: pass
+        self._carregados, self._faltam_carregadas = [], 0
+
+    # --- banco fora por muito tempo / desligamento ---
+    def _limitar_buffer(self):
+        if len(self._buffer) > HISTORICO_BUFFER_MAX:
+            self._salvar_pendentes()
+
+    def _salvar_pendentes(self):
+        with self._trava:
+            linhas, self._buffer = self._buffer, []
+        if not linhas: return
+        with open(HISTORICO_PENDENTES, "a", encoding="utf-8") as f:
+            for l in linhas:
+                f.write(json.dumps(l, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._apagar_carregados()   # o que faltava deles acabou de ir para o arquivo novo
+        self.enviadas_arquivo += len(linhas)
+        log.warning("%s linhas do histórico guardadas em %s", len(linhas), HISTORICO_PENDENTES)
+
+    def _carregar_pendentes(self):
+        # Renomeia antes de ler: dois workers subindo juntos não regravam o mesmo arquivo.
+        # Também assume os renomeados por processo que morreu antes de gravar
+        # (pid que não existe mais, ou o nosso: pid reaproveitado no container)
+        origens = [HISTORICO_PENDENTES] + [c for c in glob.glob(f"{glob.escape(HISTORICO_PENDENTES)}.*") if _abandonado(c)]
+        linhas = []
+        for i, origem in enumerate(origens):
+            temporario = f"{HISTORICO_PENDENTES}.{os.getpid()}.{i}.carregando"
+            try:
+                os.replace(origem, temporario)
+            except OSError:
+                continue
+            with open(temporario, encoding="utf-8") as f:
+                linhas += [json.loads(l) for l in f if l.strip()]
+            self._carregados.append(temporario)
+        if not self._carregados: return
+        self._faltam_carregadas = len(linhas)
+        with self._trava:
+            self._buffer[:0] = linhas
+        if not linhas: self._apagar_carregados()
+        log.info("%s linhas pendentes do histórico recarregadas", len(linhas))
+
+    def estatisticas(self):
+        return {
+            "buffer": len(self._buffer),
+            "linhas": self.linhas,
+            "lotes": self.lotes,
+            "linhas_por_lote": round(self.linhas / self.lotes, 2) if self.lotes else 0.0,
+            "falhas": self.falhas,
+            "rejeitadas": self.rejeitadas,
+            "enviadas_arquivo": self.enviadas_arquivo,
+        }
+
+
+def _abandonado(caminho):
+    # "<arquivo>.<pid>.<n>.carregando"
+    pid = caminho[len(HISTORICO_PENDENTES) + 1:].split(".")[0]
+    if not pid.isdigit(): return False
+    if int(pid) == os.getpid(): return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        pass
+    return False
+
+
+gravador_historico = GravadorHistorico()
@@ -0,0 +1,136 @@
+# ==========================================================
+# 💬 HISTÓRICO DE MENSAGENS (LEITURA INCREMENTAL)
+# ==========================================================
+# O chat do painel perguntava a cada 3s "me dá as últimas 50" para cada
+# conversa aberta. Agora:
+#   - o cliente manda o id da última mensagem que já tem (?apos_id=) ou a
+#     última data (?desde=) e recebe só o que chegou depois. A ordem é
+#     (data_hora, id): id é sequência, e uma transação que pegou id menor
+#     pode fazer commit depois de uma de id maior. Por isso a resposta
+#     relê os últimos HISTORICO_SOBREPOSICAO_S antes do cursor; o cliente
+#     descarta os ids que já tem;
+#   - a versão da conversa (maior id + quantas linhas nos últimos
+#     HISTORICO_SOBREPOSICAO_S) vira ETag: se o cliente manda
+#     If-None-Match igual, a resposta é 304 sem corpo e sem consulta de
+#     mensagens. Linha atrasada (id menor) muda a contagem e o ETag.
+#
+# A tabela é particionada por mês (particoes.py). As consultas levam um
+# filtro em data_hora sempre que dá, para o Postgres abrir só as
+# partições recentes; o que já foi para o arquivo frio sai por
+# particoes.ler_arquivo_historico (/chat/arquivo/...).
+# ==========================================================
+import os
+
+from banco import garantir_indices
+
+HISTORICO_LIMITE = 50
+HISTORICO_JANELA_DIAS = int(os.getenv("HISTORICO_JANELA_DIAS", 30))   # 1ª tentativa das "últimas N"
+HISTORICO_SOBREPOSICAO_S = int(os.getenv("HISTORICO_SOBREPOSICAO_S", 30))   # releitura antes do cursor
+CHAVE_INDICES_HISTORICO = 728405  # advisory lock do build de índices
+
+INDICES_HISTORICO = [
+    ("idx_historico_conversa_id", "ON historico_mensagens (instancia, remote_jid, id DESC)"),
+]
+
+COLUNAS = """
+    id,
+    from_me as "fromMe",
+    conteudo as "text",
+    data_hora as "timestamp",
+    nome_atendente
+"""
+
+
+async def garantir_indices_historico(pool):
+    return await garantir_indices(pool, INDICES_HISTORICO, CHAVE_INDICES_HISTORICO)
+
+
+def normalizar_jid(remote_jid):
+    return remote_jid if "@" in remote_jid else f"{remote_jid}@s.whatsapp.net"
+
+
+def versao_conversa(cur, instancia, jid):
+    """'<maior id>.<linhas recentes>' ('0.0' se vazia). cur: RealDictCursor."""
+    # Duas consultas baratas: MAX(id) sai do índice por id; a contagem tem
+    # filtro em data_hora (índice por data, só as partições recentes)
+    cur.execute("""
+        SELECT COALESCE(MAX(id), 0) AS maior FROM historico_mensagens
+        WHERE instancia = %s AND remote_jid = %s
+    """, (instancia, jid))
+    maior = cur.fetchone()['maior']
+    cur.execute("""
+        SELECT COUNT(*) AS recentes FROM historico_mensagens
+        WHERE instancia = %s AND remote_jid = %s AND data_hora >= NOW() - make_interval(secs => %s)
+    """, (instancia, jid, HISTORICO_SOBREPOSICAO_S))
+    return f"{maior}.{cur.fetchone()['recentes']}"
+
+
+def etag_conversa(versao):
+    return f'"h{versao}"'
+
+
+def ler_mensagens(cur, instancia, jid, apos_id=None, desde=None, limite=HISTORICO_LIMITE):
+    """
+    Sem cursor: as últimas `limite` mensagens. Com apos_id/desde: só as
+    mais novas (no máximo `limite` depois do cursor, as mais antigas
+    primeiro, para o cliente emendar e pedir o resto) mais a releitura
+    dos últimos HISTORICO_SOBREPOSICAO_S antes dele — o cliente ignora os
+    ids que já tem. Sempre em ordem cronológica (data_hora, id).
+    """
+    if apos_id is not None:
+        cur.execute("""
+            SELECT data_hora FROM historico_mensagens
+            WHERE id = %s AND instancia = %s AND remote_jid = %s LIMIT 1
+        """, (apos_id, instancia, jid))
+        ref = cur.fetchone()
+        if ref is None:
+            # Linha do cursor sumiu (arquivada): sem data, vale o id
+            cur.execute(f"""
+                SELECT {COLUNAS} FROM historico_mensagens
+                WHERE instancia = %s AND remote_jid = %s AND id > %s
+                ORDER BY data_hora, id LIMIT %s
+            """, (instancia, jid, apos_id, limite))
+            msgs = cur.fetchall()
+        else:
+            msgs = _ler_apos(cur, instancia, jid, ref['data_hora'], apos_id, limite)
+    elif desde is not None:
+        msgs = _ler_apos(cur, instancia, jid, desde, None, limite)
+    else:
+        # Quase sempre a conversa teve `limite` mensagens na janela recente;
+        # se não teve, repete sem o filtro (todas as partições)
+        cur.execute(f"""
+            SELECT {COLUNAS} FROM historico_mensagens
+            WHERE instancia = %s AND remote_jid = %s AND data_hora >= NOW() - make_interval(days => %s)
+            ORDER BY data_hora DESC, id DESC LIMIT %s
+        """, (instancia, jid, HISTORICO_JANELA_DIAS, limite))
+        msgs = cur.fetchall()
+        if len(msgs) < limite:
+            cur.execute(f"""
+                SELECT {COLUNAS} FROM historico_mensagens
+                WHERE instancia = %s AND remote_jid = %s
+                ORDER BY data_hora DESC, id DESC LIMIT %s
+            """, (instancia, jid, limite))
+            msgs = cur.fetchall()
+        msgs = msgs[::-1]   # Antigo -> Novo na tela
+
+    for m in msgs:
+        if m['timestamp']: m['timestamp'] = str(m['timestamp'])
+    return msgs
+
+
+def _ler_apos(cur, instancia, jid, data_ref, id_ref, limite):
+    """Até `limite` linhas depois de (data_ref, id_ref) + a janela de releitura antes dele."""
+    cur.execute(f"""
+        (SELECT {COLUNAS} FROM historico_mensagens
+         WHERE instancia = %(inst)s AND remote_jid = %(jid)s
+           AND (data_hora, id) > (%(data)s::timestamp, COALESCE(%(id)s, 9223372036854775807))
+         ORDER BY data_hora, id LIMIT %(limite)s)
+        UNION ALL
+        (SELECT {COLUNAS} FROM historico_mensagens
+         WHERE instancia = %(inst)s AND remote_jid = %(jid)s
+           AND data_hora >= %(data)s::timestamp - make_interval(secs => %(sobreposicao)s)
+           AND (data_hora, id) <= (%(data)s::timestamp, COALESCE(%(id)s, 9223372036854775807)))
+        ORDER BY "timestamp", id
+    """, {"inst": instancia, "jid": jid, "data": data_ref, "id": id_ref,
+          "limite": limite, "sobreposicao": HISTORICO_SOBREPOSICAO_S})
+    return cur.fetchall()
@@ -0,0 +1,217 @@
+# ==========================================================
+# 🧾 LOGS ESTRUTURADOS (JSON, FILA, AMOSTRAGEM, CORRELAÇÃO)
+# ==========================================================
+# Os caminhos quentes (webhook, envio, pagamento) faziam print() de toda
+# mensagem — texto inteiro incluído — direto no stdout, no meio da
+# requisição. Agora:
+#   - logging padrão do Python, com um QueueHandler na raiz: quem loga só
+#     põe o registro numa fila (não espera I/O); uma thread (QueueListener)
+#     formata em JSON e escreve. Fila cheia = registro descartado e contado,
+#     nunca trava o event loop;
+#   - nível global (LOG_NIVEL) e por módulo (LOG_NIVEIS="webhook=DEBUG,evolution=WARNING");
+#   - eventos de alto volume levam extra={"evento": ...} e são amostrados
+#     (LOG_AMOSTRAGEM="mensagem.recebida=0.1"): o descarte acontece antes de
+#     formatar, então amostra baixa = custo quase zero. WARNING+ nunca é amostrado;
+#   - id de correlação num ContextVar: o middleware pega o X-Request-ID (ou
+#     gera um) e devolve no header; o webhook grava o id no evento da fila e o
+#     consumidor restaura, então recebimento -> gatilho -> envio Evolution ->
+#     INSERT no histórico saem com o mesmo "correlacao".
+# Texto de mensagem não vai para o log (só tamanho), a não ser em DEBUG.
+# ==========================================================
+import os
+import sys
+import json
+import uuid
+import queue
+import random
+import atexit
+import logging
+import contextvars
+import logging.handlers
+from datetime import datetime, timezone
+
+LOG_NIVEL = os.getenv("LOG_NIVEL", "INFO").upper()
+LOG_NIVEIS = os.getenv("LOG_NIVEIS", "")                     # "webhook=DEBUG,evolution=WARNING"
+LOG_AMOSTRAGEM = os.getenv("LOG_AMOSTRAGEM", "mensagem.recebida=0.1,mensagem.enviada=0.1")
+LOG_FORMATO = os.getenv("LOG_FORMATO", "json")               # json | texto
+LOG_FILA_MAX = int(os.getenv("LOG_FILA_MAX", 10000))
+
+PREFIXO = "agil"
+CABECALHO_CORRELACAO = "X-Request-ID"
+
+_correlacao = contextvars.ContextVar("correlacao", default=None)
+
+# Atributos que todo LogRecord tem: o resto veio de extra={...} e vai para o JSON
+_PADRAO = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "correlacao"}
+
+
+def _pares(texto):
+    pares = {}
+    for item in filter(None, (p.strip() for p in texto.split(","))):
+        chave, _, valor = item.partition("=")
+        pares[chave.strip()] = valor.strip()
+    return pares
+
+
+# ==========================================================
+# CORRELAÇÃO
+# ==========================================================
+def novo_id():
+    return uuid.uuid4().hex[:16]
+
+
+def id_correlacao():
+    return _correlacao.get()
+
+
+def definir_correlacao(valor=None):
+    """Devolve o token para _correlacao.reset (ou use restaurar_correlacao)."""
+    return _correlacao.set(valor or novo_id())
+
+
+def restaurar_correlacao(token):
+    _correlacao.reset(token)
+
+
+async def correlacionar_requisicao(request, call_next):
+    """Middleware: id de correlação da requisição (X-Request-ID de entrada ou novo)."""
+    recebido = (request.headers.get(CABECALHO_CORRELACAO) or "")[:64]
+    token = definir_correlacao(recebido)
+    try:
+        resposta = await call_next(request)
+        resposta.headers[CABECALHO_CORRELACAO] = _correlacao.get()
+        return resposta
+    finally:
+        restaurar_correlacao(token)
+
+
+# ==========================================================
+# FILTROS / FORMATO
+# ==========================================================
+class FiltroCorrelacao(logging.Filter):
+    # Roda na thread de quem loga (antes da fila): é ali que o ContextVar vale
+    def filter(self, record):
+        record.correlacao = _correlacao.get()
+        return True
+
+
+class FiltroAmostragem(logging.Filter):
+    def __init__(self, taxas):
+        super().__init__()
+        self.taxas = taxas
+        self.descartados = {}
+
+    def filter(self, record):
+        evento = getattr(record, "evento", None)
+        taxa = self.taxas.get(evento) if evento else None
+        if taxa is None or record.levelno >= logging.WARNING or random.random() < taxa:
+            return True
+        self.descartados[evento] = self.descartados.get(evento, 0) + 1
+        return False
+
+
+class FormatoJson(logging.Formatter):
+    def format(self, record):
+        saida = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "correlacao", None): saida["correlacao"] = record.correlacao
+        for chave, valor in vars(record).items():
+            if chave not in _PADRAO and not chave.startswith("_"):
+                saida[chave] = valor
+        if record.exc_info:
+            saida["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            saida["exc"] = record.exc_text
+        return json.dumps(saida, ensure_ascii=False, default=str)
+
+
+class FormatoTexto(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(correlacao)s] %(message)s")
+
+    def format(self, record):
+        if not hasattr(record, "correlacao"): record.correlacao = None
+        return super().format(record)
+
+
+class FilaSemBloqueio(logging.handlers.QueueHandler):
+    """Fila cheia: descarta e conta (log nunca segura a requisição)."""
+
+    def __init__(self, fila):
+        super().__init__(fila)
+        self.descartados = 0
+
+    def prepare(self, record):
+        # Como o QueueHandler padrão, mas o traceback fica em exc_text (vira "exc" no JSON, não cola na msg)
+        record = logging.makeLogRecord(vars(record))
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.descartados += 1
+
+
+# ==========================================================
+# CONFIGURAÇÃO (uma vez por processo)
+# ==========================================================
+_ouvinte = None
+_manipulador = None
+_amostragem = None
+
+
+def configurar_logs():
+    global _ouvinte, _manipulador, _amostragem
+    if _ouvinte is not None: return
+
+    saida = logging.StreamHandler(sys.stdout)
+    saida.setFormatter(FormatoJson() if LOG_FORMATO == "json" else FormatoTexto())
+
+    taxas = {k: float(v) for k, v in _pares(LOG_AMOSTRAGEM).items()}
+    _amostragem = FiltroAmostragem(taxas)
+    _manipulador = FilaSemBloqueio(queue.Queue(maxsize=LOG_FILA_MAX))
+    _manipulador.addFilter(_amostragem)
+    _manipulador.addFilter(FiltroCorrelacao())
+
+    raiz = logging.getLogger(PREFIXO)
+    raiz.setLevel(LOG_NIVEL)
+    raiz.handlers = [_manipulador]
+    raiz.propagate = False
+    for modulo, nivel in _pares(LOG_NIVEIS).items():
+        logging.getLogger(f"{PREFIXO}.{modulo}").setLevel(nivel.upper())
+
+    _ouvinte = logging.handlers.QueueListener(_manipulador.queue, saida, respect_handler_level=True)
+    _ouvinte.start()
+    atexit.register(encerrar_logs)
+
+
+def encerrar_logs():
+    global _ouvinte
+    if _ouvinte is not None:
+        _ouvinte.stop()   # esvazia a fila antes de sair
+        _ouvinte = None
+
+
+def obter_logger(modulo):
+    """logging.getLogger("agil.<modulo>") — nível por módulo via LOG_NIVEIS."""
+    return logging.getLogger(f"{PREFIXO}.{modulo}")
+
+
+def estatisticas_logs():
+    return {
+        "nivel": LOG_NIVEL,
+        "niveis_por_modulo": _pares(LOG_NIVEIS),
+        "fila": _manipulador.queue.qsize() if _manipulador else 0,
+        "descartados_fila_cheia": _manipulador.descartados if _manipulador else 0,
+        "descartados_amostragem": dict(_amostragem.descartados) if _amostragem else {},
+    }
@@ -0,0 +1,186 @@
+# ==========================================================
+# 🌳 ÁRVORE DE MENU COMPILADA (CACHE POR INSTÂNCIA)
+# ==========================================================
+# Em vez de 3-5 consultas em respostas_automacao por mensagem, cada
+# instância tem sua árvore de gatilhos montada em memória:
+#   - raiz / filhos: dict gatilho.lower() -> nó   (busca O(1))
+#   - bloco "👇 Opções" de cada nó já renderizado
+#   - bot_ativo da instância
+#
+# Versionamento: a tabela menu_versao guarda um contador por instância.
+# Toda escrita (/salvar, /excluir, status do bot) incrementa o contador;
+# cada worker confere a versão no banco no máximo a cada MENU_VERIFICAR_S
+# segundos e recompila se mudou. O worker que fez a escrita descarta a
+# árvore local na hora.
+# ==========================================================
+import os
+import time
+import asyncio
+
+MENU_VERIFICAR_S = float(os.getenv("MENU_VERIFICAR_S", 2))
+
+DDL_MENU_VERSAO = """
+    CREATE TABLE IF NOT EXISTS menu_versao (
+        instancia VARCHAR(100) PRIMARY KEY,
+        versao BIGINT NOT NULL DEFAULT 1,
+        atualizado_em TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+"""
+
+SQL_INCREMENTAR_VERSAO = """
+    INSERT INTO menu_versao (instancia, versao) VALUES (%s, 1)
+    ON CONFLICT (instancia) DO UPDATE SET versao = menu_versao.versao + 1, atualizado_em = NOW()
+"""
+
+
+def renderizar_opcoes(nos):
+    if not nos: return ""
+    texto = "\n\n👇 *Opções:*"
+    for no in nos:
+        label = no['titulo_menu'] if no['titulo_menu'] else no['gatilho']
+        texto += f"\n*{no['gatilho']}* - {label}"
+    return texto
+
+
+class ArvoreMenu:
+    def __init__(self, instancia, versao, linhas, bot_ativo=True):
+        self.instancia = instancia
+        self.versao = versao
+        self.bot_ativo = bot_ativo
+        self.verificado_em = time.monotonic()
+
+        self.nos = {}
+        self.raiz = {}            # gatilho -> nó (id_pai IS NULL)
+        self.filhos = {}          # id_pai -> {gatilho -> nó}
+        self.default = None
+        self._opcoes = {}         # id do nó (None = raiz) -> bloco renderizado
+
+        opcoes_raiz = []
+        filhos_lista = {}
+        for r in sorted(linhas, key=lambda x: x['id']):
+            no = {
+                "id": r['id'],
+                "gatilho": r['gatilho'],
+                "resposta": r['resposta'],
+                "titulo_menu": r['titulo_menu'],
+                "id_pai": r['id_pai'],
+                "tipo_midia": r.get('tipo_midia'),
+                "url_midia": r.get('url_midia'),
+            }
+            self.nos[no['id']] = no
+            chave = (no['gatilho'] or "").strip().lower()
+
+            if no['gatilho'] == 'default' and self.default is None:
+                self.default = no
+
+            if no['id_pai'] is None:
+                self.raiz.setdefault(chave, no)
+            else:
+                self.filhos.setdefault(no['id_pai'], {}).setdefault(chave, no)
+                filhos_lista.setdefault(no['id_pai'], []).append(no)
+
+            # Menu principal: id_pai nulo ou 0, sem o 'default'
+            if (no['id_pai'] is None or no['id_pai'] == 0) and no['gatilho'] != 'default':
+                opcoes_raiz.append(no)
+
+        self._opcoes[None] = renderizar_opcoes(opcoes_raiz)
+        for id_pai, nos in filhos_lista.items():
+            self._opcoes[id_pai] = renderizar_opcoes(nos)
+
+    def buscar(self, texto, id_pai=None):
+        chave = (texto or "").strip().lower()
+        if id_pai: return self.filhos.get(id_pai, {}).get(chave)
+        return self.raiz.get(chave)
+
+    def tem_filhos(self, id_no):
+        return bool(self.filhos.get(id_no))
+
+    def bloco_opcoes(self, id_no=None):
+        return self._opcoes.get(id_no or None, "")
+
+    def __len__(self):
+        return len(self.nos)
+
+
+class CacheMenus:
+    def __init__(self, verificar_s=MENU_VERIFICAR_S):
+        self.pool = None
+        self.verificar_s = verificar_s
+        self._arvores = {}
+        self._travas = {}
+
+        # Métricas
+        self.acertos = 0
+        self.compilacoes = 0
+        self.checagens_versao = 0
+
+    async def iniciar(self, pool):
+        self.pool = pool   # tabela menu_versao: migração 004 (migracoes.py)
+
+    async def _versao_banco(self, conn, instancia):
+        self.checagens_versao += 1
+        return await conn.fetchval("SELECT versao FROM menu_versao WHERE instancia = $1", instancia) or 0
+
+    async def _compilar(self, instancia):
+        async with self.pool.acquire() as conn:
+            # Versão + linhas na mesma foto do banco
+            async with conn.transaction(isolation='repeatable_read', readonly=True):
+                versao = await self._versao_banco(conn, instancia)
+                linhas = await conn.fetch("""
+                    SELECT id, gatilho, resposta, titulo_menu, id_pai, tipo_midia, url_midia
+                    FROM respostas_automacao WHERE instancia = $1
+                """, instancia)
+                bot_ativo = await conn.fetchval("SELECT bot_ativo FROM usuarios WHERE instancia_wa = $1", instancia)
+        self.compilacoes += 1
+        return ArvoreMenu(instancia, versao, [dict(r) for r in linhas], bot_ativo is not False)
+
+    async def obter(self, instancia):
+        arvore = self._arvores.get(instancia)
+        agora = time.monotonic()
+        if arvore and agora - arvore.verificado_em < self.verificar_s:
+            self.acertos += 1
+            return arvore
+
+        trava = self._travas.setdefault(instancia, asyncio.Lock())
+        async with trava:
+            arvore = self._arvores.get(instancia)
+            if arvore and time.monotonic() - arvore.verificado_em < self.verificar_s:
+                self.acertos += 1
+                return arvore
+
+            if arvore:
+                async with self.pool.acquire() as conn:
+                    versao = await self._versao_banco(conn, instancia)
+                if versao == arvore.versao:
+                    arvore.verificado_em = time.monotonic()
+                    self.acertos += 1
+                    return arvore
+
+            arvore = await self._compilar(instancia)
+            self._arvores[instancia] = arvore
+            return arvore
+
+    def descartar(self, instancia):
+        self._arvores.pop(instancia, None)
+
+    def estatisticas(self):
+        return {
+            "instancias": len(self._arvores),
+            "nos": sum(len(a) for a in self._arvores.values()),
+            "acertos": self.acertos,
+            "compilacoes": self.compilacoes,
+            "checagens_versao": self.checagens_versao,
+        }
+
+
+cache_menus = CacheMenus()
+
+
+def invalidar_menu(cur, instancia):
+    """
+    Chamar DENTRO da transação que alterou os gatilhos / status do bot
+    (cursor psycopg2). Incrementa a versão para os outros workers e
+    descarta a árvore local.
+    """
+    cur.execute(SQL_INCREMENTAR_VERSAO, (instancia,))
+    cache_menus.descartar(instancia)
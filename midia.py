@@ -0,0 +1,172 @@
+# ==========================================================
+# 🔐 MÍDIA DO WHATSAPP: DOWNLOAD + DESCRIPTOGRAFIA EM STREAMING
+# ==========================================================
+# O .enc do WhatsApp é:  AES-256-CBC(arquivo) || HMAC-SHA256(iv + cifrado)[:10]
+# Antes o arquivo inteiro vinha para a memória (response.content), era
+# decifrado de uma vez e devolvido como bytes: alguns vídeos de 60 MB em
+# paralelo estouravam a RAM do worker.
+#
+# Agora:
+#   - download em pedaços de MIDIA_CHUNK bytes (stream=True);
+#   - HKDF uma vez só; AES-CBC, HMAC e remoção do padding PKCS7 avançam
+#     pedaço a pedaço (os últimos 10 bytes ficam segurados: são o MAC);
+#   - o resultado vai para um arquivo temporário que só entra no armazém
+#     (armazem.py, endereço = SHA-256 do conteúdo) se o MAC bater.
+# Memória por download ~ MIDIA_CHUNK, não importa o tamanho do arquivo.
+# ==========================================================
+import os
+import hmac
+import base64
+import hashlib
+import tempfile
+
+import requests
+
+from armazem import PASTA_CAS, publicar_temporario
+
+try:
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    from cryptography.hazmat.primitives import hashes, padding
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    TEM_CRYPTOGRAPHY = True
+except ImportError:
+    TEM_CRYPTOGRAPHY = False
+
+MIDIA_CHUNK = int(os.getenv("MIDIA_CHUNK", 64 * 1024))
+MIDIA_TIMEOUT = float(os.getenv("MIDIA_TIMEOUT", 15))   # conexão / intervalo entre pedaços
+TAMANHO_MAC = 10
+
+# Info Strings do WhatsApp
+INFO_HKDF = {
+    "image": b"WhatsApp Image Keys",
+    "video": b"WhatsApp Video Keys",
+    "audio": b"WhatsApp Audio Keys",
+    "document": b"WhatsApp Document Keys",
+}
+EXTENSOES = {"image": ".jpg", "video": ".mp4", "audio": ".ogg", "document": ".bin"}
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+
+_sessao = None
+
+
+def sessao_download():
+    # Sessão própria (CDN do WhatsApp, não a Evolution): keep-alive entre downloads
+    global _sessao
+    if _sessao is None:
+        _sessao = requests.Session()
+        _sessao.headers.update({"User-Agent": USER_AGENT})
+    return _sessao
+
+
+class MidiaInvalida(Exception):
+    """Chave inválida, download falhou ou o MAC não confere."""
+
+
+def ler_media_key(media_key_obj):
+    """mediaKey vem como base64 (str) ou como Buffer serializado ({"0": 255, "1": 10, ...})."""
+    media_key = None
+    if isinstance(media_key_obj, str):
+        media_key = base64.b64decode(media_key_obj)
+    elif isinstance(media_key_obj, dict):
+        try:
+            # Ordena pelas chaves para garantir a sequência correta
+            media_key = bytes(media_key_obj[str(k)] for k in sorted(map(int, media_key_obj.keys())))
+        except (ValueError, KeyError):
+            media_key = bytes(list(media_key_obj.values()))
+    elif isinstance(media_key_obj, (bytes, bytearray)):
+        media_key = bytes(media_key_obj)
+
+    if not media_key or len(media_key) != 32:
+        raise MidiaInvalida(f"MediaKey inválida ou tamanho incorreto ({len(media_key) if media_key else 0}).")
+    return media_key
+
+
+def derivar_chaves(media_key, tipo_media):
+    """HKDF(112 bytes) -> (iv, chave AES, chave HMAC)."""
+    expandida = HKDF(
+        algorithm=hashes.SHA256(),
+        length=112,
+        salt=None,
+        info=INFO_HKDF.get(tipo_media, INFO_HKDF["image"]),
+        backend=default_backend()
+    ).derive(media_key)
+    return expandida[:16], expandida[16:48], expandida[48:80]
+
+
+class DecifradorStreaming:
+    """
+    Recebe o .enc em pedaços (alimentar) e devolve o texto claro em pedaços.
+    Segura sempre os últimos 10 bytes (podem ser o MAC); finalizar() confere o MAC.
+    """
+
+    def __init__(self, media_key, tipo_media):
+        iv, chave_aes, chave_mac = derivar_chaves(media_key, tipo_media)
+        self._decifrador = Cipher(algorithms.AES(chave_aes), modes.CBC(iv), backend=default_backend()).decryptor()
+        self._sem_padding = padding.PKCS7(128).unpadder()
+        self._mac = hmac.new(chave_mac, iv, hashlib.sha256)
+        self._cauda = b""
+        self.bytes_cifrados = 0
+
+    def alimentar(self, pedaco):
+        dados = self._cauda + pedaco
+        if len(dados) <= TAMANHO_MAC:
+            self._cauda = dados
+            return b""
+        cifrado, self._cauda = dados[:-TAMANHO_MAC], dados[-TAMANHO_MAC:]
+        self.bytes_cifrados += len(cifrado)
+        self._mac.update(cifrado)
+        return self._sem_padding.update(self._decifrador.update(cifrado))
+
+    def finalizar(self):
+        if len(self._cauda) != TAMANHO_MAC or self.bytes_cifrados % 16:
+            raise MidiaInvalida("Arquivo .enc truncado.")
+        if not hmac.compare_digest(self._mac.digest()[:TAMANHO_MAC], self._cauda):
+            raise MidiaInvalida("MAC não confere (arquivo corrompido ou chave errada).")
+        try:
+            return self._sem_padding.update(self._decifrador.finalize()) + self._sem_padding.finalize()
+        except ValueError as e:
+            raise MidiaInvalida("Padding inválido (arquivo corrompido ou chave errada).") from e
+
+
+def baixar_e_descriptografar(media_url, media_key_obj, tipo_media, chunk=MIDIA_CHUNK):
+    """
+    Baixa e decifra em streaming direto para o armazém.
+    Devolve (sha256, extensao, caminho); levanta MidiaInvalida em qualquer falha
+    (o temporário é apagado).
+    """
+    if not TEM_CRYPTOGRAPHY:
+        raise MidiaInvalida("Biblioteca 'cryptography' não instalada.")
+
+    decifrador = DecifradorStreaming(ler_media_key(media_key_obj), tipo_media)
+    os.makedirs(PASTA_CAS, exist_ok=True)
+    fd, temporario = tempfile.mkstemp(prefix=".wa_", suffix=".part", dir=PASTA_CAS)
+    h = hashlib.sha256()
+    try:
+        with os.fdopen(fd, "wb") as saida:
+            with sessao_download().get(media_url, stream=True, timeout=MIDIA_TIMEOUT) as resp:
+                if resp.status_code != 200:
+                    raise MidiaInvalida(f"Erro download do WhatsApp: {resp.status_code}")
+                for pedaco in resp.iter_content(chunk_size=chunk):
+                    if not pedaco: continue
+                    claro = decifrador.alimentar(pedaco)
+                    h.update(claro)
+                    saida.write(claro)
+            claro = decifrador.finalizar()
+            h.update(claro)
+            saida.write(claro)
+
+        sha256, extensao = h.hexdigest(), EXTENSOES.get(tipo_media, '.bin')
+        return sha256, extensao, publicar_temporario(temporario, sha256, extensao)
+    except requests.RequestException as e:
+        _apagar(temporario)
+        raise MidiaInvalida(f"Erro download do WhatsApp: {e}") from e
+    except BaseException:
+        _apagar(temporario)
+        raise
+
+
+def _apagar(caminho):
+    try: os.remove(caminho)
+    except OSError: pass
@@ -0,0 +1,280 @@
+# ==========================================================
+# 🧱 MIGRAÇÕES DE SCHEMA (VERSIONADAS)
+# ==========================================================
+# Antes cada pedaço do schema nascia num lugar: rota que fazia CREATE
+# TABLE a cada chamada (criar_tarefa), rota de "emergência"
+# (/setup/reparar-banco) e o startup de cada módulo rodando o seu DDL.
+#
+# Agora:
+#   - MIGRACOES é uma lista ordenada (versão, nome, SQL). No startup,
+#     aplicar_migracoes() pega um advisory lock (os outros workers
+#     esperam), aplica só as versões que ainda não estão em
+#     schema_migracoes — cada uma na sua transação — e solta o lock.
+#     Migração publicada não muda: correção = versão nova.
+#   - ÍNDICES que as rotas usam ficam declarados aqui (INDICES_ROTAS) e
+#     são criados CONCURRENTLY em segundo plano (banco.garantir_indices),
+#     porque isso não pode rodar dentro de transação nem travar o boot.
+#   - `python migracoes.py verificar` lista migrações pendentes, índices
+#     faltando/inválidos e planos lentos das consultas quentes.
+#     `python migracoes.py migrar` aplica sem subir a API.
+# ==========================================================
+import os
+import sys
+import json
+import time
+import asyncio
+
+from banco import garantir_indices
+from fila_webhook import DDL_INBOX, DDL_IDEMPOTENCIA, DDL_INBOX_DONO
+from estado_conversa import DDL_ESTADO
+from menu import DDL_MENU_VERSAO
+from campanhas import DDL_CAMPANHAS, DDL_CAMPANHAS_DONO
+from rollups import DDL_ROLLUPS, INDICES_FONTES
+from feed import DDL_FEED
+from armazem import DDL_ARMAZEM
+from particoes import DDL_ARQUIVO
+from planos import DDL_DIREITOS
+from cache_ttl import DDL_RESERVAS
+from caixa_email import DDL_EMAILS, DDL_EMAILS_DONO
+from pagamentos import DDL_PAGAMENTOS, DDL_PAGAMENTOS_DONO
+from crm import INDICES_CRM
+from historico import INDICES_HISTORICO
+from logs import configurar_logs, obter_logger
+
+log = obter_logger("migracoes")
+
+CHAVE_MIGRACOES = 728407       # advisory lock das migrações
+CHAVE_INDICES_ROTAS = 728408   # advisory lock do build dos índices abaixo
+PLANO_CUSTO_MAX = float(os.getenv("PLANO_CUSTO_MAX", 10000))   # acima disso o "verificar" acusa
+PLANO_SEQ_LINHAS_MAX = int(os.getenv("PLANO_SEQ_LINHAS_MAX", 50000))
+
+DDL_SCHEMA_MIGRACOES = """
+    CREATE TABLE IF NOT EXISTS schema_migracoes (
+        versao INTEGER PRIMARY KEY,
+        nome VARCHAR(100) NOT NULL,
+        aplicada_em TIMESTAMP NOT NULL DEFAULT NOW(),
+        duracao_ms INTEGER
+    );
+"""
+
+# (versão, nome, SQL) — em ordem; IF NOT EXISTS em tudo porque bases antigas já têm parte disso
+MIGRACOES = [
+    (1, "tabelas_planos_e_tarefas", """
+        CREATE TABLE IF NOT EXISTS planos_comerciais (
+            id SERIAL PRIMARY KEY,
+            nome VARCHAR(50) UNIQUE NOT NULL,
+            valor DECIMAL(10, 2) NOT NULL,
+            descricao TEXT,
+            ativo BOOLEAN DEFAULT TRUE
+        );
+
+        CREATE TABLE IF NOT EXISTS regras (
+            id SERIAL PRIMARY KEY,
+            plano VARCHAR(50) NOT NULL,
+            funcionalidade VARCHAR(50) NOT NULL,
+            ativo BOOLEAN DEFAULT FALSE,
+            limite INTEGER DEFAULT 0,
+            CONSTRAINT uk_regra_plano UNIQUE (plano, funcionalidade)
+        );
+
+        INSERT INTO planos_comerciais (nome, valor, descricao)
+        SELECT * FROM (VALUES
+            ('Básico', 19.90, '🤖 5 Gatilhos'),
+            ('Pro', 39.90, '🚀 Disparos e CRM'),
+            ('Enterprise', 99.90, '💎 Tudo Ilimitado')
+        ) AS padrao (nome, valor, descricao)
+        WHERE NOT EXISTS (SELECT 1 FROM planos_comerciais);
+
+        CREATE TABLE IF NOT EXISTS crm_tarefas (
+            id SERIAL PRIMARY KEY,
+            cliente_id INTEGER NOT NULL,
+            descricao TEXT NOT NULL,
+            data_limite TIMESTAMP WITHOUT TIME ZONE,
+            concluido BOOLEAN DEFAULT FALSE,
+            criado_em TIMESTAMP DEFAULT NOW()
+        );
+    """),
+    (2, "fila_webhook", DDL_INBOX),
+    (3, "estado_conversa", DDL_ESTADO),
+    (4, "menu_versao", DDL_MENU_VERSAO),
+    (5, "campanhas", DDL_CAMPANHAS),
+    (6, "rollups_metricas", DDL_ROLLUPS),
+    (7, "feed_mudancas", DDL_FEED),
+    (8, "armazem_midias", DDL_ARMAZEM),
+    (9, "arquivo_particoes", DDL_ARQUIVO),
+    (10, "direitos_planos", DDL_DIREITOS),
+    (11, "webhook_idempotencia", DDL_IDEMPOTENCIA),
+    (12, "reservas_ttl", DDL_RESERVAS),
+    (13, "emails_saida", DDL_EMAILS),
+    (14, "pagamentos_mp", DDL_PAGAMENTOS),
+    (15, "emails_saida_dono", DDL_EMAILS_DONO),
+    (16, "campanha_envios_dono", DDL_CAMPANHAS_DONO),
+    (17, "webhook_inbox_dono", DDL_INBOX_DONO),
+    (18, "pagamentos_dono", DDL_PAGAMENTOS_DONO),
+]
+
+# Índices que as rotas "quentes" supõem existir (criados CONCURRENTLY no startup)
+INDICES_ROTAS = [
+    ("idx_respostas_automacao_gatilho", "ON respostas_automacao (instancia, id_pai, lower(gatilho))"),
+    ("idx_historico_mensagens_data", "ON historico_mensagens (instancia, remote_jid, data_hora)"),
+    ("idx_chat_logs_instancia_data", "ON chat_logs (instancia, data_hora)"),
+    ("idx_clientes_finais_instancia_telefone", "ON clientes_finais (instancia, telefone)"),
+    ("idx_atendimentos_ativos_conversa", "ON atendimentos_ativos (instancia, remote_jid)"),
+    ("idx_atendimentos_concluidos_instancia_fim", "ON atendimentos_concluidos (instancia, data_fim DESC)"),
+    ("idx_crm_tarefas_cliente", "ON crm_tarefas (cliente_id, concluido, data_limite)"),
+    ("idx_crm_notas_cliente", "ON crm_notas (cliente_id)"),
+    ("idx_usuarios_login", "ON usuarios (login)"),
+    ("idx_usuarios_instancia_wa", "ON usuarios (instancia_wa)"),
+    ("idx_usuarios_id_pagamento_mp", "ON usuarios (id_pagamento_mp)"),
+    ("idx_atendentes_instancia", "ON atendentes (instancia_vinculada)"),
+]
+
+# Todos os índices declarados no código (cada módulo ainda cria os seus)
+TODOS_INDICES = INDICES_ROTAS + INDICES_CRM + INDICES_HISTORICO + INDICES_FONTES
+
+# Consultas quentes para o "verificar" olhar o plano ($1 = instância de exemplo)
+CONSULTAS_QUENTES = {
+    "menu_gatilho": "SELECT id FROM respostas_automacao WHERE instancia = $1 AND id_pai IS NULL AND lower(gatilho) = 'menu'",
+    "chat_ultimas": "SELECT id FROM historico_mensagens WHERE instancia = $1 AND remote_jid = 'x@s.whatsapp.net' ORDER BY id DESC LIMIT 50",
+    "chat_desde": "SELECT id FROM historico_mensagens WHERE instancia = $1 AND remote_jid = 'x@s.whatsapp.net' AND data_hora > NOW() - INTERVAL '1 day'",
+    "crm_pagina": "SELECT id FROM clientes_finais WHERE instancia = $1 ORDER BY id DESC LIMIT 21",
+    "crm_telefone": "SELECT id FROM clientes_finais WHERE instancia = $1 AND telefone = 'x@s.whatsapp.net'",
+    "atendimento_ativo": "SELECT id FROM atendimentos_ativos WHERE instancia = $1 AND remote_jid = 'x@s.whatsapp.net'",
+    "concluidos_recentes": "SELECT id FROM atendimentos_concluidos WHERE instancia = $1 ORDER BY data_fim DESC LIMIT 50",
+    "chat_logs_periodo": "SELECT COUNT(*) FROM chat_logs WHERE instancia = $1 AND data_hora > NOW() - INTERVAL '1 day'",
+}
+
+situacao_indices_rotas = {"verificado_em": None, "indices": {}}
+
+
+# ==========================================================
+# APLICAÇÃO (startup)
+# ==========================================================
+async def aplicar_migracoes(pool):
+    """Aplica as migrações pendentes. Devolve a lista de versões aplicadas agora."""
+    aplicadas = []
+    async with pool.acquire() as conn:
+        # Bloqueante de propósito: o segundo worker espera o primeiro terminar
+        await conn.execute("SELECT pg_advisory_lock($1)", CHAVE_MIGRACOES)
+        try:
+            await conn.execute(DDL_SCHEMA_MIGRACOES)
+            feitas = {r['versao'] for r in await conn.fetch("SELECT versao FROM schema_migracoes")}
+            for versao, nome, sql in MIGRACOES:
+                if versao in feitas: continue
+                inicio = time.perf_counter()
+                async with conn.transaction():
+                    await conn.execute(sql)
+                    await conn.execute(
+                        "INSERT INTO schema_migracoes (versao, nome, duracao_ms) VALUES ($1, $2, $3)",
+                        versao, nome, int((time.perf_counter() - inicio) * 1000))
+                aplicadas.append(versao)
+                log.info("Migração aplicada", extra={"versao": versao, "migracao": nome})
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", CHAVE_MIGRACOES)
+    return aplicadas
+
+
+async def garantir_indices_rotas(pool):
+    resultado = await garantir_indices(pool, INDICES_ROTAS, CHAVE_INDICES_ROTAS)
+    if resultado is not None:
+        situacao_indices_rotas["indices"].update(resultado)
+        situacao_indices_rotas["verificado_em"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    return situacao_indices_rotas
+
+
+def iniciar_indices_rotas(pool):
+    return asyncio.create_task(garantir_indices_rotas(pool))
+
+
+# ==========================================================
+# VERIFICAÇÃO (CLI / /sistema/schema)
+# ==========================================================
+def _varrer_plano(no, achados):
+    if no.get("Node Type") == "Seq Scan" and no.get("Plan Rows", 0) >= PLANO_SEQ_LINHAS_MAX:
+        achados.append(f"Seq Scan em {no.get('Relation Name')} (~{int(no['Plan Rows'])} linhas)")
+    for filho in no.get("Plans", []):
+        _varrer_plano(filho, achados)
+
+
+async def verificar(pool, instancia=None):
+    """Migrações pendentes, índices faltando/inválidos e planos suspeitos das consultas quentes."""
+    relatorio = {"migracoes_pendentes": [], "indices": {}, "planos": {}, "consultas_lentas": None}
+    async with pool.acquire() as conn:
+        await conn.execute(DDL_SCHEMA_MIGRACOES)
+        feitas = {r['versao'] for r in await conn.fetch("SELECT versao FROM schema_migracoes")}
+        relatorio["migracoes_pendentes"] = [f"{v:03d} {n}" for v, n, _ in MIGRACOES if v not in feitas]
+
+        linhas = await conn.fetch("""
+            SELECT c.relname, i.indisvalid FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = ANY($1::text[])
+        """, [n for n, _ in TODOS_INDICES])
+        existentes = {r['relname']: r['indisvalid'] for r in linhas}
+        for nome, definicao in TODOS_INDICES:
+            estado = existentes.get(nome)
+            relatorio["indices"][nome] = "ok" if estado else ("inválido" if estado is False else "faltando")
+
+        if instancia is None:
+            instancia = await conn.fetchval("SELECT instancia_wa FROM usuarios WHERE instancia_wa IS NOT NULL LIMIT 1") or ""
+        for nome, sql in CONSULTAS_QUENTES.items():
+            try:
+                bruto = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {sql}", instancia)
+                plano = (json.loads(bruto) if isinstance(bruto, str) else bruto)[0]["Plan"]
+                achados = []
+                _varrer_plano(plano, achados)
+                if plano.get("Total Cost", 0) > PLANO_CUSTO_MAX:
+                    achados.append(f"custo estimado {plano['Total Cost']:.0f}")
+                relatorio["planos"][nome] = {"custo": plano.get("Total Cost"), "alertas": achados}
+            except Exception as e:
+                relatorio["planos"][nome] = {"erro": str(e)}
+
+        # Se o pg_stat_statements estiver ligado, as 10 mais lentas de verdade
+        try:
+            lentas = await conn.fetch("""
+                SELECT left(query, 200) AS consulta, calls AS chamadas,
+                       round(mean_exec_time::numeric, 1) AS media_ms
+                FROM pg_stat_statements ORDER BY mean_exec_time DESC LIMIT 10
+            """)
+            relatorio["consultas_lentas"] = [dict(r) for r in lentas]
+        except Exception:
+            pass
+    return relatorio
+
+
+def _imprimir(relatorio):
+    pend = relatorio["migracoes_pendentes"]
+    print(f"🧱 Migrações pendentes: {', '.join(pend) if pend else 'nenhuma'}")
+    for nome, estado in relatorio["indices"].items():
+        print(f"{'✅' if estado == 'ok' else '❌'} índice {nome}: {estado}")
+    for nome, plano in relatorio["planos"].items():
+        if "erro" in plano:
+            print(f"⚠️ plano {nome}: {plano['erro']}")
+        else:
+            print(f"{'⚠️' if plano['alertas'] else '✅'} plano {nome}: custo {plano['custo']} {'; '.join(plano['alertas'])}")
+    for r in relatorio["consultas_lentas"] or []:
+        print(f"🐢 {r['media_ms']} ms x{r['chamadas']}: {r['consulta']}")
+
+
+async def _main(comando, instancia):
+    from banco import iniciar_pool_async, pool_async, fechar_pool_async
+    configurar_logs()
+    await iniciar_pool_async()
+    try:
+        if comando == "migrar":
+            aplicadas = await aplicar_migracoes(pool_async())
+            print(f"🧱 {len(aplicadas)} migração(ões) aplicada(s).")
+        else:
+            relatorio = await verificar(pool_async(), instancia)
+            _imprimir(relatorio)
+            falhou = relatorio["migracoes_pendentes"] or any(e != "ok" for e in relatorio["indices"].values()) \
+                or any(p.get("alertas") for p in relatorio["planos"].values())
+            return 1 if falhou else 0
+    finally:
+        await fechar_pool_async()
+    return 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("migrar", "verificar"):
+        print("Uso: python migracoes.py migrar | verificar [instancia]")
+        sys.exit(2)
+    sys.exit(asyncio.run(_main(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)))
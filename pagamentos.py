@@ -0,0 +1,398 @@
+# ==========================================================
+# 💳 PAGAMENTOS DO MERCADO PAGO (LIVRO + PROCESSAMENTO EM SEGUNDO PLANO)
+# ==========================================================
+# O /webhook/pagamento estava definido duas vezes no main.py; o que
+# valia chamava o SDK do Mercado Pago (síncrono) e a criação da instância
+# na Evolution dentro do async def — travando o event loop — e a única
+# proteção contra aplicar o mesmo pagamento duas vezes era comparar
+# usuarios.id_pagamento_mp.
+#
+# Agora:
+#   - o webhook só grava o id no livro pagamentos_mp (PRIMARY KEY no id do
+#     pagamento) + pg_notify e responde: latência constante, sem SDK;
+#   - ProcessadorPagamentos (todo worker; FOR UPDATE SKIP LOCKED divide)
+#     consulta o status no MP (em thread) e, se aprovado, aplica numa
+#     transação que trava a linha do livro: conta ativa, +30 dias a partir
+#     do vencimento (ou de hoje), livro -> 'aplicado'. Linha 'aplicada'
+#     nunca volta: notificação repetida só incrementa o contador;
+#   - conta que estava pendente ganha uma linha em provisionamentos
+#     (outbox, mesma transação): outro laço cria a instância na Evolution
+#     e aponta o webhook, com retry e backoff. Instância que já existe
+#     conta como criada (repetir é seguro);
+#   - pagamento ainda pendente no MP fica 'aguardando': a notificação de
+#     mudança de status (mesmo id) reabre a linha.
+#   - o retorno do checkout do cartão (/pagamento/confirmar_sucesso) não
+#     mexe mais no vencimento: registra o payment_id no mesmo livro.
+#   - linha 'processando' tem dono (o processador que pegou): quem perdeu
+#     o prazo (consulta ao MP lenta) e viu a linha ir para outro worker
+#     não grava mais nada nela — nem aplica, nem devolve para a fila.
+# ==========================================================
+import os
+import uuid
+import random
+import socket
+import asyncio
+from datetime import date, timedelta
+
+from evolution import evolution_async, EnvioRecusado
+from logs import obter_logger, definir_correlacao, restaurar_correlacao
+
+PAGAMENTOS_LOTE = int(os.getenv("PAGAMENTOS_LOTE", 10))
+PAGAMENTOS_MAX_TENTATIVAS = int(os.getenv("PAGAMENTOS_MAX_TENTATIVAS", 8))
+PAGAMENTOS_LEASE_S = int(os.getenv("PAGAMENTOS_LEASE_S", 120))
+PROVISIONAR_MAX_TENTATIVAS = int(os.getenv("PROVISIONAR_MAX_TENTATIVAS", 10))
+DIAS_POR_PAGAMENTO = 30
+
+CANAL_PAGAMENTOS = "pagamentos_mp"
+DOMAIN_URL = os.getenv("DOMAIN_URL")
+
+# Status do MP que ainda podem virar "approved" (esperam a próxima notificação)
+STATUS_EM_ANDAMENTO = ("pending", "in_process", "authorized", "in_mediation")
+
+log = obter_logger("pagamento")
+
+# Migração 014
+DDL_PAGAMENTOS = """
+    CREATE TABLE IF NOT EXISTS pagamentos_mp (
+        id_pagamento VARCHAR(50) PRIMARY KEY,
+        status VARCHAR(15) NOT NULL DEFAULT 'recebido',
+        status_mp VARCHAR(30),
+        user_id INTEGER,
+        valor NUMERIC(10, 2),
+        notificacoes INTEGER NOT NULL DEFAULT 1,
+        tentativas INTEGER NOT NULL DEFAULT 0,
+        proxima_tentativa TIMESTAMP NOT NULL DEFAULT NOW(),
+        travado_ate TIMESTAMP,
+        erro TEXT,
+        recebido_em TIMESTAMP NOT NULL DEFAULT NOW(),
+        aplicado_em TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_pagamentos_mp_fila
+        ON pagamentos_mp (proxima_tentativa) WHERE status = 'recebido';
+
+    CREATE TABLE IF NOT EXISTS provisionamentos (
+        id BIGSERIAL PRIMARY KEY,
+        id_pagamento VARCHAR(50) UNIQUE REFERENCES pagamentos_mp(id_pagamento),
+        user_id INTEGER NOT NULL,
+        status VARCHAR(15) NOT NULL DEFAULT 'pendente',
+        tentativas INTEGER NOT NULL DEFAULT 0,
+        proxima_tentativa TIMESTAMP NOT NULL DEFAULT NOW(),
+        travado_ate TIMESTAMP,
+        erro TEXT,
+        criado_em TIMESTAMP NOT NULL DEFAULT NOW(),
+        concluido_em TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_provisionamentos_fila
+        ON provisionamentos (proxima_tentativa) WHERE status = 'pendente';
+"""
+
+# Migração 018: quem pegou a linha (só o dono grava o resultado)
+DDL_PAGAMENTOS_DONO = """
+    ALTER TABLE pagamentos_mp ADD COLUMN IF NOT EXISTS dono VARCHAR(80);
+    ALTER TABLE provisionamentos ADD COLUMN IF NOT EXISTS dono VARCHAR(80);
+"""
+
+
+def calcular_backoff(tentativas):
+    # 5s, 10s, 20s... (máx 30 min) com jitter
+    return min(1800, 5 * 2 ** (tentativas - 1)) * random.uniform(0.8, 1.2)
+
+
+def novo_vencimento(vencimento_atual, hoje=None):
+    """Ainda no prazo: acumula. Vencido (ou conta nova): a partir de hoje."""
+    hoje = hoje or date.today()
+    base = vencimento_atual if vencimento_atual and vencimento_atual > hoje else hoje
+    return base + timedelta(days=DIAS_POR_PAGAMENTO)
+
+
+# ==========================================================
+# WEBHOOK (só registra)
+# ==========================================================
+async def registrar_notificacao(pool, id_pagamento):
+    """
+    Uma ida ao banco. Id novo -> entra na fila. Id conhecido e ainda não
+    aplicado -> volta para a fila (o status no MP pode ter mudado).
+    """
+    await pool.execute(f"""
+        WITH nota AS (
+            INSERT INTO pagamentos_mp (id_pagamento) VALUES ($1)
+            ON CONFLICT (id_pagamento) DO UPDATE SET
+                notificacoes = pagamentos_mp.notificacoes + 1,
+                status = CASE WHEN pagamentos_mp.status IN ('aplicado', 'processando') THEN pagamentos_mp.status ELSE 'recebido' END,
+                tentativas = CASE WHEN pagamentos_mp.status IN ('aplicado', 'processando') THEN pagamentos_mp.tentativas ELSE 0 END,
+                proxima_tentativa = NOW()
+            RETURNING status
+        )
+        SELECT pg_notify('{CANAL_PAGAMENTOS}', $1) FROM nota WHERE status = 'recebido'
+    """, id_pagamento)
+
+
+# ==========================================================
+# PROCESSADOR (todo worker; o banco divide o trabalho)
+# ==========================================================
+class ProcessadorPagamentos:
+    def __init__(self, pool, sdk, lote=PAGAMENTOS_LOTE):
+        self.pool = pool
+        self.sdk = sdk
+        self.lote = lote
+        self._acordar = asyncio.Event()
+        self._conn_listen = None
+        self._tarefas = []
+        self._ao_notificar = lambda *_: self._acordar.set()
+        self.dono = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        # Métricas
+        self.aplicados = 0
+        self.aguardando = 0
+        self.ignorados = 0
+        self.repeticoes = 0
+        self.provisionados = 0
+        self.falhas_provisionamento = 0
+
+    async def iniciar(self):
+        # Tabelas: migrações 014 e 018 (migracoes.py)
+        self._conn_listen = await self.pool.acquire()
+        await self._conn_listen.add_listener(CANAL_PAGAMENTOS, self._ao_notificar)
+        self._tarefas = [
+            asyncio.create_task(self._loop()),
+            asyncio.create_task(self._loop_manutencao()),
+        ]
+        self._acordar.set()   # o que ficou na fila do último desligamento
+
+    async def parar(self):
+        for t in self._tarefas: t.cancel()
+        await asyncio.gather(*self._tarefas, return_exceptions=True)
+        self._tarefas = []
+        if self._conn_listen is not None:
+            try: await self._conn_listen.remove_listener(CANAL_PAGAMENTOS, self._ao_notificar)
+            except Exception: pass
+            await self.pool.release(self._conn_listen)
+            self._conn_listen = None
+
+    async def _reivindicar(self, tabela, chave, status_fila, campos):
+        return await self.pool.fetch(f"""
+            UPDATE {tabela} t
+            SET status = 'processando', dono = $2, travado_ate = NOW() + INTERVAL '{PAGAMENTOS_LEASE_S} seconds'
+            FROM (
+                SELECT {chave} FROM {tabela}
+                WHERE status = '{status_fila}' AND proxima_tentativa <= NOW()
+                ORDER BY proxima_tentativa LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            ) escolhidos
+            WHERE t.{chave} = escolhidos.{chave}
+            RETURNING {campos}
+        """, self.lote, self.dono)
+
+    # --- pagamento ---
+    async def _processar(self, item):
+        id_pagamento = item['id_pagamento']
+        try:
+            resposta = await asyncio.to_thread(lambda: self.sdk.payment().get(id_pagamento))
+            if not isinstance(resposta, dict) or resposta.get("status") != 200:
+                raise RuntimeError(f"Mercado Pago respondeu {resposta.get('status') if isinstance(resposta, dict) else resposta}")
+            dados = resposta.get("response") or {}
+        except Exception as e:
+            await self._repetir("pagamentos_mp", "id_pagamento", id_pagamento, item['tentativas'], e, PAGAMENTOS_MAX_TENTATIVAS, 'recebido')
+            return
+
+        status_mp = dados.get("status")
+        if status_mp != "approved":
+            final = 'aguardando' if status_mp in STATUS_EM_ANDAMENTO else 'ignorado'
+            # Chegou notificação nova enquanto consultávamos? Volta para a fila em vez de dormir
+            await self.pool.execute("""
+                UPDATE pagamentos_mp SET status = CASE WHEN notificacoes = $4 THEN $2 ELSE 'recebido' END,
+                    status_mp = $3, travado_ate = NULL, dono = NULL, proxima_tentativa = NOW()
+                WHERE id_pagamento = $1 AND status = 'processando' AND dono = $5
+            """, id_pagamento, final, status_mp, item['notificacoes'], self.dono)
+            if final == 'aguardando': self.aguardando += 1
+            else: self.ignorados += 1
+            log.info("Pagamento não aprovado", extra={"id_pagamento": id_pagamento, "status_mp": status_mp})
+            return
+
+        await self._aplicar(id_pagamento, dados)
+
+    async def _aplicar(self, id_pagamento, dados):
+        referencia = str(dados.get("external_reference") or "")
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # A trava na linha do livro (ainda nossa) é o que garante "uma vez só"
+                atual = await conn.fetchrow(
+                    "SELECT status, dono FROM pagamentos_mp WHERE id_pagamento = $1 FOR UPDATE", id_pagamento)
+                if atual is None or atual['status'] != 'processando' or atual['dono'] != self.dono:
+                    log.warning("Pagamento não é mais deste processador", extra={"id_pagamento": id_pagamento})
+                    return
+
+                # Cartão: external_reference = id do usuário. Pix: id_pagamento_mp gravado no registro/renovação
+                user = None
+                if referencia.isdigit():
+                    user = await conn.fetchrow(
+                        "SELECT id, status_conta, data_vencimento, id_pagamento_mp FROM usuarios WHERE id = $1 FOR UPDATE",
+                        int(referencia))
+                if user is None:
+                    user = await conn.fetchrow(
+                        "SELECT id, status_conta, data_vencimento, id_pagamento_mp FROM usuarios WHERE id_pagamento_mp = $1 FOR UPDATE",
+                        id_pagamento)
+                if user is None:
+                    await conn.execute("""
+                        UPDATE pagamentos_mp SET status = 'ignorado', status_mp = 'approved', travado_ate = NULL, dono = NULL,
+                            erro = 'usuário não encontrado' WHERE id_pagamento = $1
+                    """, id_pagamento)
+                    self.ignorados += 1
+                    log.warning("Pagamento aprovado sem usuário", extra={"id_pagamento": id_pagamento, "referencia": referencia})
+                    return
+
+                if await self._aplicado_sem_livro(conn, id_pagamento, dados, user):
+                    await conn.execute("""
+                        UPDATE pagamentos_mp SET status = 'aplicado', status_mp = 'approved', user_id = $2, valor = $3,
+                            travado_ate = NULL, dono = NULL, erro = 'aplicado antes do livro', aplicado_em = NOW()
+                        WHERE id_pagamento = $1
+                    """, id_pagamento, user['id'], dados.get("transaction_amount"))
+                    self.ignorados += 1
+                    log.info("Pagamento já aplicado antes do livro", extra={"id_pagamento": id_pagamento, "user_id": user['id']})
+                    return
+
+                # Plano escolhido no checkout do cartão vem no metadata da preferência
+                plano = (dados.get("metadata") or {}).get("plano")
+                nova_data = novo_vencimento(user['data_vencimento'])
+                await conn.execute("""
+                    UPDATE usuarios SET status_conta = 'ativo', data_vencimento = $2, id_pagamento_mp = $3,
+                        plano = COALESCE($4, plano)
+                    WHERE id = $1
+                """, user['id'], nova_data, id_pagamento, plano)
+                if user['status_conta'] == 'pendente':
+                    await conn.execute("""
+                        INSERT INTO provisionamentos (id_pagamento, user_id) VALUES ($1, $2)
+                        ON CONFLICT (id_pagamento) DO NOTHING
+                    """, id_pagamento, user['id'])
+                await conn.execute("""
+                    UPDATE pagamentos_mp SET status = 'aplicado', status_mp = 'approved', user_id = $2, valor = $3,
+                        travado_ate = NULL, dono = NULL, erro = NULL, aplicado_em = NOW()
+                    WHERE id_pagamento = $1
+                """, id_pagamento, user['id'], dados.get("transaction_amount"))
+        self.aplicados += 1
+        log.info("Pagamento aplicado", extra={"id_pagamento": id_pagamento, "user_id": user['id'], "vencimento": nova_data,
+                                              "provisionar": user['status_conta'] == 'pendente'})
+
+    async def _aplicado_sem_livro(self, conn, id_pagamento, dados, user):
+        """
+        Pagamento aprovado antes da migração 014 não tem linha no livro, mas
+        o webhook antigo (ou o /pagamento/confirmar_sucesso) pode já ter
+        aplicado: conta que já saiu de 'pendente' e aponta para este
+        pagamento (ou para a marca 'CARTAO_WEB') conta como aplicada.
+        Aprovado depois da migração: só o livro decide (um Pix de renovação
+        também aponta para o pagamento antes de ser pago).
+        """
+        aprovado_em = dados.get("date_approved")
+        if not aprovado_em:
+            return False
+        antes_do_livro = await conn.fetchval(
+            "SELECT $1::text::timestamptz < aplicada_em FROM schema_migracoes WHERE versao = 14", aprovado_em)
+        return bool(antes_do_livro) and user['status_conta'] != 'pendente' \
+            and user['id_pagamento_mp'] in (id_pagamento, 'CARTAO_WEB')
+
+    # --- provisionamento (outbox) ---
+    async def _provisionar(self, item):
+        user = await self.pool.fetchrow("SELECT instancia_wa, senha FROM usuarios WHERE id = $1", item['user_id'])
+        try:
+            if user is None: raise LookupError("usuário não existe mais")
+            evo = evolution_async()
+            try:
+                resp = await evo.create_instance(user['instancia_wa'], user['senha'])
+            except EnvioRecusado as e:
+                resp = e.resp     # 5xx no create: pode ter criado, confere abaixo
+            if resp.status_code >= 400:
+                # Já existe (tentativa anterior criou e caiu antes de concluir)? Então segue
+                estado = await evo.connection_state(user['instancia_wa'])
+                if estado.status_code != 200:
+                    raise RuntimeError(f"Evolution respondeu {resp.status_code} no create: {resp.text[:200]}")
+            resp = await evo.set_webhook(user['instancia_wa'], f"{DOMAIN_URL}/webhook/whatsapp")
+            if resp.status_code >= 400:
+                raise RuntimeError(f"Evolution respondeu {resp.status_code} no webhook/set: {resp.text[:200]}")
+        except Exception as e:
+            if not await self._repetir("provisionamentos", "id", item['id'], item['tentativas'], e, PROVISIONAR_MAX_TENTATIVAS, 'pendente'):
+                self.falhas_provisionamento += 1
+            return
+        await self.pool.execute("""
+            UPDATE provisionamentos SET status = 'concluido', concluido_em = NOW(), travado_ate = NULL, dono = NULL, erro = NULL
+            WHERE id = $1 AND status = 'processando' AND dono = $2
+        """, item['id'], self.dono)
+        self.provisionados += 1
+        log.info("Instância provisionada", extra={"instancia": user['instancia_wa'], "user_id": item['user_id']})
+
+    async def _repetir(self, tabela, chave, valor, tentativas, erro, maximo, status_fila):
+        """
+        Nova tentativa com backoff; passou do máximo -> 'erro' (False).
+        Só mexe na linha se ela ainda for nossa (prazo vencido = outro worker pegou).
+        """
+        tentativas += 1
+        texto = f"{type(erro).__name__}: {erro}"[:500]
+        if tentativas >= maximo:
+            await self.pool.execute(f"""
+                UPDATE {tabela} SET status = 'erro', tentativas = $2, erro = $3, travado_ate = NULL, dono = NULL
+                WHERE {chave} = $1 AND status = 'processando' AND dono = $4
+            """, valor, tentativas, texto, self.dono)
+            log.error("Desistindo depois de %s tentativas: %s", tentativas, texto, extra={"tabela": tabela, "chave": valor})
+            return False
+        await self.pool.execute(f"""
+            UPDATE {tabela} SET status = '{status_fila}', tentativas = $2, erro = $3, travado_ate = NULL, dono = NULL,
+                proxima_tentativa = NOW() + make_interval(secs => $4)
+            WHERE {chave} = $1 AND status = 'processando' AND dono = $5
+        """, valor, tentativas, texto, calcular_backoff(tentativas), self.dono)
+        self.repeticoes += 1
+        log.warning("Vai tentar de novo: %s", texto, extra={"tabela": tabela, "chave": valor, "tentativas": tentativas})
+        return True
+
+    async def _loop(self):
+        while True:
+            trabalhou = False
+            try:
+                for item in await self._reivindicar("pagamentos_mp", "id_pagamento", "recebido",
+                                                     "t.id_pagamento, t.tentativas, t.notificacoes"):
+                    trabalhou = True
+                    token = definir_correlacao(f"pagamento-{item['id_pagamento']}")
+                    try: await self._processar(item)
+                    finally: restaurar_correlacao(token)
+                for item in await self._reivindicar("provisionamentos", "id", "pendente",
+                                                     "t.id, t.id_pagamento, t.user_id, t.tentativas"):
+                    trabalhou = True
+                    token = definir_correlacao(f"pagamento-{item['id_pagamento']}")
+                    try: await self._provisionar(item)
+                    finally: restaurar_correlacao(token)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Processador de pagamentos: %s", e)
+                await asyncio.sleep(5)
+            if not trabalhou:
+                # Acorda no NOTIFY; a cada 5s de qualquer jeito (retries com backoff vencendo)
+                try:
+                    await asyncio.wait_for(self._acordar.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    pass
+                self._acordar.clear()
+
+    async def _loop_manutencao(self):
+        while True:
+            await asyncio.sleep(60)
+            try:
+                # Worker que morreu no meio: devolve para a fila
+                await self.pool.execute(
+                    "UPDATE pagamentos_mp SET status = 'recebido', travado_ate = NULL, dono = NULL WHERE status = 'processando' AND travado_ate < NOW()")
+                await self.pool.execute(
+                    "UPDATE provisionamentos SET status = 'pendente', travado_ate = NULL, dono = NULL WHERE status = 'processando' AND travado_ate < NOW()")
+            except Exception as e:
+                log.warning("Manutenção dos pagamentos: %s", e)
+
+    async def estatisticas(self):
+        livro = await self.pool.fetch("SELECT status, COUNT(*) AS qtd FROM pagamentos_mp GROUP BY status")
+        prov = await self.pool.fetch("SELECT status, COUNT(*) AS qtd FROM provisionamentos WHERE status <> 'concluido' GROUP BY status")
+        return {
+            "livro": {r['status']: r['qtd'] for r in livro},
+            "provisionamentos": {r['status']: r['qtd'] for r in prov},
+            "aplicados": self.aplicados,
+            "aguardando": self.aguardando,
+            "ignorados": self.ignorados,
+            "repeticoes": self.repeticoes,
+            "provisionados": self.provisionados,
+            "falhas_provisionamento": self.falhas_provisionamento,
+        }
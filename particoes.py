@@ -0,0 +1,613 @@
+# ==========================================================
+# 🗓️ PARTIÇÕES MENSAIS + ARQUIVO FRIO (historico_mensagens, chat_logs)
+# ==========================================================
+# As duas tabelas só crescem e só são lidas por instância + janela
+# recente. Particionadas por mês (RANGE em data_hora):
+#   - consulta com filtro de data só abre as partições do período;
+#   - apagar/arquivar um mês inteiro é DETACH + DROP, não um DELETE
+#     gigante que incha a tabela e o autovacuum.
+#
+# CONVERSÃO (uma vez por tabela, manual, num horário calmo):
+#     python particoes.py converter historico_mensagens
+#   A tabela antiga NÃO é copiada: vira a partição "<tabela>_legado"
+#   (MINVALUE até o 1º dia do mês que vem). Antes da troca, sem travar
+#   escritas: índice único (id, data_hora) CONCURRENTLY e um CHECK
+#   validado com o limite — assim o ATTACH não relê a tabela. A troca em
+#   si é uma transação curta (lock_timeout: se a tabela estiver ocupada,
+#   desiste e dá para rodar de novo). Sequência do id, índices e GRANTs
+#   (chat_logs é escrito por outro sistema) passam para a tabela nova.
+#
+# MANUTENÇÃO (um worker só, advisory lock, a cada PARTICOES_INTERVALO_S):
+#   - cria as partições do mês atual até PARTICOES_MESES_FRENTE à frente
+#     (se algo caiu na partição DEFAULT nesse intervalo, é movido junto);
+#   - mês inteiro mais velho que HISTORICO_RETENCAO_MESES: exporta para
+#     arquivo_frio/<tabela>/<AAAA-MM>_<origem>.parquet (zstd, ordenado por
+#     instância: os filtros de leitura pulam row groups), confere a
+#     contagem, e numa transação só faz DETACH + registro no catálogo
+#     (arquivo_particoes) + DROP. A mensagem está no banco ou no arquivo,
+#     nunca nos dois "pela metade". Na partição _legado (vários meses) o
+#     mesmo vale mês a mês com DELETE.
+#   - sem pyarrow instalado o arquivo sai como .csv.gz.
+#
+# LEITURA: ler_arquivo_historico() procura nos meses arquivados (mais
+# novos primeiro) as mensagens de uma conversa com id < antes_id.
+# ==========================================================
+import os
+import re
+import csv
+import sys
+import gzip
+import asyncio
+from datetime import date, datetime
+
+from banco import garantir_indices
+from logs import configurar_logs, obter_logger
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    TEM_PYARROW = True
+except ImportError:
+    TEM_PYARROW = False
+
+log = obter_logger("particoes")
+
+PARTICOES_MESES_FRENTE = int(os.getenv("PARTICOES_MESES_FRENTE", 3))
+HISTORICO_RETENCAO_MESES = int(os.getenv("HISTORICO_RETENCAO_MESES", 12))   # 0 = nunca arquiva
+PARTICOES_INTERVALO_S = int(os.getenv("PARTICOES_INTERVALO_S", 6 * 3600))
+PARTICOES_LOCK_TIMEOUT = os.getenv("PARTICOES_LOCK_TIMEOUT", "5s")            # DDL desiste em vez de enfileirar
+PARTICOES_COMPRESSAO = os.getenv("PARTICOES_COMPRESSAO", "zstd")
+ARQUIVO_LOTE = int(os.getenv("ARQUIVO_LOTE", 50000))                          # linhas por row group / lote
+PASTA_ARQUIVO = os.getenv("PASTA_ARQUIVO", "arquivo_frio")
+
+CHAVE_PARTICOES = 728409       # advisory lock da manutenção
+COLUNA_PARTICAO = "data_hora"
+DATA_SEM_DATA = "2000-01-01"   # linhas antigas com data_hora NULL (partição exige valor)
+
+TABELAS_PARTICIONADAS = ("historico_mensagens", "chat_logs")
+
+DDL_ARQUIVO = """
+    -- Catálogo do arquivo frio: um arquivo por (tabela, mês, partição de origem)
+    CREATE TABLE IF NOT EXISTS arquivo_particoes (
+        tabela VARCHAR(63) NOT NULL,
+        mes DATE NOT NULL,
+        caminho TEXT NOT NULL,
+        formato VARCHAR(10) NOT NULL,
+        linhas BIGINT NOT NULL,
+        bytes BIGINT NOT NULL,
+        arquivado_em TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (tabela, mes, caminho)
+    );
+"""
+
+_RE_LIMITES = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+
+# ==========================================================
+# DATAS / NOMES
+# ==========================================================
+def inicio_do_mes(d):
+    return date(d.year, d.month, 1)
+
+
+def somar_meses(d, n):
+    total = d.year * 12 + (d.month - 1) + n
+    return date(total // 12, total % 12 + 1, 1)
+
+
+def nome_particao(tabela, mes):
+    return f"{tabela}_p{mes:%Y_%m}"
+
+
+def _limite(texto):
+    """'MINVALUE' -> None; "'2025-03-01 00:00:00'" -> date(2025, 3, 1)."""
+    texto = texto.strip()
+    if texto.upper() == "MINVALUE": return None
+    return date.fromisoformat(texto.strip("'")[:10])
+
+
+def _nome_legado(nome):
+    return f"{nome[:55]}_legado"
+
+
+# ==========================================================
+# CATÁLOGO DO POSTGRES
+# ==========================================================
+async def _tipo_tabela(conn, tabela):
+    """'p' = particionada, 'r' = comum, None = não existe."""
+    return await conn.fetchval("SELECT relkind::text FROM pg_class WHERE oid = to_regclass($1)", tabela)
+
+
+async def listar_particoes(conn, tabela):
+    """[{nome, de, ate, padrao}] — de/ate: date (de None = MINVALUE)."""
+    linhas = await conn.fetch("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS limites
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass($1)
+    """, tabela)
+    particoes = []
+    for r in linhas:
+        m = _RE_LIMITES.search(r['limites'] or "")
+        if m:
+            particoes.append({"nome": r['relname'], "de": _limite(m.group(1)), "ate": _limite(m.group(2)), "padrao": False})
+        else:
+            particoes.append({"nome": r['relname'], "de": None, "ate": None, "padrao": True})
+    return sorted(particoes, key=lambda p: (p["padrao"], p["de"] or date.min))
+
+
+# ==========================================================
+# CONVERSÃO (CLI)
+# ==========================================================
+async def converter(pool, tabela):
+    """Transforma `tabela` em particionada por mês. Devolve False se já era."""
+    if tabela not in TABELAS_PARTICIONADAS:
+        raise ValueError(f"Tabela não prevista: {tabela}")
+    legado = f"{tabela}_legado"
+    restricao = f"ck_{tabela}_corte"
+    corte = somar_meses(inicio_do_mes(date.today()), 1)
+
+    async with pool.acquire() as conn:
+        tipo = await _tipo_tabela(conn, tabela)
+        if tipo is None: raise ValueError(f"Tabela {tabela} não existe.")
+        if tipo == "p":
+            log.info("Tabela já é particionada", extra={"tabela": tabela})
+            return False
+        tem_id = bool(await conn.fetchval("""
+            SELECT TRUE FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = $1 AND column_name = 'id'
+        """, tabela))
+
+        # 1) Preparação: nada aqui trava escrita por muito tempo
+        log.info("Preparando conversão (pode demorar em tabela grande)", extra={"tabela": tabela})
+        # Índices declarados no código: depois da troca não dá mais para criá-los CONCURRENTLY na tabela-mãe
+        from migracoes import TODOS_INDICES
+        await garantir_indices(pool, [i for i in TODOS_INDICES if f"ON {tabela} (" in i[1]], CHAVE_PARTICOES)
+        await conn.execute(f"UPDATE {tabela} SET {COLUNA_PARTICAO} = '{DATA_SEM_DATA}' WHERE {COLUNA_PARTICAO} IS NULL", timeout=None)
+        if tem_id:
+            await conn.execute(
+                f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {tabela}_id_data ON {tabela} (id, {COLUNA_PARTICAO})", timeout=None)
+        async with conn.transaction():
+            await conn.execute(f"SET LOCAL lock_timeout = '{PARTICOES_LOCK_TIMEOUT}'")
+            await conn.execute(f"ALTER TABLE {tabela} DROP CONSTRAINT IF EXISTS {restricao}")
+            await conn.execute(f"""
+                ALTER TABLE {tabela} ADD CONSTRAINT {restricao}
+                CHECK ({COLUNA_PARTICAO} IS NOT NULL AND {COLUNA_PARTICAO} < '{corte}') NOT VALID
+            """)
+        await conn.execute(f"ALTER TABLE {tabela} VALIDATE CONSTRAINT {restricao}", timeout=None)
+
+        # 2) Troca: transação curta
+        log.info("Trocando pela tabela particionada", extra={"tabela": tabela})
+        async with conn.transaction():
+            await conn.execute(f"SET LOCAL lock_timeout = '{PARTICOES_LOCK_TIMEOUT}'")
+            await conn.execute(f"LOCK TABLE {tabela} IN ACCESS EXCLUSIVE MODE")
+            indices = await conn.fetch("""
+                SELECT c.relname, pg_get_indexdef(i.indexrelid) AS definicao, i.indisprimary, i.indisunique
+                FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE i.indrelid = to_regclass($1)
+            """, tabela)
+            sequencia = await conn.fetchval("SELECT pg_get_serial_sequence($1, 'id')", tabela) if tem_id else None
+            permissoes = await conn.fetch("""
+                SELECT grantee, privilege_type FROM information_schema.role_table_grants
+                WHERE table_schema = current_schema() AND table_name = $1 AND grantee <> current_user
+            """, tabela)
+            pk_antiga = await conn.fetchval("""
+                SELECT conname FROM pg_constraint WHERE conrelid = to_regclass($1) AND contype = 'p'
+            """, tabela)
+
+            await conn.execute(f"ALTER TABLE {tabela} RENAME TO {legado}")
+            await conn.execute(f"ALTER TABLE {legado} ALTER COLUMN {COLUNA_PARTICAO} SET NOT NULL")
+            if tem_id:
+                # PK de partição precisa conter a chave: (id, data_hora), aproveitando o índice do passo 1
+                if pk_antiga:
+                    await conn.execute(f'ALTER TABLE {legado} DROP CONSTRAINT "{pk_antiga}"')
+                await conn.execute(f"ALTER TABLE {legado} ADD CONSTRAINT {legado}_pkey PRIMARY KEY USING INDEX {tabela}_id_data")
+            for idx in indices:
+                if idx['relname'] in (pk_antiga, f"{tabela}_id_data"): continue
+                await conn.execute(f'ALTER INDEX "{idx["relname"]}" RENAME TO "{_nome_legado(idx["relname"])}"')
+
+            await conn.execute(f"CREATE TABLE {tabela} (LIKE {legado} INCLUDING DEFAULTS) PARTITION BY RANGE ({COLUNA_PARTICAO})")
+            if tem_id:
+                await conn.execute(f"ALTER TABLE {tabela} ADD CONSTRAINT {tabela}_pkey PRIMARY KEY (id, {COLUNA_PARTICAO})")
+            for idx in indices:
+                if idx['indisunique']:
+                    if not idx['indisprimary'] and idx['relname'] != f"{tabela}_id_data":
+                        log.warning("Índice único fica só na partição _legado (não contém %s)", COLUNA_PARTICAO,
+                                    extra={"tabela": tabela, "indice": idx["relname"]})
+                    continue
+                # A definição foi lida antes do RENAME: "ON <tabela>" agora é a tabela particionada
+                # (tabela vazia: instantâneo; no ATTACH o índice igual do _legado é reaproveitado)
+                await conn.execute(idx['definicao'])
+            if sequencia:
+                await conn.execute(f"ALTER SEQUENCE {sequencia} OWNED BY {tabela}.id")
+            for p in permissoes:
+                quem = "PUBLIC" if p['grantee'] == "PUBLIC" else f'"{p["grantee"]}"'
+                await conn.execute(f"GRANT {p['privilege_type']} ON {tabela} TO {quem}")
+
+            await conn.execute(f"ALTER TABLE {tabela} ATTACH PARTITION {legado} FOR VALUES FROM (MINVALUE) TO ('{corte}')")
+            await conn.execute(f"ALTER TABLE {legado} DROP CONSTRAINT {restricao}")
+            await conn.execute(f"CREATE TABLE {tabela}_padrao PARTITION OF {tabela} DEFAULT")
+
+        # 3) Meses à frente
+        criadas = await garantir_meses(conn, tabela)
+        log.info("Tabela particionada", extra={"tabela": tabela, "particoes_criadas": len(criadas)})
+    return True
+
+
+# ==========================================================
+# MANUTENÇÃO
+# ==========================================================
+async def criar_particao(conn, tabela, mes):
+    """Cria a partição do mês, movendo o que tiver caído na DEFAULT nesse intervalo."""
+    nome, fim = nome_particao(tabela, mes), somar_meses(mes, 1)
+    async with conn.transaction():
+        await conn.execute(f"SET LOCAL lock_timeout = '{PARTICOES_LOCK_TIMEOUT}'")
+        await conn.execute(f"CREATE TABLE {nome} (LIKE {tabela} INCLUDING DEFAULTS)")
+        if await _tipo_tabela(conn, f"{tabela}_padrao"):
+            await conn.execute(f"""
+                WITH movidas AS (
+                    DELETE FROM {tabela}_padrao
+                    WHERE {COLUNA_PARTICAO} >= '{mes}' AND {COLUNA_PARTICAO} < '{fim}'
+                    RETURNING *
+                )
+                INSERT INTO {nome} SELECT * FROM movidas
+            """)
+        await conn.execute(f"ALTER TABLE {tabela} ATTACH PARTITION {nome} FOR VALUES FROM ('{mes}') TO ('{fim}')")
+    return nome
+
+
+async def garantir_meses(conn, tabela, meses_frente=PARTICOES_MESES_FRENTE):
+    """Partições do mês atual até meses_frente; devolve os nomes criados."""
+    particoes = await listar_particoes(conn, tabela)
+    atual = inicio_do_mes(date.today())
+    criadas = []
+    for n in range(meses_frente + 1):
+        mes = somar_meses(atual, n)
+        coberto = any(not p["padrao"] and (p["de"] is None or p["de"] <= mes) and p["ate"] > mes for p in particoes)
+        if not coberto:
+            criadas.append(await criar_particao(conn, tabela, mes))
+    return criadas
+
+
+def _tipo_arrow(tipo_pg):
+    if tipo_pg in ("int2", "int4", "int8"): return pa.int64()
+    if tipo_pg in ("float4", "float8"): return pa.float64()
+    if tipo_pg == "bool": return pa.bool_()
+    if tipo_pg == "timestamp": return pa.timestamp("us")
+    if tipo_pg == "timestamptz": return pa.timestamp("us", tz="UTC")
+    if tipo_pg == "date": return pa.date32()
+    return pa.string()
+
+
+class _EscritorParquet:
+    extensao, formato = ".parquet", "parquet"
+
+    def __init__(self, caminho, colunas):
+        # colunas: [(nome, tipo_pg)] — schema fixo (um lote só de NULL não pode mudar o tipo)
+        self.schema = pa.schema([(n, _tipo_arrow(t)) for n, t in colunas])
+        self._texto = [n for n, t in colunas if self.schema.field(n).type == pa.string()]
+        self._w = pq.ParquetWriter(caminho, self.schema, compression=PARTICOES_COMPRESSAO)
+
+    def escrever(self, linhas):
+        dados = {n: [l[n] for l in linhas] for n in self.schema.names}
+        for n in self._texto:
+            dados[n] = [v if v is None or isinstance(v, str) else str(v) for v in dados[n]]
+        self._w.write_table(pa.Table.from_pydict(dados, schema=self.schema), row_group_size=ARQUIVO_LOTE)
+
+    def fechar(self):
+        self._w.close()
+
+
+class _EscritorCsvGz:
+    extensao, formato = ".csv.gz", "csv.gz"
+
+    def __init__(self, caminho, colunas):
+        self._nomes = [n for n, _ in colunas]
+        self._f = gzip.open(caminho, "wt", newline="", encoding="utf-8")
+        self._w = csv.writer(self._f)
+        self._w.writerow(self._nomes)
+
+    def escrever(self, linhas):
+        self._w.writerows([["" if l[n] is None else l[n] for n in self._nomes] for l in linhas])
+
+    def fechar(self):
+        self._f.close()
+
+
+async def exportar(conn, tabela, origem, mes, filtro=""):
+    """
+    Exporta as linhas de `origem` (partição) para o arquivo frio, ordenadas
+    por instância. Devolve (caminho, formato, linhas, bytes).
+    """
+    classe = _EscritorParquet if TEM_PYARROW else _EscritorCsvGz
+    pasta = os.path.join(PASTA_ARQUIVO, tabela)
+    os.makedirs(pasta, exist_ok=True)
+    caminho = os.path.join(pasta, f"{mes:%Y-%m}_{origem}{classe.extensao}")
+    temporario = caminho + ".part"
+
+    sql = f"SELECT * FROM {origem} {filtro} ORDER BY instancia, {COLUNA_PARTICAO}"
+    linhas = 0
+    try:
+        async with conn.transaction(readonly=True):
+            comando = await conn.prepare(sql)
+            colunas = [(a.name, a.type.name) for a in comando.get_attributes()]
+            escritor = await asyncio.to_thread(classe, temporario, colunas)
+            try:
+                cursor = await comando.cursor()
+                while True:
+                    lote = await cursor.fetch(ARQUIVO_LOTE)
+                    if not lote: break
+                    await asyncio.to_thread(escritor.escrever, [dict(r) for r in lote])
+                    linhas += len(lote)
+            finally:
+                await asyncio.to_thread(escritor.fechar)
+        os.replace(temporario, caminho)
+    except BaseException:
+        _apagar(temporario)
+        raise
+    return caminho, classe.formato, linhas, os.path.getsize(caminho)
+
+
+async def _registrar(conn, tabela, mes, caminho, formato, linhas, tamanho):
+    await conn.execute("""
+        INSERT INTO arquivo_particoes (tabela, mes, caminho, formato, linhas, bytes)
+        VALUES ($1, $2, $3, $4, $5, $6)
+        ON CONFLICT (tabela, mes, caminho) DO UPDATE
+        SET linhas = EXCLUDED.linhas, bytes = EXCLUDED.bytes, arquivado_em = NOW()
+    """, tabela, mes, caminho, formato, linhas, tamanho)
+
+
+def _apagar(caminho):
+    try: os.remove(caminho)
+    except OSError: pass
+
+
+async def arquivar(conn, tabela, retencao_meses=HISTORICO_RETENCAO_MESES):
+    """Arquiva os meses inteiros anteriores ao corte. Devolve [(origem, mes, linhas)]."""
+    if retencao_meses <= 0: return []
+    corte = somar_meses(inicio_do_mes(date.today()), -retencao_meses)
+    feitos = []
+    for p in await listar_particoes(conn, tabela):
+        if p["padrao"]: continue
+        if p["de"] is None or p["ate"] != somar_meses(p["de"], 1):
+            feitos += await _arquivar_por_mes(conn, tabela, p, corte)
+        elif p["ate"] <= corte:
+            feitos += await _arquivar_particao(conn, tabela, p)
+    return feitos
+
+
+async def _arquivar_particao(conn, tabela, p):
+    """
+    Partição de um mês: exporta, e conferência + DETACH + catálogo + DROP
+    numa transação. A contagem (mês inteiro) roda antes do DETACH, só com
+    SHARE na partição (barra escrita nela, não no resto da tabela): o
+    ACCESS EXCLUSIVE do DETACH na tabela-mãe fica só para o final curto.
+    """
+    caminho, formato, linhas, tamanho = await exportar(conn, tabela, p["nome"], p["de"])
+    async with conn.transaction():
+        await conn.execute(f"SET LOCAL lock_timeout = '{PARTICOES_LOCK_TIMEOUT}'")
+        await conn.execute(f"LOCK TABLE {p['nome']} IN SHARE MODE")
+        atual = await conn.fetchval(f"SELECT COUNT(*) FROM {p['nome']}")
+        if atual != linhas:
+            # Chegou linha durante a exportação: desfaz e tenta na próxima rodada
+            raise RuntimeError(f"{p['nome']}: {atual} linhas, exportadas {linhas}")
+        await conn.execute(f"ALTER TABLE {tabela} DETACH PARTITION {p['nome']}")
+        await _registrar(conn, tabela, p["de"], caminho, formato, linhas, tamanho)
+        await conn.execute(f"DROP TABLE {p['nome']}")
+    log.info("Partição arquivada", extra={"particao": p["nome"], "linhas": linhas, "kb": tamanho // 1024})
+    return [(p["nome"], p["de"], linhas)]
+
+
+async def _arquivar_por_mes(conn, tabela, p, corte):
+    """Partição com vários meses (_legado): exporta e apaga mês a mês até o corte."""
+    feitos = []
+    menor = await conn.fetchval(f"SELECT MIN({COLUNA_PARTICAO}) FROM {p['nome']}")
+    mes = inicio_do_mes(menor) if menor else None
+    while mes is not None and mes < corte:
+        fim = somar_meses(mes, 1)
+        filtro = f"WHERE {COLUNA_PARTICAO} >= '{mes}' AND {COLUNA_PARTICAO} < '{fim}'"
+        caminho, formato, linhas, tamanho = await exportar(conn, tabela, p["nome"], mes, filtro)
+        if linhas:
+            async with conn.transaction():
+                apagadas = int((await conn.execute(f"DELETE FROM {p['nome']} {filtro}", timeout=None)).split()[-1])
+                if apagadas != linhas:
+                    raise RuntimeError(f"{p['nome']} {mes:%Y-%m}: {apagadas} linhas, exportadas {linhas}")
+                await _registrar(conn, tabela, mes, caminho, formato, linhas, tamanho)
+            feitos.append((p["nome"], mes, linhas))
+            log.info("Mês arquivado", extra={"particao": p["nome"], "mes": f"{mes:%Y-%m}", "linhas": linhas})
+        else:
+            _apagar(caminho)
+        mes = fim
+
+    # Esvaziou e já passou do corte: a partição sai
+    if p["ate"] <= corte and not await conn.fetchval(f"SELECT EXISTS (SELECT 1 FROM {p['nome']})"):
+        async with conn.transaction():
+            await conn.execute(f"SET LOCAL lock_timeout = '{PARTICOES_LOCK_TIMEOUT}'")
+            await conn.execute(f"ALTER TABLE {tabela} DETACH PARTITION {p['nome']}")
+            await conn.execute(f"DROP TABLE {p['nome']}")
+        log.info("Partição vazia removida", extra={"particao": p["nome"]})
+    return feitos
+
+
+class ManutencaoParticoes:
+    def __init__(self, pool, intervalo=PARTICOES_INTERVALO_S):
+        self.pool = pool
+        self.intervalo = intervalo
+        self._tarefa = None
+
+        # Métricas
+        self.execucoes = 0
+        self.ultima_execucao = None
+        self.ultimo_erro = None
+        self.criadas = []
+        self.arquivadas = []
+        self.nao_particionadas = []
+
+    async def iniciar(self):
+        # Catálogo: migração 009 (migracoes.py)
+        self._tarefa = asyncio.create_task(self._loop())
+
+    async def parar(self):
+        if self._tarefa:
+            self._tarefa.cancel()
+            await asyncio.gather(self._tarefa, return_exceptions=True)
+            self._tarefa = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.executar()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.ultimo_erro = str(e)
+                log.warning("Manutenção de partições falhou: %s", e)
+            await asyncio.sleep(self.intervalo)
+
+    async def executar(self):
+        """Uma rodada. False se outro worker já está fazendo."""
+        async with self.pool.acquire() as conn:
+            if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", CHAVE_PARTICOES):
+                return False
+            try:
+                nao_particionadas = []
+                for tabela in TABELAS_PARTICIONADAS:
+                    if await _tipo_tabela(conn, tabela) != "p":
+                        nao_particionadas.append(tabela)
+                        continue
+                    self.criadas += await garantir_meses(conn, tabela)
+                    self.arquivadas += [f"{o} {m:%Y-%m} ({n})" for o, m, n in await arquivar(conn, tabela)]
+                self.nao_particionadas = nao_particionadas
+                self.criadas, self.arquivadas = self.criadas[-50:], self.arquivadas[-50:]
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1)", CHAVE_PARTICOES)
+
+        self.execucoes += 1
+        self.ultima_execucao = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.ultimo_erro = None
+        return True
+
+    def estatisticas(self):
+        return {
+            "execucoes": self.execucoes,
+            "ultima_execucao": self.ultima_execucao,
+            "ultimo_erro": self.ultimo_erro,
+            "particoes_criadas": self.criadas,
+            "meses_arquivados": self.arquivadas,
+            "nao_particionadas": self.nao_particionadas,
+            "formato_arquivo": "parquet" if TEM_PYARROW else "csv.gz",
+        }
+
+
+async def situacao(pool):
+    """Partições de cada tabela, linhas na DEFAULT e o que já está no arquivo frio."""
+    resultado = {}
+    async with pool.acquire() as conn:
+        for tabela in TABELAS_PARTICIONADAS:
+            tipo = await _tipo_tabela(conn, tabela)
+            if tipo != "p":
+                resultado[tabela] = {"particionada": False}
+                continue
+            particoes = await listar_particoes(conn, tabela)
+            padrao = next((p["nome"] for p in particoes if p["padrao"]), None)
+            resultado[tabela] = {
+                "particionada": True,
+                "particoes": [{"nome": p["nome"], "de": str(p["de"]) if p["de"] else None,
+                               "ate": str(p["ate"]) if p["ate"] else None} for p in particoes if not p["padrao"]],
+                # Deveria ser sempre 0: linha aqui = mês sem partição criada
+                "linhas_fora_de_particao": await conn.fetchval(f"SELECT COUNT(*) FROM {padrao}") if padrao else None,
+            }
+        arquivos = await conn.fetch("""
+            SELECT tabela, COUNT(*) AS arquivos, SUM(linhas) AS linhas, SUM(bytes) AS bytes,
+                   MIN(mes) AS de, MAX(mes) AS ate
+            FROM arquivo_particoes GROUP BY tabela
+        """)
+    for a in arquivos:
+        resultado.setdefault(a['tabela'], {})["arquivo"] = {
+            "arquivos": a['arquivos'], "linhas": a['linhas'], "bytes": a['bytes'], "de": str(a['de']), "ate": str(a['ate'])}
+    return resultado
+
+
+# ==========================================================
+# LEITURA DO ARQUIVO FRIO
+# ==========================================================
+COLUNAS_HISTORICO = ["id", "from_me", "conteudo", "data_hora", "nome_atendente"]
+
+
+def _ler_arquivo(caminho, filtros, colunas):
+    """Linhas (dicts) de um arquivo do catálogo que batem com os filtros {coluna: valor}."""
+    if caminho.endswith(".parquet"):
+        if not TEM_PYARROW:
+            raise RuntimeError("pyarrow não instalado: não dá para ler o arquivo .parquet")
+        filtro = [(c, "==", v) for c, v in filtros.items()]
+        return pq.read_table(caminho, columns=colunas, filters=filtro).to_pylist()
+    with gzip.open(caminho, "rt", newline="", encoding="utf-8") as f:
+        return [{c: l[c] for c in colunas} for l in csv.DictReader(f)
+                if all(l.get(c) == v for c, v in filtros.items())]
+
+
+def _formatar_historico(linha):
+    # Mesmo formato de historico.ler_mensagens (no .csv.gz tudo vem como texto)
+    from_me = linha['from_me']
+    return {
+        "id": int(linha['id']),
+        "fromMe": from_me if isinstance(from_me, bool) else from_me in ("True", "true", "t"),
+        "text": linha['conteudo'],
+        "timestamp": str(linha['data_hora']) if linha['data_hora'] else None,
+        "nome_atendente": linha['nome_atendente'] or None,
+    }
+
+
+async def ler_arquivo_historico(pool, instancia, jid, antes_id=None, limite=50):
+    """
+    Mensagens arquivadas da conversa com id < antes_id (as `limite` mais
+    novas, em ordem cronológica). Lê mês a mês, do mais novo para o mais
+    velho, até juntar `limite`. antes_id da resposta = cursor da próxima página.
+    """
+    arquivos = await pool.fetch("""
+        SELECT mes, caminho FROM arquivo_particoes
+        WHERE tabela = 'historico_mensagens' ORDER BY mes DESC, caminho
+    """)
+    msgs = []
+    for a in arquivos:
+        try:
+            linhas = await asyncio.to_thread(_ler_arquivo, a['caminho'],
+                                             {"instancia": instancia, "remote_jid": jid}, COLUNAS_HISTORICO)
+        except FileNotFoundError:
+            log.warning("Arquivo frio sumiu", extra={"caminho": a["caminho"]})
+            continue
+        msgs += [m for m in map(_formatar_historico, linhas) if antes_id is None or m["id"] < antes_id]
+        if len(msgs) >= limite: break
+
+    msgs = sorted(msgs, key=lambda m: m["id"])[-limite:]
+    return {"mensagens": msgs, "antes_id": msgs[0]["id"] if len(msgs) == limite else None}
+
+
+# ==========================================================
+# CLI
+# ==========================================================
+async def _main(comando, tabela):
+    from banco import iniciar_pool_async, pool_async, fechar_pool_async
+    configurar_logs()
+    await iniciar_pool_async()
+    try:
+        if comando == "converter":
+            await converter(pool_async(), tabela)
+        elif comando == "manter":
+            manutencao = ManutencaoParticoes(pool_async())
+            if not await manutencao.executar():
+                print("⏳ Outro processo está fazendo a manutenção agora.")
+            print(manutencao.estatisticas())
+        else:
+            for nome, info in (await situacao(pool_async())).items():
+                print(f"🗓️ {nome}: {info}")
+    finally:
+        await fechar_pool_async()
+    return 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("converter", "manter", "situacao") \
+            or (sys.argv[1] == "converter" and (len(sys.argv) < 3 or sys.argv[2] not in TABELAS_PARTICIONADAS)):
+        print(f"Uso: python particoes.py converter {'|'.join(TABELAS_PARTICIONADAS)} | manter | situacao")
+        sys.exit(2)
+    sys.exit(asyncio.run(_main(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)))
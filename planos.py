@@ -0,0 +1,225 @@
+# ==========================================================
+# 🎟️ DIREITOS DOS PLANOS (FOTO EM MEMÓRIA)
+# ==========================================================
+# As regras de plano eram lidas do banco a cada verificação, cada rota do
+# seu jeito: /salvar usava um dicionário fixo (LIMITES) que não batia com
+# a tabela `regras`, o verificador de limite fazia COUNT(*) dos gatilhos e
+# consultava `regras_planos`.
+#
+# Agora:
+#   - cada worker guarda uma foto de planos_comerciais + regras (+ as
+#     chaves de regras_planos que não existem em `regras`, tabela antiga
+#     do /admin/regras). Verificar = consulta num dict, sem I/O;
+#   - quem escreve em planos/regras chama invalidar_direitos(cur) dentro
+#     da transação: o pg_notify só sai no COMMIT e todos os workers (LISTEN)
+#     recarregam a foto. A cada DIREITOS_RECARREGAR_S recarrega de qualquer
+#     jeito, caso um NOTIFY se perca;
+#   - quantidade de gatilhos por instância: contador em contagem_gatilhos,
+#     mantido por trigger em respostas_automacao (vale para qualquer
+#     caminho que insira/apague gatilhos).
+# Convenção das regras (a mesma do painel): "max_*" usa `limite`
+# (0 = ilimitado); as demais usam `ativo`.
+# ==========================================================
+import os
+import asyncio
+import time
+
+from logs import obter_logger
+
+log = obter_logger("planos")
+
+DIREITOS_RECARREGAR_S = float(os.getenv("DIREITOS_RECARREGAR_S", 300))
+CANAL_DIREITOS = "direitos_planos"
+PLANO_PADRAO = "Básico"                 # usuário sem plano / plano que não existe mais
+
+# Regra que o plano não tem cadastrada
+PADROES = {"max_gatilhos": 5}
+
+DDL_DIREITOS = """
+    CREATE TABLE IF NOT EXISTS contagem_gatilhos (
+        instancia VARCHAR(100) PRIMARY KEY,
+        qtd INTEGER NOT NULL DEFAULT 0
+    );
+
+    CREATE OR REPLACE FUNCTION contar_gatilhos() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('DELETE', 'UPDATE') THEN
+            UPDATE contagem_gatilhos SET qtd = qtd - 1 WHERE instancia = OLD.instancia;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO contagem_gatilhos (instancia, qtd) VALUES (NEW.instancia, 1)
+            ON CONFLICT (instancia) DO UPDATE SET qtd = contagem_gatilhos.qtd + 1;
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS trg_contar_gatilhos ON respostas_automacao;
+    CREATE TRIGGER trg_contar_gatilhos
+        AFTER INSERT OR DELETE OR UPDATE OF instancia ON respostas_automacao
+        FOR EACH ROW EXECUTE FUNCTION contar_gatilhos();
+
+    -- Ponto de partida (mesma transação do trigger: nada escapa da contagem)
+    INSERT INTO contagem_gatilhos (instancia, qtd)
+    SELECT instancia, COUNT(*) FROM respostas_automacao GROUP BY instancia
+    ON CONFLICT (instancia) DO UPDATE SET qtd = EXCLUDED.qtd;
+
+    -- O que o dicionário LIMITES do /salvar garantia passa a ser regra de verdade
+    INSERT INTO regras (plano, funcionalidade, ativo, limite)
+    SELECT nome, 'max_gatilhos', TRUE, CASE WHEN nome = 'Básico' THEN 5 ELSE 0 END FROM planos_comerciais
+    ON CONFLICT (plano, funcionalidade) DO NOTHING;
+    INSERT INTO regras (plano, funcionalidade, ativo, limite)
+    SELECT nome, 'permite_midia', nome <> 'Básico', 0 FROM planos_comerciais
+    ON CONFLICT (plano, funcionalidade) DO NOTHING;
+"""
+
+
+def valor_regra(funcionalidade, ativo, limite):
+    return (limite or 0) if funcionalidade.startswith("max_") else bool(ativo)
+
+
+class FotoDireitos:
+    """Imutável: a troca de foto é uma atribuição só (segura para as rotas em thread)."""
+
+    def __init__(self, planos, regras, carregada_em):
+        self.planos = planos          # nome -> linha de planos_comerciais
+        self.regras = regras          # nome -> {funcionalidade: valor}
+        self.carregada_em = carregada_em
+
+
+class DireitosPlanos:
+    def __init__(self):
+        self.pool = None
+        self._foto = FotoDireitos({}, {}, None)
+        self._conn_listen = None
+        self._sinal = None
+        self._tarefa = None
+
+        # Métricas
+        self.recargas = 0
+        self.notificacoes = 0
+        self.consultas = 0
+        self.ultimo_erro = None
+
+    async def iniciar(self, pool):
+        self.pool = pool   # contagem_gatilhos + regras iniciais: migração 010 (migracoes.py)
+        self._sinal = asyncio.Event()
+        await self._escutar()
+        await self.recarregar()
+        self._tarefa = asyncio.create_task(self._loop())
+
+    async def parar(self):
+        if self._tarefa:
+            self._tarefa.cancel()
+            await asyncio.gather(self._tarefa, return_exceptions=True)
+            self._tarefa = None
+        if self._conn_listen is not None:
+            try: await self._conn_listen.remove_listener(CANAL_DIREITOS, self._ao_notificar)
+            except Exception: pass
+            await self.pool.release(self._conn_listen)
+            self._conn_listen = None
+
+    async def _escutar(self):
+        if self._conn_listen is not None:
+            # Conexão do LISTEN que caiu volta para o pool (que a substitui); senão a vaga se perde
+            velha, self._conn_listen = self._conn_listen, None
+            try: await self.pool.release(velha)
+            except Exception: pass
+        self._conn_listen = await self.pool.acquire()
+        await self._conn_listen.add_listener(CANAL_DIREITOS, self._ao_notificar)
+
+    def _ao_notificar(self, conn, pid, canal, payload):
+        self.notificacoes += 1
+        self._sinal.set()
+
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._sinal.wait(), timeout=DIREITOS_RECARREGAR_S)
+            except asyncio.TimeoutError:
+                pass
+            self._sinal.clear()   # várias notificações seguidas = uma recarga
+            try:
+                if self._conn_listen is None or self._conn_listen.is_closed():
+                    await self._escutar()
+                await self.recarregar()
+            except Exception as e:
+                self.ultimo_erro = str(e)
+                log.warning("Recarga dos direitos dos planos falhou: %s", e)
+
+    async def recarregar(self):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction(isolation='repeatable_read', readonly=True):
+                linhas_planos = await conn.fetch("SELECT * FROM planos_comerciais ORDER BY valor ASC")
+                linhas_regras = await conn.fetch("SELECT plano, funcionalidade, ativo, limite FROM regras")
+                legado = []
+                if await conn.fetchval("SELECT to_regclass('regras_planos') IS NOT NULL"):
+                    legado = await conn.fetch("SELECT * FROM regras_planos")
+
+        regras = {}
+        for r in legado:
+            regras.setdefault(r['plano'], {})[r['funcionalidade']] = valor_regra(r['funcionalidade'], r['ativo'], r.get('limite'))
+        for r in linhas_regras:
+            regras.setdefault(r['plano'], {})[r['funcionalidade']] = valor_regra(r['funcionalidade'], r['ativo'], r['limite'])
+
+        self._foto = FotoDireitos({p['nome']: dict(p) for p in linhas_planos}, regras, time.strftime("%Y-%m-%d %H:%M:%S"))
+        self.recargas += 1
+        self.ultimo_erro = None
+
+    # --- CONSULTAS (sem I/O; servem para rotas sync e async) ---
+    def regras(self, plano):
+        foto = self._foto
+        self.consultas += 1
+        if plano not in foto.regras and plano not in foto.planos:
+            plano = PLANO_PADRAO
+        return {**PADROES, **foto.regras.get(plano, {})}
+
+    def permite(self, plano, funcionalidade):
+        return bool(self.regras(plano).get(funcionalidade, False))
+
+    def limite(self, plano, funcionalidade):
+        """Inteiro, ou None se ilimitado (0 / regra inexistente sem padrão)."""
+        return self.regras(plano).get(funcionalidade) or None
+
+    def planos(self):
+        """Planos (ordem de preço) com as regras embutidas, como o /planos/listar devolve."""
+        foto = self._foto
+        return [{**p, "regras": dict(foto.regras.get(nome, {}))} for nome, p in foto.planos.items()]
+
+    def estatisticas(self):
+        foto = self._foto
+        return {
+            "planos": len(foto.planos),
+            "regras": sum(len(r) for r in foto.regras.values()),
+            "carregada_em": foto.carregada_em,
+            "recargas": self.recargas,
+            "notificacoes": self.notificacoes,
+            "consultas": self.consultas,
+            "ultimo_erro": self.ultimo_erro,
+        }
+
+
+direitos = DireitosPlanos()
+
+
+def invalidar_direitos(cur):
+    """Chamar DENTRO da transação que alterou planos/regras (cursor psycopg2): avisa no COMMIT."""
+    cur.execute("SELECT pg_notify(%s, '')", (CANAL_DIREITOS,))
+
+
+def qtd_gatilhos(cur, instancia, travar=False):
+    """
+    Gatilhos da instância pelo contador. travar=True: segura a linha do
+    contador até o fim da transação (dois /salvar simultâneos não passam
+    os dois pelo limite).
+    """
+    if travar:
+        cur.execute("""
+            INSERT INTO contagem_gatilhos (instancia, qtd) VALUES (%s, 0)
+            ON CONFLICT (instancia) DO UPDATE SET qtd = contagem_gatilhos.qtd
+            RETURNING qtd
+        """, (instancia,))
+    else:
+        cur.execute("SELECT qtd FROM contagem_gatilhos WHERE instancia = %s", (instancia,))
+    linha = cur.fetchone()
+    if not linha: return 0
+    return linha['qtd'] if isinstance(linha, dict) else linha[0]
@@ -0,0 +1,296 @@
+# ==========================================================
+# 📊 ROLLUPS DO DASHBOARD (/metricas/{instancia})
+# ==========================================================
+# O dashboard lia chat_logs / atendimentos_concluidos / clientes_finais
+# inteiros a cada carregamento. Agora ele lê só tabelas pequenas, já
+# agregadas por instância:
+#
+#   metricas_hora          -> (instancia, hora): mensagens, atendimentos
+#   metricas_atendente_dia -> (instancia, dia, atendente): atendimentos
+#   metricas_etiquetas     -> (instancia, etiquetas): qtd de clientes (foto)
+#
+# Quem mantém:
+#   - finalizar_atendimento_v2 soma +1 na mesma transação (tempo real);
+#   - o COMPACTADOR (um worker só, advisory lock) a cada
+#     METRICAS_COMPACTAR_S recalcula os baldes desde a última marca
+#     (metricas_marca), voltando METRICAS_MARGEM_S para pegar linhas que
+#     chegaram atrasadas. O recálculo grava o valor absoluto, então rodar
+#     duas vezes não duplica nada. chat_logs é escrito fora desta API, por
+#     isso as mensagens só entram pelo compactador.
+#   - a foto de etiquetas/total de clientes é refeita a cada
+#     METRICAS_CLIENTES_S.
+# ==========================================================
+import os
+import asyncio
+from datetime import datetime, timedelta
+
+from banco import garantir_indices
+from logs import obter_logger
+
+log = obter_logger("rollups")
+
+METRICAS_COMPACTAR_S = int(os.getenv("METRICAS_COMPACTAR_S", 60))
+METRICAS_MARGEM_S = int(os.getenv("METRICAS_MARGEM_S", 600))
+METRICAS_CLIENTES_S = int(os.getenv("METRICAS_CLIENTES_S", 300))
+METRICAS_JANELA_MAX_H = int(os.getenv("METRICAS_JANELA_MAX_H", 24))       # backfill em pedaços
+METRICAS_TIMEOUT_S = int(os.getenv("METRICAS_TIMEOUT_S", 300))           # agregações grandes
+
+CHAVE_COMPACTADOR = 728403     # advisory lock do compactador
+CHAVE_INDICES_FONTES = 728404  # advisory lock do build dos índices de data
+
+DDL_ROLLUPS = """
+    CREATE TABLE IF NOT EXISTS metricas_hora (
+        instancia VARCHAR(100) NOT NULL,
+        hora TIMESTAMP NOT NULL,
+        mensagens INTEGER NOT NULL DEFAULT 0,
+        atendimentos INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (instancia, hora)
+    );
+
+    CREATE TABLE IF NOT EXISTS metricas_atendente_dia (
+        instancia VARCHAR(100) NOT NULL,
+        dia DATE NOT NULL,
+        nome_atendente VARCHAR(255) NOT NULL,
+        atendimentos INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (instancia, dia, nome_atendente)
+    );
+
+    CREATE TABLE IF NOT EXISTS metricas_etiquetas (
+        instancia VARCHAR(100) NOT NULL,
+        etiquetas TEXT NOT NULL,          -- '' = sem etiqueta
+        qtd INTEGER NOT NULL DEFAULT 0,
+        atualizado_em TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (instancia, etiquetas)
+    );
+
+    CREATE TABLE IF NOT EXISTS metricas_marca (
+        fonte VARCHAR(50) PRIMARY KEY,
+        processado_ate TIMESTAMP NOT NULL
+    );
+"""
+
+# Índices nas colunas de data das fontes: o compactador só lê a janela nova
+INDICES_FONTES = [
+    ("idx_chat_logs_data_hora", "ON chat_logs (data_hora)"),
+    ("idx_atendimentos_concluidos_data_fim", "ON atendimentos_concluidos (data_fim)"),
+]
+
+
+# ==========================================================
+# ESCRITA EM TEMPO REAL (cursor psycopg2, dentro da transação da rota)
+# ==========================================================
+def registrar_atendimento_concluido(cur, instancia, nome_atendente):
+    cur.execute("""
+        INSERT INTO metricas_hora (instancia, hora, atendimentos)
+        VALUES (%s, date_trunc('hour', NOW()::timestamp), 1)
+        ON CONFLICT (instancia, hora) DO UPDATE SET atendimentos = metricas_hora.atendimentos + 1
+    """, (instancia,))
+    cur.execute("""
+        INSERT INTO metricas_atendente_dia (instancia, dia, nome_atendente, atendimentos)
+        VALUES (%s, CURRENT_DATE, %s, 1)
+        ON CONFLICT (instancia, dia, nome_atendente) DO UPDATE SET atendimentos = metricas_atendente_dia.atendimentos + 1
+    """, (instancia, nome_atendente or ""))
+
+
+# ==========================================================
+# LEITURA (o que o /metricas devolve)
+# ==========================================================
+def ler_metricas(cur, instancia, dias):
+    """cur: RealDictCursor. Só toca nos rollups: custo fixo, independe do histórico."""
+    data_corte = datetime.now() - timedelta(days=dias)
+
+    cur.execute("SELECT COALESCE(SUM(qtd), 0)::int AS total FROM metricas_etiquetas WHERE instancia = %s", (instancia,))
+    total_clientes = cur.fetchone()['total']
+
+    cur.execute("""
+        SELECT COALESCE(SUM(atendimentos), 0)::int AS total FROM metricas_hora
+        WHERE instancia = %s AND hora >= date_trunc('hour', %s::timestamp)
+    """, (instancia, data_corte))
+    total_atendimentos = cur.fetchone()['total']
+
+    cur.execute("""
+        SELECT nome_atendente, SUM(atendimentos)::int AS qtd
+        FROM metricas_atendente_dia
+        WHERE instancia = %s AND dia >= %s
+        GROUP BY nome_atendente
+        ORDER BY qtd DESC LIMIT 5
+    """, (instancia, data_corte.date()))
+    ranking_atendentes = cur.fetchall()
+
+    cur.execute("""
+        SELECT hora::date AS data, SUM(mensagens)::int AS qtd
+        FROM metricas_hora
+        WHERE instancia = %s AND hora >= date_trunc('hour', %s::timestamp) AND mensagens > 0
+        GROUP BY 1 ORDER BY 1 ASC
+    """, (instancia, data_corte))
+    grafico_diario = cur.fetchall()
+    for g in grafico_diario: g['data'] = str(g['data'])
+
+    cur.execute("""
+        SELECT EXTRACT(HOUR FROM hora)::int AS hora, SUM(mensagens)::int AS qtd
+        FROM metricas_hora
+        WHERE instancia = %s AND hora >= date_trunc('hour', %s::timestamp) AND mensagens > 0
+        GROUP BY 1 ORDER BY 1 ASC
+    """, (instancia, data_corte))
+    grafico_horario = cur.fetchall()
+
+    cur.execute("""
+        SELECT NULLIF(etiquetas, '') AS etiquetas, qtd
+        FROM metricas_etiquetas WHERE instancia = %s
+    """, (instancia,))
+    grafico_etiquetas = cur.fetchall()
+
+    return {
+        "kpis": {
+            "clientes": total_clientes,
+            "atendimentos_mes": total_atendimentos,
+        },
+        "ranking": ranking_atendentes,
+        "diario": grafico_diario,
+        "horario": grafico_horario,
+        "etiquetas": grafico_etiquetas
+    }
+
+
+# ==========================================================
+# COMPACTADOR (asyncpg)
+# ==========================================================
+class CompactadorMetricas:
+    def __init__(self, pool, intervalo=METRICAS_COMPACTAR_S):
+        self.pool = pool
+        self.intervalo = intervalo
+        self._tarefa = None
+        self._clientes_em = 0.0
+
+        # Métricas
+        self.execucoes = 0
+        self.ultima_execucao = None
+        self.ultimo_erro = None
+
+    async def iniciar(self):
+        # Tabelas: migração 006 (migracoes.py)
+        self._tarefa = asyncio.create_task(self._loop())
+
+    async def parar(self):
+        if self._tarefa:
+            self._tarefa.cancel()
+            await asyncio.gather(self._tarefa, return_exceptions=True)
+            self._tarefa = None
+
+    async def _loop(self):
+        await self._criar_indices()
+        while True:
+            try:
+                # Backfill: enquanto houver pedaço atrasado, emenda a próxima rodada
+                while await self.compactar():
+                    await asyncio.sleep(0.5)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.ultimo_erro = str(e)
+                log.warning("Compactador de métricas falhou: %s", e)
+            await asyncio.sleep(self.intervalo)
+
+    async def _criar_indices(self):
+        await garantir_indices(self.pool, INDICES_FONTES, CHAVE_INDICES_FONTES)
+
+    async def compactar(self):
+        """Uma rodada. Retorna True se ainda ficou janela atrasada (backfill)."""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # Só um worker compacta por vez; os outros pulam a rodada
+                if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", CHAVE_COMPACTADOR):
+                    return False
+                atrasado = await self._compactar_mensagens(conn)
+                atrasado = await self._compactar_atendimentos(conn) or atrasado
+
+            agora = asyncio.get_running_loop().time()
+            if agora - self._clientes_em >= METRICAS_CLIENTES_S:
+                async with conn.transaction():
+                    if await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", CHAVE_COMPACTADOR):
+                        await self._foto_clientes(conn)
+                        self._clientes_em = agora
+
+        self.execucoes += 1
+        self.ultima_execucao = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.ultimo_erro = None
+        return atrasado
+
+    async def _janela(self, conn, fonte, tabela, coluna, alinhar):
+        """Retorna (inicio, fim, atrasado) do próximo pedaço a recalcular, alinhado à hora/dia."""
+        marca = await conn.fetchval("SELECT processado_ate FROM metricas_marca WHERE fonte = $1", fonte)
+        if marca is None:
+            # Primeira vez: começa do registro mais antigo (backfill em pedaços)
+            marca = await conn.fetchval(f"SELECT MIN({coluna}) FROM {tabela}")
+            if marca is None: return None
+        else:
+            marca = marca - timedelta(seconds=METRICAS_MARGEM_S)
+
+        inicio = await conn.fetchval(f"SELECT date_trunc('{alinhar}', $1::timestamp)", marca)
+        agora = await conn.fetchval("SELECT LOCALTIMESTAMP")
+        fim = min(agora, inicio + timedelta(hours=METRICAS_JANELA_MAX_H))
+        return inicio, fim, fim < agora
+
+    async def _gravar_marca(self, conn, fonte, fim):
+        await conn.execute("""
+            INSERT INTO metricas_marca (fonte, processado_ate) VALUES ($1, $2)
+            ON CONFLICT (fonte) DO UPDATE SET processado_ate = EXCLUDED.processado_ate
+        """, fonte, fim)
+
+    async def _compactar_mensagens(self, conn):
+        janela = await self._janela(conn, "chat_logs", "chat_logs", "data_hora", "hour")
+        if not janela: return False
+        inicio, fim, atrasado = janela
+        await conn.execute("""
+            INSERT INTO metricas_hora (instancia, hora, mensagens)
+            SELECT instancia, date_trunc('hour', data_hora), COUNT(*)
+            FROM chat_logs
+            WHERE data_hora >= $1 AND data_hora < $2
+            GROUP BY 1, 2
+            ON CONFLICT (instancia, hora) DO UPDATE SET mensagens = EXCLUDED.mensagens
+        """, inicio, fim, timeout=METRICAS_TIMEOUT_S)
+        await self._gravar_marca(conn, "chat_logs", fim)
+        return atrasado
+
+    async def _compactar_atendimentos(self, conn):
+        # Alinhado ao dia: o ranking é por dia, então o dia inteiro é recalculado
+        janela = await self._janela(conn, "atendimentos_concluidos", "atendimentos_concluidos", "data_fim", "day")
+        if not janela: return False
+        inicio, fim, atrasado = janela
+        await conn.execute("""
+            INSERT INTO metricas_hora (instancia, hora, atendimentos)
+            SELECT instancia, date_trunc('hour', data_fim), COUNT(*)
+            FROM atendimentos_concluidos
+            WHERE data_fim >= $1 AND data_fim < $2
+            GROUP BY 1, 2
+            ON CONFLICT (instancia, hora) DO UPDATE SET atendimentos = EXCLUDED.atendimentos
+        """, inicio, fim, timeout=METRICAS_TIMEOUT_S)
+        await conn.execute("""
+            INSERT INTO metricas_atendente_dia (instancia, dia, nome_atendente, atendimentos)
+            SELECT instancia, data_fim::date, COALESCE(nome_atendente, ''), COUNT(*)
+            FROM atendimentos_concluidos
+            WHERE data_fim >= $1 AND data_fim < $2
+            GROUP BY 1, 2, 3
+            ON CONFLICT (instancia, dia, nome_atendente) DO UPDATE SET atendimentos = EXCLUDED.atendimentos
+        """, inicio, fim, timeout=METRICAS_TIMEOUT_S)
+        await self._gravar_marca(conn, "atendimentos_concluidos", fim)
+        return atrasado
+
+    async def _foto_clientes(self, conn):
+        await conn.execute("""
+            INSERT INTO metricas_etiquetas (instancia, etiquetas, qtd, atualizado_em)
+            SELECT instancia, COALESCE(etiquetas, ''), COUNT(*), NOW()
+            FROM clientes_finais
+            GROUP BY 1, 2
+            ON CONFLICT (instancia, etiquetas) DO UPDATE SET qtd = EXCLUDED.qtd, atualizado_em = EXCLUDED.atualizado_em
+        """, timeout=METRICAS_TIMEOUT_S)
+        # Etiqueta que sumiu da base sai da foto
+        await conn.execute("DELETE FROM metricas_etiquetas WHERE atualizado_em < NOW()")
+
+    def estatisticas(self):
+        return {
+            "execucoes": self.execucoes,
+            "ultima_execucao": self.ultima_execucao,
+            "ultimo_erro": self.ultimo_erro,
+            "intervalo_s": self.intervalo,
+        }
@@ -0,0 +1,274 @@
+# ==========================================================
+# 📈 TELEMETRIA (/metrics NO FORMATO DE TEXTO DO PROMETHEUS)
+# ==========================================================
+# Até aqui só havia print() com emoji. Agora cada worker mede:
+#   - requisições: contagem e histograma de latência por rota (o MOLDE
+#     da rota, ex. /chat/local/{instancia}/{remote_jid}, nunca a URL
+#     crua), método e status; quantas estão em andamento;
+#   - banco por requisição: quantas consultas e quanto tempo (psycopg2
+#     pelos cursores do pool, asyncpg pelo query logger — banco.py);
+#   - chamadas de saída (Evolution, Mercado Pago): latência por operação
+#     e resultado (2xx/4xx/5xx/rede);
+#   - filas (webhook, disparos) e pool: lidos na hora da coleta.
+#
+# Sem dependência: registro próprio, texto no formato de exposição 0.0.4.
+# Cada worker do uvicorn tem o seu registro (como o pool e os caches): o
+# /metrics responde pelo worker que atendeu — com vários workers, o
+# Prometheus deve raspar cada um (uma porta por worker) ou somar por pid.
+# ==========================================================
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+BALDES_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BALDES_CONSULTAS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# Consultas da requisição atual: [quantidade, segundos]
+_consultas_requisicao = contextvars.ContextVar("consultas_requisicao", default=None)
+
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _numero(valor):
+    if valor == float("inf"): return "+Inf"
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+
+def _rotulos(nomes, valores, extra=""):
+    pares = [f'{n}="{_escapar(v)}"' for n, v in zip(nomes, valores)]
+    if extra: pares.append(extra)
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+
+class _Metrica:
+    tipo = "untyped"
+
+    def __init__(self, nome, ajuda, rotulos=()):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.rotulos = tuple(rotulos)
+        self._valores = {}
+        self._trava = threading.Lock()
+
+    def _chave(self, rotulos):
+        return tuple(str(rotulos.get(n, "")) for n in self.rotulos)
+
+    def cabecalho(self):
+        return [f"# HELP {self.nome} {self.ajuda}", f"# TYPE {self.nome} {self.tipo}"]
+
+    def linhas(self):
+        with self._trava:
+            itens = sorted(self._valores.items())
+        return [f"{self.nome}{_rotulos(self.rotulos, k)} {_numero(v)}" for k, v in itens]
+
+
+class Contador(_Metrica):
+    tipo = "counter"
+
+    def inc(self, valor=1, **rotulos):
+        chave = self._chave(rotulos)
+        with self._trava:
+            self._valores[chave] = self._valores.get(chave, 0) + valor
+
+
+class Medidor(_Metrica):
+    tipo = "gauge"
+
+    def definir(self, valor, **rotulos):
+        with self._trava:
+            self._valores[self._chave(rotulos)] = valor
+
+    def somar(self, valor=1, **rotulos):
+        chave = self._chave(rotulos)
+        with self._trava:
+            self._valores[chave] = self._valores.get(chave, 0) + valor
+
+
+class Histograma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nome, ajuda, rotulos=(), baldes=BALDES_LATENCIA):
+        super().__init__(nome, ajuda, rotulos)
+        self.baldes = tuple(sorted(baldes)) + (float("inf"),)
+
+    def observar(self, valor, **rotulos):
+        chave = self._chave(rotulos)
+        with self._trava:
+            item = self._valores.get(chave)
+            if item is None:
+                item = self._valores[chave] = [[0] * len(self.baldes), 0.0, 0]   # contagens, soma, total
+            for i, limite in enumerate(self.baldes):
+                if valor <= limite:
+                    item[0][i] += 1
+                    break
+            item[1] += valor
+            item[2] += 1
+
+    def linhas(self):
+        with self._trava:
+            itens = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._valores.items())
+        saida = []
+        for chave, (contagens, soma, total) in itens:
+            acumulado = 0
+            for limite, qtd in zip(self.baldes, contagens):
+                acumulado += qtd
+                le = 'le="%s"' % _numero(limite)
+                saida.append(f"{self.nome}_bucket{_rotulos(self.rotulos, chave, le)} {acumulado}")
+            saida.append(f"{self.nome}_sum{_rotulos(self.rotulos, chave)} {_numero(soma)}")
+            saida.append(f"{self.nome}_count{_rotulos(self.rotulos, chave)} {total}")
+        return saida
+
+
+class Registro:
+    def __init__(self):
+        self._metricas = []
+        self._coletores = []
+
+    def _adicionar(self, metrica):
+        self._metricas.append(metrica)
+        return metrica
+
+    def contador(self, nome, ajuda, rotulos=()):
+        return self._adicionar(Contador(nome, ajuda, rotulos))
+
+    def medidor(self, nome, ajuda, rotulos=()):
+        return self._adicionar(Medidor(nome, ajuda, rotulos))
+
+    def histograma(self, nome, ajuda, rotulos=(), baldes=BALDES_LATENCIA):
+        return self._adicionar(Histograma(nome, ajuda, rotulos, baldes))
+
+    def ao_coletar(self, funcao):
+        """funcao: async () -> None; roda a cada /metrics (atualiza medidores de fila, pool...)."""
+        self._coletores.append(funcao)
+        return funcao
+
+    async def exportar(self):
+        for coletor in self._coletores:
+            try:
+                await coletor()
+            except Exception as e:
+                print(f"⚠️ Telemetria: coletor {getattr(coletor, '__name__', coletor)} falhou: {e}")
+        linhas = []
+        for m in self._metricas:
+            linhas += m.cabecalho() + m.linhas()
+        return "\n".join(linhas) + "\n"
+
+
+registro = Registro()
+
+requisicoes = registro.contador("http_requisicoes_total", "Requisições atendidas.", ("metodo", "rota", "status"))
+latencia = registro.histograma("http_requisicao_duracao_segundos", "Latência das requisições (até a resposta começar).", ("metodo", "rota"))
+em_andamento = registro.medidor("http_requisicoes_em_andamento", "Requisições sendo atendidas agora.")
+consultas_por_requisicao = registro.histograma(
+    "db_consultas_por_requisicao", "Consultas ao banco feitas por requisição.", ("rota",), BALDES_CONSULTAS)
+tempo_banco_por_requisicao = registro.histograma(
+    "db_tempo_por_requisicao_segundos", "Tempo gasto em consultas ao banco por requisição.", ("rota",))
+saida_latencia = registro.histograma(
+    "saida_duracao_segundos", "Latência das chamadas a serviços externos.", ("destino", "operacao", "resultado"))
+fila_profundidade = registro.medidor("fila_profundidade", "Itens esperando em cada fila.", ("fila", "estado"))
+pool_conexoes = registro.medidor("db_pool_conexoes", "Conexões do pool deste worker.", ("pool", "estado"))
+processo_info = registro.medidor("processo_info", "Worker que respondeu esta coleta.", ("pid",))
+processo_info.definir(1, pid=os.getpid())
+
+
+# ==========================================================
+# BANCO (chamado por banco.py)
+# ==========================================================
+def contar_consulta(duracao):
+    medicao = _consultas_requisicao.get()
+    if medicao is not None:
+        medicao[0] += 1
+        medicao[1] += duracao
+
+
+# ==========================================================
+# REQUISIÇÕES (middleware do main.py)
+# ==========================================================
+def _molde_rota(request):
+    rota = request.scope.get("route")
+    return getattr(rota, "path", None) or "nao_encontrada"
+
+
+async def medir_requisicao(request, call_next):
+    medicao = [0, 0.0]
+    token = _consultas_requisicao.set(medicao)
+    em_andamento.somar(1)
+    inicio = time.perf_counter()
+    status = 500
+    try:
+        resposta = await call_next(request)
+        status = resposta.status_code
+        return resposta
+    finally:
+        duracao = time.perf_counter() - inicio
+        em_andamento.somar(-1)
+        _consultas_requisicao.reset(token)
+        rota = _molde_rota(request)
+        requisicoes.inc(metodo=request.method, rota=rota, status=status)
+        latencia.observar(duracao, metodo=request.method, rota=rota)
+        consultas_por_requisicao.observar(medicao[0], rota=rota)
+        tempo_banco_por_requisicao.observar(medicao[1], rota=rota)
+
+
+# ==========================================================
+# CHAMADAS DE SAÍDA
+# ==========================================================
+def faixa_status(status):
+    return f"{status // 100}xx" if status else "rede"
+
+
+def registrar_saida(destino, operacao, duracao, resultado):
+    saida_latencia.observar(duracao, destino=destino, operacao=operacao, resultado=resultado)
+
+
+@contextmanager
+def medir_saida(destino, operacao):
+    inicio = time.perf_counter()
+    resultado = "erro"
+    try:
+        yield
+        resultado = "ok"
+    finally:
+        registrar_saida(destino, operacao, time.perf_counter() - inicio, resultado)
+
+
+class _RecursoMedido:
+    """sdk.payment() medido: cada método chamado vira uma observação destino/recurso.metodo."""
+
+    def __init__(self, destino, nome, recurso):
+        self._destino = destino
+        self._nome = nome
+        self._recurso = recurso
+
+    def __getattr__(self, metodo):
+        alvo = getattr(self._recurso, metodo)
+        if not callable(alvo): return alvo
+
+        def medido(*args, **kwargs):
+            inicio = time.perf_counter()
+            resultado = "rede"
+            try:
+                resposta = alvo(*args, **kwargs)
+                status = resposta.get("status") if isinstance(resposta, dict) else None
+                resultado = faixa_status(status) if isinstance(status, int) else "ok"
+                return resposta
+            finally:
+                registrar_saida(self._destino, f"{self._nome}.{metodo}", time.perf_counter() - inicio, resultado)
+        return medido
+
+
+class ClienteMedido:
+    """Embrulha um SDK no estilo sdk.recurso().metodo(...) (Mercado Pago)."""
+
+    def __init__(self, destino, sdk):
+        self._destino = destino
+        self._sdk = sdk
+
+    def __getattr__(self, nome):
+        fabrica = getattr(self._sdk, nome)
+        if not callable(fabrica): return fabrica
+        return lambda *args, **kwargs: _RecursoMedido(self._destino, nome, fabrica(*args, **kwargs))
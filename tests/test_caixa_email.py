@@ -0,0 +1,140 @@
+# ==========================================================
+# 🧪 CAIXA DE E-MAIL: SESSÃO SMTP, RECUSAS E DONO DO E-MAIL
+# ==========================================================
+# smtplib.SMTP trocado por um servidor falso em memória (sem rede).
+# Rodar: python -m pytest -q tests
+# ==========================================================
+import asyncio
+import smtplib
+
+import pytest
+
+import caixa_email
+
+
+class SMTPFalso:
+    """Imita o smtplib.SMTP: recusas e quedas são programadas por destinatário."""
+    conexoes = []
+    recusas = {}          # destinatario -> exceção a levantar no sendmail
+
+    def __init__(self, host, porta, timeout=None):
+        self.enviados = []
+        self.aberta = True
+        SMTPFalso.conexoes.append(self)
+
+    def starttls(self): pass
+    def login(self, usuario, senha): pass
+
+    def noop(self):
+        if not self.aberta: raise smtplib.SMTPServerDisconnected()
+        return (250, b"ok")
+
+    def sendmail(self, remetente, destinatario, mensagem):
+        erro = SMTPFalso.recusas.get(destinatario)
+        if erro is not None:
+            if isinstance(erro, smtplib.SMTPServerDisconnected): self.aberta = False
+            raise erro
+        self.enviados.append(destinatario)
+
+    def quit(self): self.aberta = False
+    def close(self): self.aberta = False
+
+
+@pytest.fixture(autouse=True)
+def smtp_falso(monkeypatch):
+    SMTPFalso.conexoes = []
+    SMTPFalso.recusas = {}
+    monkeypatch.setattr(caixa_email.smtplib, "SMTP", SMTPFalso)
+    monkeypatch.setattr(caixa_email, "SMTP_HOST", "smtp.falso")
+    monkeypatch.setattr(caixa_email, "SMTP_TLS", False)
+    monkeypatch.setattr(caixa_email, "SMTP_USER", None)
+    return SMTPFalso
+
+
+def test_sessao_reaproveitada_entre_envios():
+    sessao = caixa_email.SessaoSMTP()
+    for i in range(4):
+        sessao.enviar(f"cliente{i}@teste.com", "Assunto", "<p>oi</p>")
+    assert len(SMTPFalso.conexoes) == 1
+    assert len(SMTPFalso.conexoes[0].enviados) == 4
+
+
+def test_destinatario_recusado_mantem_a_sessao_e_e_definitivo():
+    SMTPFalso.recusas["nao.existe@teste.com"] = smtplib.SMTPRecipientsRefused(
+        {"nao.existe@teste.com": (550, b"mailbox unavailable")})
+    sessao = caixa_email.SessaoSMTP()
+    with pytest.raises(smtplib.SMTPRecipientsRefused) as erro:
+        sessao.enviar("nao.existe@teste.com", "Assunto", "<p>oi</p>")
+    assert caixa_email.falha_definitiva(erro.value)
+    sessao.enviar("cliente@teste.com", "Assunto", "<p>oi</p>")
+    assert len(SMTPFalso.conexoes) == 1
+
+
+@pytest.mark.parametrize("erro", [
+    smtplib.SMTPRecipientsRefused({"a@teste.com": (452, b"too many recipients")}),
+    smtplib.SMTPAuthenticationError(535, b"authentication failed"),
+    smtplib.SMTPSenderRefused(530, b"must issue STARTTLS", "remetente@teste.com"),
+    smtplib.SMTPDataError(554, b"transaction failed"),
+    smtplib.SMTPServerDisconnected(),
+    ConnectionRefusedError(),
+])
+def test_erros_de_servidor_e_configuracao_sao_temporarios(erro):
+    assert not caixa_email.falha_definitiva(erro)
+
+
+def test_conexao_caida_descarta_a_sessao():
+    SMTPFalso.recusas["cai@teste.com"] = smtplib.SMTPServerDisconnected("caiu")
+    sessao = caixa_email.SessaoSMTP()
+    with pytest.raises(smtplib.SMTPServerDisconnected):
+        sessao.enviar("cai@teste.com", "Assunto", "<p>oi</p>")
+    sessao.enviar("cliente@teste.com", "Assunto", "<p>oi</p>")
+    assert len(SMTPFalso.conexoes) == 2
+
+
+class PoolFalso:
+    """Só o necessário para o _enviar: a renovação responde se o e-mail ainda é nosso."""
+
+    def __init__(self, ainda_dono):
+        self.ainda_dono = ainda_dono
+        self.comandos = []
+
+    async def fetchval(self, sql, *args):
+        self.comandos.append(sql)
+        return args[0] if self.ainda_dono else None
+
+    async def execute(self, sql, *args):
+        self.comandos.append(sql)
+
+
+def _email():
+    return {"id": 7, "destinatario": "cliente@teste.com", "assunto": "Assunto", "corpo_html": "<p>oi</p>", "tentativas": 0}
+
+
+def test_email_que_voltou_para_a_fila_nao_e_enviado():
+    enviador = caixa_email.EnviadorEmails(PoolFalso(ainda_dono=False))
+    asyncio.run(enviador._enviar(_email()))
+    assert SMTPFalso.conexoes == []
+    assert enviador.perdidos == 1 and enviador.enviados == 0
+
+
+def test_email_ainda_nosso_e_enviado_e_marcado():
+    pool = PoolFalso(ainda_dono=True)
+    enviador = caixa_email.EnviadorEmails(pool)
+    asyncio.run(enviador._enviar(_email()))
+    assert SMTPFalso.conexoes[0].enviados == ["cliente@teste.com"]
+    assert enviador.enviados == 1
+    assert "status = 'enviado'" in pool.comandos[-1]
+
+
+def test_login_recusado_volta_para_a_fila(monkeypatch):
+    class SMTPSemLogin(SMTPFalso):
+        def login(self, usuario, senha):
+            raise smtplib.SMTPAuthenticationError(535, b"authentication failed")
+
+    monkeypatch.setattr(caixa_email.smtplib, "SMTP", SMTPSemLogin)
+    monkeypatch.setattr(caixa_email, "SMTP_USER", "usuario")
+    pool = PoolFalso(ainda_dono=True)
+    enviador = caixa_email.EnviadorEmails(pool)
+    asyncio.run(enviador._enviar(_email()))
+    assert enviador.falhas == 0 and enviador.repeticoes == 1
+    assert "status = 'pendente'" in pool.comandos[-1]
@@ -0,0 +1,131 @@
+# ==========================================================
+# 🧪 ESTADO DA CONVERSA: BACKEND REDIS CONTRA UM SERVIDOR FALSO
+# ==========================================================
+# RedisFalso imita o que o EstadoRedis usa do redis.asyncio (get, set com
+# EX, delete, pipeline, ping), com relógio controlado para testar o TTL.
+# Com o pacote fakeredis instalado, o mesmo roteiro roda contra ele.
+# Rodar: python -m pytest -q tests
+# ==========================================================
+import asyncio
+import types
+
+import pytest
+
+import estado_conversa
+
+
+class RedisFalso:
+    def __init__(self):
+        self.agora = 0.0
+        self.dados = {}          # chave -> (valor, expira_em | None)
+        self.pipelines = 0
+
+    async def ping(self): return True
+    async def aclose(self): pass
+
+    async def get(self, chave):
+        item = self.dados.get(chave)
+        if item is None: return None
+        valor, expira = item
+        if expira is not None and expira <= self.agora:
+            del self.dados[chave]
+            return None
+        return valor
+
+    def pipeline(self, transaction=True):
+        self.pipelines += 1
+        return PipelineFalso(self)
+
+
+class PipelineFalso:
+    def __init__(self, redis):
+        self.redis = redis
+        self.comandos = []
+
+    def set(self, chave, valor, ex=None):
+        self.comandos.append(("set", chave, valor, ex))
+
+    def delete(self, *chaves):
+        self.comandos.append(("delete", chaves))
+
+    async def execute(self):
+        for cmd in self.comandos:
+            if cmd[0] == "set":
+                _, chave, valor, ex = cmd
+                self.redis.dados[chave] = (valor, self.redis.agora + ex if ex else None)
+            else:
+                for chave in cmd[1]: self.redis.dados.pop(chave, None)
+
+
+@pytest.fixture
+def redis_falso(monkeypatch):
+    servidor = RedisFalso()
+    monkeypatch.setattr(estado_conversa, "TEM_REDIS", True)
+    monkeypatch.setattr(estado_conversa, "aioredis",
+                        types.SimpleNamespace(from_url=lambda url, **kw: servidor), raising=False)
+    return servidor
+
+
+def _rodar(redis, roteiro, ttl=60):
+    async def principal():
+        estado = estado_conversa.EstadoRedis(url="redis://falso", ttl=ttl, lote_ms=5)
+        await estado.iniciar()
+        try:
+            return await roteiro(estado, redis)
+        finally:
+            await estado.parar()
+    return asyncio.run(principal())
+
+
+def test_definir_obter_remover(redis_falso):
+    async def roteiro(estado, redis):
+        assert await estado.obter("inst", "5511@s.whatsapp.net") is None
+        await estado.definir("inst", "5511@s.whatsapp.net", 42)
+        assert await estado.obter("inst", "5511@s.whatsapp.net") == 42
+        assert "agil:estado:inst:5511@s.whatsapp.net" in redis.dados
+        await estado.remover("inst", "5511@s.whatsapp.net")
+        assert await estado.obter("inst", "5511@s.whatsapp.net") is None
+        assert redis.dados == {}
+    _rodar(redis_falso, roteiro)
+
+
+def test_ttl_expira_a_chave(redis_falso):
+    async def roteiro(estado, redis):
+        await estado.definir("inst", "a", {"no": 7})
+        assert redis.dados["agil:estado:inst:a"][1] == 30    # SET ... EX 30
+        redis.agora = 29
+        assert await estado.obter("inst", "a") == {"no": 7}
+        redis.agora = 30
+        assert await estado.obter("inst", "a") is None
+        await estado.definir("inst", "b", 1, ttl=5)           # TTL por chave
+        assert redis.dados["agil:estado:inst:b"][1] == redis.agora + 5
+    _rodar(redis_falso, roteiro, ttl=30)
+
+
+def test_escritas_simultaneas_saem_num_pipeline(redis_falso):
+    async def roteiro(estado, redis):
+        await asyncio.gather(*(estado.definir("inst", f"c{i}", i) for i in range(20)))
+        assert redis.pipelines == 1
+        assert [await estado.obter("inst", f"c{i}") for i in range(20)] == list(range(20))
+    _rodar(redis_falso, roteiro)
+
+
+def test_contra_fakeredis_se_instalado(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    servidor = fakeredis.FakeAsyncRedis(decode_responses=True)
+    monkeypatch.setattr(estado_conversa, "TEM_REDIS", True)
+    monkeypatch.setattr(estado_conversa, "aioredis",
+                        types.SimpleNamespace(from_url=lambda url, **kw: servidor), raising=False)
+
+    async def principal():
+        estado = estado_conversa.EstadoRedis(url="redis://falso", ttl=30, lote_ms=5)
+        await estado.iniciar()
+        try:
+            await estado.definir("inst", "a", 3)
+            assert await estado.obter("inst", "a") == 3
+            assert 0 < await servidor.ttl("agil:estado:inst:a") <= 30
+            await estado.remover("inst", "a")
+            assert await estado.obter("inst", "a") is None
+        finally:
+            await estado.parar()
+    asyncio.run(principal())
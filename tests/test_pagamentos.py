@@ -0,0 +1,128 @@
+# ==========================================================
+# 🧪 PAGAMENTOS: PRAZO VENCIDO NÃO APLICA DUAS VEZES
+# ==========================================================
+# LivroFalso guarda as linhas de pagamentos_mp em memória e respeita o
+# WHERE de cada UPDATE (status / dono), como o Postgres faria. O roteiro:
+# o worker A pega o pagamento, a consulta ao MP demora mais que o prazo,
+# a manutenção devolve a linha, o worker B pega e aplica — e o que A
+# fizer depois não pode desfazer nem repetir o que B fez.
+# Rodar: python -m pytest -q tests
+# ==========================================================
+import re
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import date
+
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("dotenv")
+
+import pagamentos
+
+
+class LivroFalso:
+    def __init__(self):
+        self.linhas = {"123": {"status": "recebido", "dono": None, "tentativas": 0}}
+        self.usuario = {"id": 7, "status_conta": "ativo", "data_vencimento": date(2030, 1, 1), "id_pagamento_mp": None}
+        self.renovacoes = 0
+
+    def vencer_prazos(self):
+        # O que o _loop_manutencao faz quando travado_ate passou
+        for linha in self.linhas.values():
+            if linha["status"] == "processando":
+                linha.update(status="recebido", dono=None)
+
+    # --- pool ---
+    async def fetch(self, sql, lote, dono):
+        pegos = []
+        for chave, linha in self.linhas.items():
+            if linha["status"] == "recebido":
+                linha.update(status="processando", dono=dono)
+                pegos.append({"id_pagamento": chave, "tentativas": linha["tentativas"], "notificacoes": 1})
+        return pegos
+
+    async def execute(self, sql, *args):
+        if "UPDATE usuarios" in sql:
+            self.renovacoes += 1
+            return
+        if "UPDATE pagamentos_mp" not in sql:
+            return
+        linha = self.linhas[args[0]]
+        conjunto, condicao = sql.split("WHERE", 1)
+        if "status = 'processando'" in condicao and linha["status"] != "processando":
+            return
+        dono = re.search(r"dono = \$(\d+)", condicao)
+        if dono and linha["dono"] != args[int(dono.group(1)) - 1]:
+            return
+        novo = re.search(r"status = '(\w+)'", conjunto)
+        linha["status"] = novo.group(1) if novo and "CASE" not in conjunto else args[1]
+        linha["dono"] = None
+
+    async def fetchval(self, sql, *args):
+        return False     # aprovado depois da migração: só o livro decide
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield self
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def fetchrow(self, sql, *args):
+        if "FROM pagamentos_mp" in sql:
+            return dict(self.linhas[args[0]])
+        return dict(self.usuario)
+
+
+class SDKFalso:
+    def __init__(self, status):
+        self.status = status
+
+    def payment(self):
+        return self
+
+    def get(self, id_pagamento):
+        return {"status": 200, "response": {"status": self.status, "external_reference": "7", "transaction_amount": 99.9}}
+
+
+APROVADO = {"status": "approved", "external_reference": "7", "transaction_amount": 99.9}
+
+
+def _disputa(livro):
+    """A pega, o prazo vence, B pega de novo."""
+    a = pagamentos.ProcessadorPagamentos(livro, sdk=None)
+    b = pagamentos.ProcessadorPagamentos(livro, sdk=None)
+
+    async def roteiro():
+        item_a = (await a._reivindicar("pagamentos_mp", "id_pagamento", "recebido", ""))[0]
+        livro.vencer_prazos()
+        item_b = (await b._reivindicar("pagamentos_mp", "id_pagamento", "recebido", ""))[0]
+        return item_a, item_b
+    item_a, item_b = asyncio.run(roteiro())
+    return a, b, item_a, item_b
+
+
+def test_falha_do_worker_atrasado_nao_reabre_pagamento_aplicado():
+    livro = LivroFalso()
+    a, b, item_a, _ = _disputa(livro)
+    asyncio.run(b._aplicar("123", APROVADO))
+    assert livro.linhas["123"]["status"] == "aplicado" and livro.renovacoes == 1
+
+    asyncio.run(a._repetir("pagamentos_mp", "id_pagamento", "123", item_a["tentativas"],
+                           RuntimeError("MP demorou"), pagamentos.PAGAMENTOS_MAX_TENTATIVAS, "recebido"))
+    asyncio.run(a._aplicar("123", APROVADO))
+    assert livro.linhas["123"]["status"] == "aplicado"
+    assert livro.renovacoes == 1
+
+
+def test_worker_atrasado_nao_estaciona_pagamento_de_outro():
+    livro = LivroFalso()
+    a, b, item_a, _ = _disputa(livro)
+    a.sdk = SDKFalso("pending")
+    asyncio.run(a._processar(item_a))
+    assert livro.linhas["123"] == {"status": "processando", "dono": b.dono, "tentativas": 0}
+
+    asyncio.run(b._aplicar("123", APROVADO))
+    assert livro.linhas["123"]["status"] == "aplicado" and livro.renovacoes == 1